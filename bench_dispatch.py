@@ -0,0 +1,71 @@
+"""
+Callback dispatch benchmark: oddiy (ro'yxat bo'yicha tekshiradigan) Dispatcher va main.py dagi CallbackTable
+o'rnatilgan Dispatcher'da bitta callback'ni ishlovchiga yetkazish vaqtini ishlovchilar soni oshgan sari solishtiradi.
+Oxirida main.py dagi haqiqiy routerlar uchun har bir callback'da nechta ishlovchi tekshirilishi ko'rsatiladi.
+
+Ishga tushirish:  python bench_dispatch.py [takrorlar_soni]
+
+main.py vaqtinchalik katalogda soxta token bilan import qilinadi (tarmoq kerak emas, baza vaqtinchalik).
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from aiogram import Dispatcher, F, Router, types
+
+SERVICES = 8  # xizmatlar (routerlar) soni
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("REQUIRED_CHANNEL", "@bench")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("METRICS_PORT", "0")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="bench_dispatch_"))
+import main  # noqa: E402
+async def _noop(callback: types.CallbackQuery):
+    return True
+def build(handlers: int, table: bool) -> Dispatcher:
+    dp = Dispatcher()
+    routers = []
+    for s in range(SERVICES):
+        router = Router(name=f"svc{s}")
+        if table:
+            main.use_callback_table(router)
+        routers.append(router)
+    for i in range(handlers):
+        router = routers[i % SERVICES]
+        # har to'rtinchisi prefiks bo'yicha (mah_sel_ kabi), qolganlari aniq qiymat bo'yicha
+        if i % 4 == 3:
+            router.callback_query.register(_noop, F.data.startswith(f"svc{i % SERVICES}_p{i}_"))
+        else:
+            router.callback_query.register(_noop, F.data == f"svc{i % SERVICES}_act{i}")
+    dp.include_routers(*routers)
+    return dp
+def make_callback(data: str) -> types.CallbackQuery:
+    user = types.User(id=1, is_bot=False, first_name="bench")
+    return types.CallbackQuery(id="1", from_user=user, chat_instance="bench", data=data)
+async def measure(dp: Dispatcher, callback: types.CallbackQuery, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await dp.propagate_event("callback_query", callback)
+    return (time.perf_counter() - start) / rounds * 1e6
+def real_candidates():
+    # main.py: callback yetib boradigan routerda nechta ishlovchi tekshiriladi (jami ishlovchilar bilan)
+    print(f"\n{'callback_data':<22} {'router':<10} {'tekshiriladi':>12} {'jami':>5}")
+    for data, router in (("buyurtma", main.buyurtma_router), ("mah_sel_3", main.buyurtma_router), ("profil_confirm_yes", main.profil_router),
+                         ("ua:chat:100", main.admin_router), ("rad_attach_yes", main.reklama_router), ("cp:ok:42:0:x", main.dp)):
+        table = router.callback_query
+        print(f"{data:<22} {router.name if router is not main.dp else 'dp':<10} {len(table.candidates(data)):>12} {len(table.handlers):>5}")
+async def run():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{'handlers':>9} {'flat, us':>10} {'table, us':>10} {'speedup':>8}")
+    for handlers in (40, 80, 160, 320, 640):
+        # eng yomon holatga yaqin: oxirgidan oldingi routerning oxirgi ishlovchisi
+        last = max(i for i in range(handlers) if i % SERVICES == SERVICES - 2)
+        callback = make_callback(f"svc{last % SERVICES}_act{last}")
+        flat = await measure(build(handlers, False), callback, rounds)
+        table = await measure(build(handlers, True), callback, rounds)
+        print(f"{handlers:>9} {flat:>10.1f} {table:>10.1f} {flat / table:>7.1f}x")
+    real_candidates()
+if __name__ == "__main__":
+    asyncio.run(run())
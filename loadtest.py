@@ -0,0 +1,261 @@
+"""
+Oflayn yuklama testi: soxta Telegram Bot API serveri (aiohttp) va virtual foydalanuvchilar.
+
+Server bot chiqargan barcha so'rovlarni yozib boradi va getUpdates orqali sintetik yangilanishlar beradi.
+main.py shu jarayonda TELEGRAM_API_URL bilan ishga tushiriladi (vaqtinchalik katalog va alohida baza bilan),
+virtual foydalanuvchilar esa haqiqiy oqimni bosib o'tadi:
+captcha -> profil -> buyurtma (fayllar bilan) -> operator javobi; oxirida bot egasi e'lon (broadcast) yuboradi.
+
+Ishga tushirish:  python loadtest.py --users 50 --rate 5 [--think 0.2] [--files 2] [--broadcasts 1] [--paced]
+
+Hisobot: har bir qadam uchun p50/p99 (yangilanish berilgandan botning kutilgan javobigacha), yangilanishlar/sek
+va chiquvchi Bot API so'rovlari/sek. Tarmoq kerak emas.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from aiohttp import web
+
+TOKEN = "123456:LOADTEST"
+OWNER_ID = 1
+USER_BASE = 100000
+BOT_USER = {"id": 42, "is_bot": True, "first_name": "LoadBot", "username": "load_bot"}
+class FakeBotAPI:
+    def __init__(self):
+        self.updates = []  # (update_id, update) - bot hali tasdiqlamaganlar
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.new_update = asyncio.Event()
+        self.calls = Counter()
+        self.call_times = []
+        self.inbox = defaultdict(asyncio.Queue)  # chat_id -> (vaqt, metod, parametrlar)
+        self.callbacks = {}  # callback_query_id -> chat_id (answerCallbackQuery'da chat_id yo'q)
+        self.polling = asyncio.Event()
+        self.injected = 0
+    def push(self, kind: str, payload: dict) -> float:
+        update_id = next(self.update_ids)
+        self.updates.append((update_id, {"update_id": update_id, kind: payload}))
+        self.injected += 1
+        self.new_update.set()
+        return time.perf_counter()
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if method == "getUpdates":
+            self.polling.set()
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        self.calls[method] += 1
+        self.call_times.append(time.perf_counter())
+        chat_id = params.get("chat_id") or self.callbacks.pop(params.get("callback_query_id"), None)
+        if chat_id is not None and str(chat_id).lstrip("-").isdigit():
+            self.inbox[int(chat_id)].put_nowait((time.perf_counter(), method, params))
+        return web.json_response({"ok": True, "result": self._result(method.lower(), params)})
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset", 0))
+        self.updates = [u for u in self.updates if u[0] >= offset]
+        if not self.updates and float(params.get("timeout", 0)):
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return [update for _, update in self.updates[:100]]
+    def _message(self, params: dict) -> dict:
+        return {
+            "message_id": int(params.get("message_id") or next(self.message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text") or params.get("caption") or "",
+        }
+    def _result(self, method: str, params: dict):
+        if method == "getme":
+            return BOT_USER
+        if method == "getchatmember":
+            return {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "U"}}
+        if method == "getchat":
+            return {"id": int(params["chat_id"]), "type": "private", "first_name": f"User {params['chat_id']}"}
+        if method == "getfile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_size": 1024, "file_path": f"photos/{params['file_id']}.jpg"}
+        if method == "copymessage":
+            return {"message_id": next(self.message_ids)}
+        if method == "sendmediagroup":
+            return [self._message(params) for _ in json.loads(params["media"])]
+        if method.startswith("editmessage"):
+            return self._message(params) if "chat_id" in params else True
+        if method.startswith("send") and method != "sendchataction":
+            return self._message(params)
+        return True
+def buttons(params: dict) -> list:
+    markup = params.get("reply_markup")
+    if not markup:
+        return []
+    return [b.get("callback_data", "") for row in json.loads(markup).get("inline_keyboard", []) for b in row]
+def has_button(prefix: str):
+    return lambda method, params: any(data.startswith(prefix) for data in buttons(params))
+def text_has(fragment: str):
+    return lambda method, params: fragment in (params.get("text") or params.get("caption") or "")
+def is_method(name: str):
+    return lambda method, params: method == name
+class VirtualUser:
+    def __init__(self, api: FakeBotAPI, user_id: int, stats: dict, think: float, timeout: float):
+        self.api, self.id, self.stats, self.think, self.timeout = api, user_id, stats, think, timeout
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "username": f"load{user_id}"}
+        self.chat = {"id": user_id, "type": "private", "first_name": f"Load{user_id}"}
+        self.screen_id = 1  # inline tugmalari bor oxirgi bot xabari
+        self.message_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+    async def expect(self, step: str, sent_at: float, predicate) -> dict:
+        inbox = self.api.inbox[self.id]
+        while True:
+            remaining = sent_at + self.timeout - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(step)
+            at, method, params = await asyncio.wait_for(inbox.get(), remaining)
+            if buttons(params) and params.get("message_id"):
+                self.screen_id = int(params["message_id"])
+            if at < sent_at:
+                continue  # oldingi qadamdan qolgan javob
+            if predicate(method, params):
+                self.stats[step].append(at - sent_at)
+                return params
+    def push_message(self, **content) -> float:
+        message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": self.chat, "from": self.user, **content}
+        return self.api.push("message", message)
+    async def send(self, step: str, predicate, **content) -> dict:
+        await asyncio.sleep(self.think)
+        return await self.expect(step, self.push_message(**content), predicate)
+    async def press(self, step: str, data: str, predicate) -> dict:
+        await asyncio.sleep(self.think)
+        callback_id = f"{self.id}:{next(self.callback_ids)}"
+        self.api.callbacks[callback_id] = self.id
+        sent = self.api.push("callback_query", {
+            "id": callback_id, "from": self.user, "chat_instance": str(self.id), "data": data,
+            "message": {"message_id": self.screen_id, "date": int(time.time()), "chat": self.chat, "text": "..."},
+        })
+        return await self.expect(step, sent, predicate)
+    async def order_flow(self, files: int, admin: "VirtualUser", admin_lock: asyncio.Lock):
+        params = await self.send("start", has_button("cp:"), text="/start")
+        a, op, b = re.search(r"(\d+) (\S) (\d+) = \?", params["text"]).groups()
+        answer = {"+": int(a) + int(b), "-": int(a) - int(b)}.get(op, int(a) * int(b))
+        # javob raqamli klaviaturada teriladi: har bir raqam tugmasi klaviaturani yangilaydi
+        for typed in itertools.accumulate(str(answer)):
+            params = await self.press("captcha_raqam", next(d for d in buttons(params) if d.startswith(f"cp:d:{typed}:")), has_button(f"cp:ok:{typed}:"))
+        await self.press("captcha", next(d for d in buttons(params) if d.startswith("cp:ok:")), has_button("buyurtma"))
+        await self.press("profil", "profil", has_button("profil_consent_yes"))
+        await self.press("profil_consent", "profil_consent_yes", text_has("1/3"))
+        await self.send("profil_ism", text_has("2/3"), text=f"Load User {self.id}")
+        await self.send("profil_telefon", text_has("3/3"), text="+998901234567")
+        await self.send("profil_hudud", has_button("profil_confirm_yes"), text="Chilonzor tumani")
+        await self.press("profil_saqlash", "profil_confirm_yes", has_button("buyurtma"))
+        await self.press("buyurtma", "buyurtma", has_button("mah_sel_"))
+        await self.press("mahalla", f"mah_sel_{self.id % 10}", text_has("2/5"))
+        await self.send("buyurtma_malumot", has_button("bop_"), text="Chiroyli raqam kerak, iloji bo'lsa tezroq")
+        await self.press("operator", "bop_Ucell", has_button("file_yes"))
+        if files:
+            await self.press("fayl_ha", "file_yes", text_has("Fayl yuklash"))
+            await asyncio.sleep(self.think)
+            group = f"album{self.id}"
+            sent = [self.push_message(media_group_id=group, photo=[{"file_id": f"p{self.id}_{i}", "file_unique_id": f"p{self.id}_{i}", "width": 800, "height": 600}])
+                    for i in range(files)]
+            await self.expect("fayllar", sent[0], has_button("file_done"))
+            await self.press("fayl_tugadi", "file_done", text_has("Joylashuv"))
+        else:
+            await self.press("fayl_yoq", "file_no", text_has("Joylashuv"))
+        await self.send("joylashuv", has_button("confirm_yes"), location={"latitude": 41.31, "longitude": 69.24})
+        await self.press("tasdiqlash", "confirm_yes", text_has("muvaffaqiyatli"))
+        # bitta operator: admin amallari navbat bilan bajariladi
+        async with admin_lock:
+            await admin.press("admin_chat_ochish", f"ua:chat:{self.id}", text_has(str(self.id)))
+            sent = admin.push_message(text=f"Assalomu alaykum, buyurtmangiz qabul qilindi ({self.id})")
+            await self.expect("admin_javobi", sent, is_method("copyMessage"))
+            await admin.press("admin_chat_yopish", f"ua:exit:{self.id}", text_has(str(self.id)))
+async def broadcast(admin: VirtualUser, text: str):
+    await admin.press("broadcast_boshlash", "admin_broadcast", text_has("e'lon"))
+    await admin.send("broadcast", text_has("E'lon yuborildi"), text=text)
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+def report(stats: dict, api: FakeBotAPI, elapsed: float, failures: Counter):
+    print(f"\n{'qadam':<20} {'n':>5} {'p50, ms':>9} {'p99, ms':>9} {'max, ms':>9}")
+    every = []
+    for step, values in stats.items():
+        every += values
+        print(f"{step:<20} {len(values):>5} {percentile(values, 0.5) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f} {max(values) * 1000:>9.1f}")
+    if every:
+        print(f"{'JAMI':<20} {len(every):>5} {percentile(every, 0.5) * 1000:>9.1f} {percentile(every, 0.99) * 1000:>9.1f} {max(every) * 1000:>9.1f}")
+    calls = sum(api.calls.values())
+    print(f"\nvaqt: {elapsed:.1f} s, yangilanishlar: {api.injected} ({api.injected / elapsed:.1f}/s), Bot API so'rovlari: {calls} ({calls / elapsed:.1f}/s)")
+    print("so'rovlar:", ", ".join(f"{method}={n}" for method, n in api.calls.most_common()))
+    if failures:
+        print("xatolar:", ", ".join(f"{step}={n}" for step, n in failures.most_common()))
+async def run(args):
+    api = FakeBotAPI()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": TOKEN, "TELEGRAM_API_URL": f"http://127.0.0.1:{args.port}",
+        "REQUIRED_CHANNEL": "@loadtest", "ADMIN_ID": str(OWNER_ID), "ADMIN_IDS": "", "VIRUSTOTAL_API_KEY": "",
+        "METRICS_PORT": "0", "ADMIN_DIGEST_INTERVAL": "0", "WORK_SCHEDULE": "0-6=00:00-24:00", "WORK_HOLIDAYS": "",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("MEDIA_GROUP_WINDOW", "0.3")
+    # flood nazorati virtual foydalanuvchilarni to'smasligi uchun
+    os.environ.setdefault("THROTTLE_RATE", "50")
+    os.environ.setdefault("THROTTLE_BURST", "100")
+    if not args.paced:
+        # Telegram tezlik cheklovlarisiz: botning o'z ishlov berish tezligi o'lchanadi
+        os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "100000")
+        os.environ.setdefault("OUTBOUND_PER_CHAT_INTERVAL", "0")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="loadtest_"))  # baza va bot.log vaqtinchalik katalogda
+    import main as bot_main
+    bot_task = asyncio.create_task(bot_main.main())
+    await asyncio.wait_for(api.polling.wait(), 30)
+    stats, failures = defaultdict(list), Counter()
+    admin = VirtualUser(api, OWNER_ID, stats, 0, args.timeout)
+    admin_lock = asyncio.Lock()
+    async def one_user(i: int):
+        user = VirtualUser(api, USER_BASE + i, stats, args.think, args.timeout)
+        try:
+            await user.order_flow(args.files, admin, admin_lock)
+        except (TimeoutError, asyncio.TimeoutError) as e:
+            failures[str(e) or "timeout"] += 1
+    start = time.perf_counter()
+    tasks = []
+    for i in range(args.users):
+        tasks.append(asyncio.create_task(one_user(i)))
+        await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*tasks)
+    for n in range(args.broadcasts):
+        try:
+            await broadcast(admin, f"Yuklama testi e'loni #{n + 1}")
+        except (TimeoutError, asyncio.TimeoutError):
+            failures["broadcast"] += 1
+    elapsed = time.perf_counter() - start
+    await bot_main.dp.stop_polling()
+    await bot_task
+    await bot_main.bot.session.close()
+    await runner.cleanup()
+    report(stats, api, elapsed, failures)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Soxta Bot API server bilan oflayn yuklama testi")
+    parser.add_argument("--users", type=int, default=20, help="virtual foydalanuvchilar soni")
+    parser.add_argument("--rate", type=float, default=5, help="sekundiga yangi foydalanuvchilar")
+    parser.add_argument("--think", type=float, default=0.1, help="qadamlar orasidagi o'ylash vaqti, sekund")
+    parser.add_argument("--files", type=int, default=2, help="buyurtmaga biriktiriladigan rasmlar (albom)")
+    parser.add_argument("--broadcasts", type=int, default=1, help="oxirida yuboriladigan e'lonlar soni")
+    parser.add_argument("--timeout", type=float, default=30, help="bitta qadam uchun javob kutish, sekund")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--paced", action="store_true", help="main.py dagi chiquvchi xabar tezlik cheklovlarini saqlash")
+    asyncio.run(run(parser.parse_args()))
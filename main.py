@@ -1,11 +1,26 @@
 import sqlite3
 import asyncio
+import atexit
+import contextvars
+import copy
+import hashlib
+import hmac
+import html
+import heapq
+import itertools
 import logging
+import logging.handlers
 import os
+import operator
+import difflib
 import random
 import re
-from datetime import datetime
+import queue
+from datetime import datetime, timedelta
+from functools import lru_cache
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field, replace
 from pathlib import Path
 import pytz
 import json
@@ -13,10 +28,18 @@ import time
 import aiohttp
 import aiogram.exceptions
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, F, types
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router, types
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.enums import ParseMode
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, Filter, StateFilter
+from aiogram.dispatcher.event.bases import UNHANDLED, SkipHandler
+from aiogram.dispatcher.event.telegram import TelegramEventObserver
+from aiogram.filters.callback_data import CallbackData, CallbackQueryFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -30,26 +53,260 @@ BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("TELEGRAM_BOT_TOKEN .env faylida topilmadi")
 REQUIRED_CHANNEL = os.getenv("REQUIRED_CHANNEL")
-ADMIN_ID = int(os.getenv("ADMIN_ID", "5435595297"))
+ADMIN_ID = int(os.getenv("ADMIN_ID", "5435595297"))  # bot egasi (owner)
+ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x]  # qo'shimcha operatorlar
 VIRUSTOTAL_API_KEY = os.getenv("VIRUSTOTAL_API_KEY")
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log", encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # boshqa Bot API server (masalan, loadtest.py dagi soxta server)
+CAPTCHA_SECRET = hashlib.sha256((os.getenv("CAPTCHA_SECRET") or BOT_TOKEN).encode()).digest()  # captcha tokenlarini imzolash kaliti
+# Loglash navbat orqali: event loop faqat yozuvni navbatga qo'yadi, diskka/konsolga yozish QueueListener oqimida.
+# bot.log - JSON qatorlar (aylanma fayl), konsol - oddiy matn.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+ACCESS_LOG_SAMPLE = float(os.getenv("ACCESS_LOG_SAMPLE", "0.1"))  # oddiy yangilanishlarning qancha qismi loglanadi
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1000"))  # bundan sekin yangilanishlar har doim loglanadi
+log_context = contextvars.ContextVar("log_context", default=None)  # joriy yangilanish: update_id, chat_id, handler
+LOG_CONTEXT_FIELDS = ("update_id", "chat_id", "handler", "latency_ms")
+class LogContextFilter(logging.Filter):
+    # QueueHandler'da (event loop oqimida) ishlaydi, shuning uchun joriy yangilanish konteksti yozuvga ko'chiriladi
+    def filter(self, record):
+        ctx = log_context.get()
+        if ctx:
+            for key, value in ctx.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+class AccessSampleFilter(logging.Filter):
+    """bot.access yozuvlaridan faqat namunasi o'tadi; sekin yoki xato bilan tugaganlari har doim o'tadi."""
+    def filter(self, record):
+        ctx = log_context.get() or {}
+        if record.levelno > logging.INFO or ctx.get("latency_ms", 0) >= SLOW_UPDATE_MS:
+            return True
+        return random.random() < ACCESS_LOG_SAMPLE
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in LOG_CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Standart QueueHandler.prepare() yozuvni event loop oqimida formatlaydi (traceback msg ga qo'shiladi, exc_info
+    tozalanadi). Bu yerda yozuv nusxasi o'zgarishsiz navbatga qo'yiladi: msg % args va traceback listener oqimida
+    formatlanadi, JsonFormatter esa exc maydonini alohida yoza oladi.
+    """
+    def prepare(self, record):
+        return copy.copy(record)
+def setup_logging() -> logging.handlers.QueueListener:
+    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    logging.getLogger("bot.access").addFilter(AccessSampleFilter())
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # navbatda qolgan yozuvlar chiqishda diskka yoziladi
+    return listener
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
-# ----------------- Ma'lumotlar bazasi -----------------
-DB_FILE = 'bot_database.db'
+access_logger = logging.getLogger("bot.access")
+# ----------------- Metrikalar (Prometheus) -----------------
+# Tashqi kutubxonasiz oddiy hisoblagich/gistogramma; /metrics Prometheus matn formatida beriladi.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 - o'chirilgan
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = []
+def _label_str(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join('{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values))
+    return "{" + pairs + "}"
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values = {}
+        METRICS.append(self)
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} counter"
+        for key, value in self.values.items():
+            yield f"{self.name}{_label_str(self.labels, key)} {value}"
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.values = {}  # label_values -> [bucket hisoblagichlari..., sum, count]
+        METRICS.append(self)
+    def observe(self, value: float, *label_values):
+        state = self.values.get(label_values)
+        if state is None:
+            state = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} histogram"
+        for key, state in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, state):
+                cumulative += n
+                yield f"{self.name}_bucket{_label_str(self.labels + ('le',), key + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{_label_str(self.labels + ('le',), key + ('+Inf',))} {state[-1]}"
+            yield f"{self.name}_sum{_label_str(self.labels, key)} {state[-2]}"
+            yield f"{self.name}_count{_label_str(self.labels, key)} {state[-1]}"
+class Gauge:
+    # qiymat skrep vaqtida funksiyadan olinadi (navbat uzunliklari va h.k.)
+    def __init__(self, name: str, help_text: str, func):
+        self.name, self.help, self.func = name, help_text, func
+        METRICS.append(self)
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} gauge"
+        try:
+            yield f"{self.name} {self.func()}"
+        except Exception as e:
+            logger.debug("Gauge %s o'qilmadi: %s", self.name, e)
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+UPDATES_TOTAL = Counter("bot_updates_total", "Qabul qilingan yangilanishlar", ("type",))
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Ishlovchi bajarilish vaqti", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Ishlovchida ko'tarilgan xatolar", ("handler", "error"))
+DB_SECONDS = Histogram("bot_db_connection_seconds", "Bitta get_db_conn bloki davomiyligi")
+DB_QUERIES = Counter("bot_db_queries_total", "SQLite so'rovlari", ("op",))
+API_SECONDS = Histogram("bot_telegram_api_seconds", "Telegram Bot API so'rovi vaqti", ("method",))
+API_ERRORS = Counter("bot_telegram_api_errors_total", "Telegram Bot API xatolari", ("method", "error"))
+VT_SECONDS = Histogram("bot_virustotal_scan_seconds", "VirusTotal tekshiruvi vaqti", ("result",), buckets=(1, 5, 10, 20, 30, 60, 90, 120, 180))
+# ----------------- Sekin yangilanishlar va event loop kechikishi -----------------
+# Har bir yangilanish uchun Trace: middleware -> filtrlar -> ishlovchi -> DB / Bot API / VirusTotal oraliqlari.
+# Yangilanish SLOW_UPDATE_MS dan uzoq davom etsa oraliqlar daraxti logga yoziladi va /slow statistikasiga qo'shiladi.
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "200"))
+LOOP_LAG = Histogram("bot_event_loop_lag_seconds", "Event loop kechikishi", buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+# bitta yangilanishda yoziladigan oraliqlar chegarasi (masalan, broadcast har bir foydalanuvchi uchun API chaqiradi):
+# birinchi TRACE_MAX_SPANS tasi saqlanadi, qolganlari faqat sanaladi
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "50"))
+current_trace = contextvars.ContextVar("current_trace", default=None)
+# chuqurlik kontekstda saqlanadi: gather qilingan korutinlar har biri o'z nusxasini oladi va bir-birini buzmaydi
+_span_depth = contextvars.ContextVar("span_depth", default=0)
+class Trace:
+    __slots__ = ("name", "start", "spans", "dropped", "closed")
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []  # [nom, boshlanish, tugash, chuqurlik]
+        self.dropped = 0
+        self.closed = False
+    def format(self) -> str:
+        now = time.perf_counter()
+        lines = [f"{self.name} {(now - self.start) * 1000:.1f}ms"]
+        for name, start, end, depth in self.spans:
+            duration = ((end or now) - start) * 1000
+            lines.append(f"{'  ' * depth}{name} +{(start - self.start) * 1000:.1f}ms {duration:.1f}ms")
+        if self.dropped:
+            lines.append(f"... yana {self.dropped} ta oraliq")
+        return "\n".join(lines)
+_active_traces = set()
+slow_traces = deque(maxlen=20)
+slow_stats = {}  # handler -> [sekin yangilanishlar soni, jami ms, eng ko'p ms]
+loop_lag_recent = deque(maxlen=600)  # (vaqt, kechikish ms) - so'nggi ~5 daqiqa
 @contextmanager
-def get_db_conn():
-    conn = sqlite3.connect(DB_FILE)
+def trace_span(name: str):
+    trace = current_trace.get()
+    if trace is None or trace.closed:
+        # yangilanishdan tashqarida yoki yangilanish tugagach (fon vazifalari) hech narsa yozilmaydi
+        yield None
+        return
+    if len(trace.spans) >= TRACE_MAX_SPANS:
+        trace.dropped += 1
+        yield None
+        return
+    depth = _span_depth.get() + 1
+    depth_token = _span_depth.set(depth)
+    span = [name, time.perf_counter(), None, depth]
+    trace.spans.append(span)
     try:
-        yield conn
+        yield span
     finally:
-        conn.close()
+        span[2] = time.perf_counter()
+        _span_depth.reset(depth_token)
+def record_slow_update(trace: Trace, handler: str, latency_ms: float):
+    stats = slow_stats.setdefault(handler, [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += latency_ms
+    stats[2] = max(stats[2], latency_ms)
+    slow_traces.append((time.time(), handler, latency_ms, trace.format()))
+    logger.warning("Sekin yangilanish (%s, %.0f ms):\n%s", handler, latency_ms, trace.format())
+async def loop_lag_monitor():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - start - LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(lag)
+        loop_lag_recent.append((time.time(), lag * 1000))
+        if lag * 1000 >= LOOP_LAG_WARN_MS:
+            running = ", ".join(sorted(trace.name for trace in _active_traces)) or "-"
+            logger.warning(f"Event loop {lag * 1000:.0f} ms bloklandi; ishlayotgan yangilanishlar: {running}")
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # port band (ikkinchi nusxa yoki boshqa exporter) - bot metrikalarsiz ishlashda davom etadi
+        logger.error(f"Metrikalar serveri ishga tushmadi ({METRICS_HOST}:{METRICS_PORT}): {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Metrikalar: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+# ----------------- Ma'lumotlar bazasi -----------------
+DB_FILE = os.getenv("DB_FILE", 'bot_database.db')
+PROFILE_FIELDS = ("ism_familya", "telefon", "tuman_mahalla")
+def _count_db_query(statement: str):
+    DB_QUERIES.inc(statement.lstrip().split(None, 1)[0].upper())
+@contextmanager
+def get_db_conn():
+    start = time.perf_counter()
+    with trace_span("db") as span:
+        conn = sqlite3.connect(DB_FILE)
+        if span is None:
+            conn.set_trace_callback(_count_db_query)
+        else:
+            def on_query(statement: str):
+                _count_db_query(statement)
+                # oraliq nomi birinchi ma'noli so'rov bilan to'ldiriladi (BEGIN/COMMIT hisobga olinmaydi);
+                # qiymatlar logga tushmasligi uchun WHERE/VALUES/SET dan keyingi qism kesiladi
+                if span[0] == "db" and not statement.startswith(("BEGIN", "COMMIT")):
+                    span[0] = "db: " + re.split(r"\s(?:WHERE|VALUES|SET)\b", " ".join(statement.split()), maxsplit=1)[0][:80]
+            conn.set_trace_callback(on_query)
+        try:
+            yield conn
+        finally:
+            conn.close()
+            DB_SECONDS.observe(time.perf_counter() - start)
 def create_db():
     with get_db_conn() as conn:
         cursor = conn.cursor()
@@ -59,7 +316,10 @@ def create_db():
                 last_active REAL,
                 profile TEXT,
                 banned INTEGER DEFAULT 0,
-                in_chat_with_admin INTEGER DEFAULT 0
+                in_chat_with_admin INTEGER DEFAULT 0,
+                ism_familya TEXT,
+                telefon TEXT,
+                tuman_mahalla TEXT
             )
         """)
         cursor.execute("""
@@ -86,6 +346,58 @@ def create_db():
                 timestamp REAL
             )
         """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS admins (
+                admin_id INTEGER PRIMARY KEY,
+                name TEXT,
+                role TEXT DEFAULT 'operator',
+                online INTEGER DEFAULT 1,
+                last_seen REAL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS assignments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER,
+                chat_id INTEGER,
+                kind TEXT,
+                status TEXT DEFAULT 'open',
+                created REAL,
+                closed REAL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_assignments_open ON assignments (status, chat_id)")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS deferred_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                kind TEXT,
+                payload TEXT,
+                created REAL,
+                attempts INTEGER DEFAULT 0,
+                next_try REAL DEFAULT 0,
+                UNIQUE (chat_id, kind, payload)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                chat_id INTEGER,
+                created REAL,
+                result TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created)")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER,
+                user_id INTEGER,
+                opened REAL,
+                closed REAL,
+                last_message REAL
+            )
+        """)
         conn.commit()
 def migrate_db():
     with get_db_conn() as conn:
@@ -130,8 +442,129 @@ def migrate_db():
         columns = [row[1] for row in cursor.fetchall()]
         if 'in_chat_with_admin' not in columns:
             cursor.execute("ALTER TABLE chats ADD COLUMN in_chat_with_admin INTEGER DEFAULT 0")
+        if 'verified_until' not in columns:
+            cursor.execute("ALTER TABLE chats ADD COLUMN verified_until REAL DEFAULT 0")
+        if 'banned_until' not in columns:
+            cursor.execute("ALTER TABLE chats ADD COLUMN banned_until REAL DEFAULT 0")
+        cursor.execute("PRAGMA table_info(idempotency_keys)")
+        if 'result' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE idempotency_keys ADD COLUMN result TEXT")
+        # kechiktirilgan so'rovlar: yetkazilmaganlari qayta urinish uchun saqlanadi
+        cursor.execute("PRAGMA table_info(deferred_requests)")
+        deferred_columns = [row[1] for row in cursor.fetchall()]
+        if 'attempts' not in deferred_columns:
+            cursor.execute("ALTER TABLE deferred_requests ADD COLUMN attempts INTEGER DEFAULT 0")
+        if 'next_try' not in deferred_columns:
+            cursor.execute("ALTER TABLE deferred_requests ADD COLUMN next_try REAL DEFAULT 0")
+        # profil JSON matnidan alohida ustunlarga o'tish (eski yozuvlar bir marta ko'chiriladi)
+        for col in PROFILE_FIELDS:
+            if col not in columns:
+                cursor.execute(f"ALTER TABLE chats ADD COLUMN {col} TEXT")
+        cursor.execute("SELECT chat_id, profile FROM chats WHERE profile IS NOT NULL AND ism_familya IS NULL")
+        for chat_id, profile_json in cursor.fetchall():
+            try:
+                prof = json.loads(profile_json)
+            except json.JSONDecodeError:
+                logger.error(f"Invalid JSON in profile for chat_id {chat_id}")
+                continue
+            if not isinstance(prof, dict):
+                logger.warning(f"Profile for chat_id {chat_id} is not an object, skipped")
+                continue
+            # eski profile ustuni o'chirilmaydi: oldingi versiyaga qaytilganda profillar saqlanib qoladi
+            cursor.execute("""
+                UPDATE chats SET ism_familya = ?, telefon = ?, tuman_mahalla = ?
+                WHERE chat_id = ?
+            """, (*(str(prof.get(col) or "") for col in PROFILE_FIELDS), chat_id))
+        conn.commit()
+# ----------------- Faollik (presence) -----------------
+PRESENCE_WINDOWS = {"5 daqiqa": 300, "1 soat": 3600, "24 soat": 86400, "7 kun": 7 * 86400}
+PRESENCE_ONLINE = "5 daqiqa"
+PRESENCE_FLUSH_INTERVAL = int(os.getenv("PRESENCE_FLUSH_INTERVAL", "30"))  # last_active bazaga yozilish davriyligi (sekund)
+class Presence:
+    """
+    Yaqinda faol bo'lgan chatlar xotirada saqlanadi: har bir oyna uchun vaqt bo'yicha tartiblangan
+    OrderedDict (eng eskisi boshida). touch O(1), eskirganlar boshidan bosqichma-bosqich olib tashlanadi,
+    oynadagi faollar soni esa len(). last_active bazaga davriy ravishda bitta executemany bilan yoziladi.
+    """
+    def __init__(self, windows: dict):
+        self.windows = windows
+        self._recent = {label: OrderedDict() for label in windows}
+        self.known = set()  # chats jadvalida qatori bor chat_id lar
+        self._dirty = {}
+    def load(self):
+        horizon = time.time() - max(self.windows.values())
+        with get_db_conn() as conn:
+            rows = conn.execute("SELECT chat_id, last_active FROM chats ORDER BY last_active").fetchall()
+        for chat_id, last_active in rows:
+            self.known.add(chat_id)
+            if last_active and last_active > horizon:
+                self._mark(chat_id, last_active)
+        self.expire()
+    def _mark(self, chat_id: int, ts: float):
+        for recent in self._recent.values():
+            recent[chat_id] = ts
+            recent.move_to_end(chat_id)
+    def touch(self, chat_id: int):
+        now = time.time()
+        self._mark(chat_id, now)
+        self._dirty[chat_id] = now
+    def _expire_window(self, label: str, now: float):
+        recent, cutoff = self._recent[label], now - self.windows[label]
+        while recent and next(iter(recent.values())) < cutoff:
+            recent.popitem(last=False)
+    def expire(self):
+        now = time.time()
+        for label in self.windows:
+            self._expire_window(label, now)
+    def count(self, label: str = PRESENCE_ONLINE) -> int:
+        self._expire_window(label, time.time())
+        return len(self._recent[label])
+    def counts(self) -> dict:
+        return {label: self.count(label) for label in self.windows}
+    def is_online(self, chat_id: int) -> bool:
+        self._expire_window(PRESENCE_ONLINE, time.time())
+        return chat_id in self._recent[PRESENCE_ONLINE]
+    def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            with get_db_conn() as conn:
+                conn.executemany("UPDATE chats SET last_active = ? WHERE chat_id = ?", [(ts, cid) for cid, ts in dirty.items()])
+                conn.commit()
+        except sqlite3.Error:
+            # yozilmagan qiymatlar keyingi flush uchun qaytariladi (oraliqda yangilanganlari ustun)
+            for cid, ts in dirty.items():
+                self._dirty.setdefault(cid, ts)
+            raise
+presence = Presence(PRESENCE_WINDOWS)
+async def presence_flush_loop():
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+        presence.expire()
+        try:
+            presence.flush()
+        except sqlite3.Error as e:
+            logger.error(f"last_active yozilmadi: {e}")
+# ----------------- Inson tekshiruvi (tasdiqlanganlar) -----------------
+CAPTCHA_VERIFY_DAYS = float(os.getenv("CAPTCHA_VERIFY_DAYS", "30"))  # captcha qayta so'ralguncha o'tadigan muddat
+_verified_until = {}  # chat_id -> verified_until (bazadagi ustunning xotiradagi nusxasi)
+def load_verified():
+    with get_db_conn() as conn:
+        rows = conn.execute("SELECT chat_id, verified_until FROM chats WHERE verified_until > ?", (time.time(),)).fetchall()
+    _verified_until.update(rows)
+def is_verified(chat_id: int) -> bool:
+    return _verified_until.get(chat_id, 0) > time.time()
+def mark_verified(chat_id: int):
+    until = time.time() + CAPTCHA_VERIFY_DAYS * 86400
+    ensure_chat_exists(chat_id)
+    with get_db_conn() as conn:
+        conn.execute("UPDATE chats SET verified_until = ? WHERE chat_id = ?", (until, chat_id))
         conn.commit()
+    _verified_until[chat_id] = until
 def ensure_chat_exists(chat_id: int):
+    if chat_id in presence.known:
+        return
     with get_db_conn() as conn:
         cursor = conn.cursor()
         cursor.execute("""
@@ -139,46 +572,63 @@ def ensure_chat_exists(chat_id: int):
             VALUES (?, ?)
         """, (chat_id, time.time()))
         conn.commit()
+    presence.known.add(chat_id)
 def update_chat_activity(chat_id: int):
-    ensure_chat_exists(chat_id)
-    with get_db_conn() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE chats SET last_active = ?
-            WHERE chat_id = ?
-        """, (time.time(), chat_id))
-        conn.commit()
+    # faollik xotirada belgilanadi, bazaga presence_flush_loop yozadi
+    ensure_chat_exists(chat_id)
+    presence.touch(chat_id)
+@dataclass(frozen=True)
+class Profile:
+    ism_familya: str = ""
+    telefon: str = ""
+    tuman_mahalla: str = ""
+    admin_summary: str = field(init=False, repr=False, compare=False)  # adminga yuboriladigan tayyor qator
+    def __post_init__(self):
+        object.__setattr__(self, 'admin_summary', f"\n👤 Ism: {self.ism_familya} | 📞 Telefon: {self.telefon} | 🏙️ Tuman/Mahalla: {self.tuman_mahalla}")
+    @classmethod
+    def from_row(cls, row):
+        """(ism_familya, telefon, tuman_mahalla) qatoridan; profil bo'lmasa None."""
+        if not row or not any(row):
+            return None
+        return cls(*(value or "" for value in row))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "2048"))
+_profile_cache = OrderedDict()  # chat_id -> Profile | None (LRU)
 def get_chat_profile(chat_id: int):
-    ensure_chat_exists(chat_id)
+    if chat_id in _profile_cache:
+        _profile_cache.move_to_end(chat_id)
+        return _profile_cache[chat_id]
     with get_db_conn() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT profile FROM chats WHERE chat_id = ?", (chat_id,))
-        row = cursor.fetchone()
-        if row and row[0]:
-            try:
-                return json.loads(row[0])
-            except json.JSONDecodeError:
-                logger.error(f"Invalid JSON in profile for chat_id {chat_id}")
-    return None
-def set_chat_profile(chat_id: int, profile: dict):
+        cursor.execute(f"SELECT {', '.join(PROFILE_FIELDS)} FROM chats WHERE chat_id = ?", (chat_id,))
+        profile = Profile.from_row(cursor.fetchone())
+    cache_profile(chat_id, profile)
+    return profile
+def cache_profile(chat_id: int, profile):
+    _profile_cache[chat_id] = profile
+    _profile_cache.move_to_end(chat_id)
+    if len(_profile_cache) > PROFILE_CACHE_SIZE:
+        _profile_cache.popitem(last=False)
+def set_chat_profile(chat_id: int, profile: Profile):
     ensure_chat_exists(chat_id)
     with get_db_conn() as conn:
         cursor = conn.cursor()
-        profile_json = json.dumps(profile)
         cursor.execute("""
-            UPDATE chats SET profile = ?, last_active = ?
+            UPDATE chats SET ism_familya = ?, telefon = ?, tuman_mahalla = ?, profile = ?, last_active = ?
             WHERE chat_id = ?
-        """, (profile_json, time.time(), chat_id))
+        """, (profile.ism_familya, profile.telefon, profile.tuman_mahalla,
+              json.dumps({col: getattr(profile, col) for col in PROFILE_FIELDS}), time.time(), chat_id))
         conn.commit()
+    _profile_cache.pop(chat_id, None)
 def delete_chat_profile(chat_id: int):
     ensure_chat_exists(chat_id)
     with get_db_conn() as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            UPDATE chats SET profile = NULL, last_active = ?
+            UPDATE chats SET ism_familya = NULL, telefon = NULL, tuman_mahalla = NULL, profile = NULL, last_active = ?
             WHERE chat_id = ?
         """, (time.time(), chat_id))
         conn.commit()
+    _profile_cache.pop(chat_id, None)
 def is_banned(chat_id: int) -> bool:
     ensure_chat_exists(chat_id)
     with get_db_conn() as conn:
@@ -186,15 +636,25 @@ def is_banned(chat_id: int) -> bool:
         cursor.execute("SELECT banned FROM chats WHERE chat_id = ?", (chat_id,))
         row = cursor.fetchone()
         return row and row[0] == 1 if row else False
-def set_banned(chat_id: int, banned: bool):
+def set_banned(chat_id: int, banned: bool, until: float = 0):
+    # until > 0 bo'lsa vaqtinchalik ban: throttle_housekeeping_loop muddati o'tganda blokdan chiqaradi
     ensure_chat_exists(chat_id)
     with get_db_conn() as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            UPDATE chats SET banned = ?, last_active = ?
+            UPDATE chats SET banned = ?, banned_until = ?, last_active = ?
             WHERE chat_id = ?
-        """, (1 if banned else 0, time.time(), chat_id))
+        """, (1 if banned else 0, until if banned else 0, time.time(), chat_id))
+        conn.commit()
+def lift_expired_bans() -> list:
+    now = time.time()
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT chat_id FROM chats WHERE banned = 1 AND banned_until > 0 AND banned_until <= ?", (now,))
+        lifted = [row[0] for row in cursor.fetchall()]
+        cursor.execute("UPDATE chats SET banned = 0, banned_until = 0 WHERE banned = 1 AND banned_until > 0 AND banned_until <= ?", (now,))
         conn.commit()
+    return lifted
 def set_in_chat(chat_id: int, value: bool):
     ensure_chat_exists(chat_id)
     with get_db_conn() as conn:
@@ -205,12 +665,8 @@ def set_in_chat(chat_id: int, value: bool):
         """, (1 if value else 0, time.time(), chat_id))
         conn.commit()
 def is_in_chat(chat_id: int) -> bool:
-    ensure_chat_exists(chat_id)
-    with get_db_conn() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT in_chat_with_admin FROM chats WHERE chat_id = ?", (chat_id,))
-        row = cursor.fetchone()
-        return row and row[0] == 1 if row else False
+    # ochiq sessiyalar xotirada indekslangan (sessions_by_user), bazaga murojaat kerak emas
+    return chat_id in sessions_by_user
 def get_total_chats():
     with get_db_conn() as conn:
         cursor = conn.cursor()
@@ -287,56 +743,59 @@ def get_service_stats():
                 except json.JSONDecodeError:
                     pass
         return stats
-async def get_all_users_with_names():
+USER_STATUS_LIMIT = 50  # get_users_status qaytaradigan ism ro'yxatlarining yuqori chegarasi
+def get_all_users_with_names(page: int = 0, per_page: int = 20, banned_only: bool = False):
+    """
+    Bitta so'rov bilan sahifadagi foydalanuvchilar, ularning profillari va jami soni: (users, total).
+    O'qilgan profillar keshga ham yoziladi, shuning uchun keyingi get_chat_profile bazaga murojaat qilmaydi.
+    """
+    where = "WHERE banned = 1" if banned_only else ""
     with get_db_conn() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT chat_id, profile FROM chats ORDER BY last_active DESC LIMIT 20
-        """)
+        cursor.execute(f"""
+            SELECT chat_id, {', '.join(PROFILE_FIELDS)}, COUNT(*) OVER () FROM chats {where}
+            ORDER BY last_active DESC LIMIT ? OFFSET ?
+        """, (per_page, page * per_page))
         rows = cursor.fetchall()
-        chat_ids = [row[0] for row in rows]
+    if not rows and page:
+        # sahifa oxiridan tashqarida bo'lsa ham jami sonni qaytaramiz
+        with get_db_conn() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM chats {where}").fetchone()[0]
+        return [], total
     users = []
-    for cid in chat_ids:
-        try:
-            chat = await bot.get_chat(cid)
-            full_name = chat.full_name or f"User {cid}"
-            username = f"@{chat.username}" if chat.username else ""
-            display_name = f"{full_name} {username}".strip()
-            profile = get_chat_profile(cid)
-            users.append({'id': cid, 'name': display_name, 'profile': profile})
-        except Exception as e:
-            logger.error(f"Error getting chat {cid}: {e}")
-            profile = get_chat_profile(cid)
-            users.append({'id': cid, 'name': profile.get('ism_familya', f"User {cid}"), 'profile': profile})
-    return users
-def get_users_status():
-    now = time.time()
+    for cid, *fields, total in rows:
+        profile = Profile.from_row(fields)
+        cache_profile(cid, profile)
+        name = (profile.ism_familya or profile.telefon) if profile else None
+        users.append({'id': cid, 'name': name or f"User {cid}", 'profile': profile})
+    return users, (rows[0][-1] if rows else 0)
+def get_users_status(limit: int = USER_STATUS_LIMIT):
+    """Onlayn (so'nggi 5 daqiqa) va oflayn foydalanuvchilar: ism ro'yxatlari `limit` bilan cheklanadi, sonlar presence'dan."""
+    presence.flush()
+    cutoff = time.time() - PRESENCE_WINDOWS[PRESENCE_ONLINE]
     with get_db_conn() as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT chat_id, profile FROM chats WHERE last_active > ?
-        """, (now - 300,))
-        online_rows = cursor.fetchall()
-        cursor.execute("""
-            SELECT chat_id, profile FROM chats WHERE last_active <= ? AND last_active > 0
-        """, (now - 300,))
-        offline_rows = cursor.fetchall()
-        online = [json.loads(row[1]).get('ism_familya', f"User {row[0]}") if row[1] else f"User {row[0]}" for row in online_rows]
-        offline = [json.loads(row[1]).get('ism_familya', f"User {row[0]}") if row[1] else f"User {row[0]}" for row in offline_rows]
-        return online, offline
+            SELECT chat_id, ism_familya, last_active > ? FROM chats
+            WHERE last_active > 0 ORDER BY last_active DESC LIMIT ?
+        """, (cutoff, limit))
+        rows = cursor.fetchall()
+    online = [name or f"User {cid}" for cid, name, is_online in rows if is_online]
+    offline = [name or f"User {cid}" for cid, name, is_online in rows if not is_online]
+    online_total = presence.count()
+    return online, offline, online_total, len(presence.known) - online_total
 async def broadcast_message(message: types.Message):
     with get_db_conn() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT chat_id FROM chats WHERE banned = 0")
         users = cursor.fetchall()
-    success = 0
-    total = len(users)
-    for user in users:
-        chat_id = user[0]
+    async def deliver(chat_id: int) -> bool:
         try:
             # Try to copy the original message (preserves media, captions, formatting)
             try:
                 await bot.copy_message(chat_id=chat_id, from_chat_id=message.chat.id, message_id=message.message_id)
+            except aiogram.exceptions.TelegramForbiddenError:
+                raise
             except Exception:
                 # Fallback to manual send if copy_message is not permitted for target chat
                 if message.photo:
@@ -347,11 +806,17 @@ async def broadcast_message(message: types.Message):
                     await bot.send_document(chat_id, message.document.file_id, caption=message.caption or '')
                 else:
                     await bot.send_message(chat_id, message.text or "")
-            success += 1
-        except aiogram.exceptions.BotBlocked:
+            return True
+        except aiogram.exceptions.TelegramForbiddenError:
             logger.warning(f"User {chat_id} blocked the bot")
         except Exception as e:
             logger.error(f"Broadcast xato {chat_id}: {e}")
+        return False
+    # tezlik va ustuvorlikni OutboundScheduler boshqaradi, shuning uchun hammasi birdaniga navbatga qo'yiladi
+    with outbound_priority(PRIORITY_BROADCAST):
+        results = await asyncio.gather(*(deliver(user[0]) for user in users))
+    success = sum(results)
+    total = len(users)
     logger.info(f"Broadcast finished: {success}/{total} delivered")
     return success, total
 def save_action(action_data: dict):
@@ -363,22 +828,520 @@ def save_action(action_data: dict):
             VALUES (?, ?, ?, ?)
         """, (action_data['type'], action_data['chat_id'], details_json, time.time()))
         conn.commit()
+# ----------------- Takroriy so'rovlardan himoya (idempotency) -----------------
+# Kalit (chat, oqim, qadam[, xabar]) ko'rinishida. Avval xotiradagi qisqa oyna tekshiriladi (ikki marta bosish),
+# persist=True bo'lsa bazadagi UNIQUE kalit qayta ishga tushgandan keyingi qayta yetkazishni ham to'sadi.
+IDEMPOTENCY_WINDOW = 600
+IDEMPOTENCY_RETENTION = 7 * 86400  # bazadagi kalitlar shuncha vaqt saqlanadi
+_idem_recent = {}  # key -> amal qilish muddati (monotonic)
+def claim_idempotency(key: str, chat_id: int, persist: bool = True, window: float = IDEMPOTENCY_WINDOW) -> bool:
+    """Kalit birinchi marta ko'rilsa True, takror bo'lsa False qaytaradi."""
+    now = time.monotonic()
+    if _idem_recent.get(key, 0) > now:
+        return False
+    if persist:
+        with get_db_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT OR IGNORE INTO idempotency_keys (key, chat_id, created) VALUES (?, ?, ?)", (key, chat_id, time.time()))
+            conn.commit()
+            if cursor.rowcount == 0:
+                _idem_recent[key] = now + window
+                return False
+    _idem_recent[key] = now + window
+    return True
+def release_idempotency(key: str):
+    # ish bajarilmay qolganda (xato, so'rov yopilgan) kalit qayta ishlatilishi uchun bo'shatiladi
+    _idem_recent.pop(key, None)
+    with get_db_conn() as conn:
+        conn.execute("DELETE FROM idempotency_keys WHERE key = ?", (key,))
+        conn.commit()
+# Kalit ostida bajarilgan ish (masalan, saqlangan buyurtma ID) result ustuniga yoziladi. Ish keyinroq xato bilan
+# tugasa kalit bo'shatilmaydi, "retry:" bilan belgilanadi: qayta bosilganda ish shu natijadan davom etadi
+# (buyurtma ikkinchi marta saqlanmaydi, faqat bildirishnoma qayta yuboriladi).
+def record_idempotency(key: str, result: str):
+    with get_db_conn() as conn:
+        conn.execute("UPDATE idempotency_keys SET result = ? WHERE key = ?", (result, key))
+        conn.commit()
+def fail_idempotency(key: str):
+    """Ish xato bilan tugadi: hech narsa saqlanmagan bo'lsa kalit bo'shatiladi, aks holda qayta urinishga belgilanadi."""
+    with get_db_conn() as conn:
+        row = conn.execute("SELECT result FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+    if not row or row[0] is None:
+        release_idempotency(key)
+        return
+    _idem_recent.pop(key, None)
+    if not row[0].startswith("retry:"):
+        record_idempotency(key, f"retry:{row[0]}")
+def resume_idempotency(key: str):
+    """Xato bilan tugagan ishni qayta urinish uchun egallaydi va saqlangan natijani qaytaradi; aks holda None."""
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        row = cursor.execute("SELECT result FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+        if not row or not (row[0] or "").startswith("retry:"):
+            return None
+        result = row[0][len("retry:"):]
+        cursor.execute("UPDATE idempotency_keys SET result = ? WHERE key = ? AND result = ?", (result, key, row[0]))
+        conn.commit()
+        return result if cursor.rowcount else None
+def prune_idempotency():
+    now = time.monotonic()
+    for key, expires in list(_idem_recent.items()):
+        if expires <= now:
+            del _idem_recent[key]
+    with get_db_conn() as conn:
+        conn.execute("DELETE FROM idempotency_keys WHERE created < ?", (time.time() - IDEMPOTENCY_RETENTION,))
+        conn.commit()
+# ----------------- Operatorlar (multi-admin) -----------------
+ROLE_OWNER = "owner"
+ROLE_OPERATOR = "operator"
+ADMINS = {}  # admin_id -> {'name': str, 'role': str, 'online': bool}
+admin_load = {}  # admin_id -> ochiq biriktirishlar soni
+user_operator = {}  # chat_id -> unga biriktirilgan admin_id
+_last_assigned = {}  # admin_id -> oxirgi biriktirish vaqti (teng yuklamada navbat bilan berish uchun)
+def load_admins():
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR IGNORE INTO admins (admin_id, name, role, online, last_seen)
+            VALUES (?, ?, ?, 1, ?)
+        """, (ADMIN_ID, "Owner", ROLE_OWNER, time.time()))
+        cursor.execute("UPDATE admins SET role = CASE WHEN admin_id = ? THEN ? ELSE ? END WHERE role = ? OR admin_id = ?",
+                       (ADMIN_ID, ROLE_OWNER, ROLE_OPERATOR, ROLE_OWNER, ADMIN_ID))
+        for aid in ADMIN_IDS:
+            cursor.execute("""
+                INSERT OR IGNORE INTO admins (admin_id, name, role, online, last_seen)
+                VALUES (?, ?, ?, 1, ?)
+            """, (aid, f"Operator {aid}", ROLE_OPERATOR, time.time()))
+        conn.commit()
+        cursor.execute("SELECT admin_id, name, role, online FROM admins")
+        ADMINS.clear()
+        for aid, name, role, online in cursor.fetchall():
+            ADMINS[aid] = {'name': name or f"Admin {aid}", 'role': role, 'online': bool(online)}
+        cursor.execute("SELECT admin_id, chat_id FROM assignments WHERE status = 'open' ORDER BY created")
+        admin_load.clear()
+        user_operator.clear()
+        for aid, cid in cursor.fetchall():
+            admin_load[aid] = admin_load.get(aid, 0) + 1
+            user_operator[cid] = aid
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMINS
+def is_owner(user_id: int) -> bool:
+    return ADMINS.get(user_id, {}).get('role') == ROLE_OWNER
+def add_admin(admin_id: int, name: str, role: str = ROLE_OPERATOR):
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR REPLACE INTO admins (admin_id, name, role, online, last_seen)
+            VALUES (?, ?, ?, 1, ?)
+        """, (admin_id, name, role, time.time()))
+        conn.commit()
+    ADMINS[admin_id] = {'name': name, 'role': role, 'online': True}
+def remove_admin(admin_id: int) -> dict:
+    """Operatorni o'chiradi va uning ochiq so'rovlarini qolgan operatorlarga qayta taqsimlaydi: {chat_id: yangi operator}."""
+    if admin_id == ADMIN_ID:
+        return {}
+    for user_id in list(sessions_by_admin.pop(admin_id, ())):
+        close_chat_session(user_id)
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT chat_id, kind FROM assignments WHERE admin_id = ? AND status = 'open'", (admin_id,))
+        open_requests = cursor.fetchall()
+    for cid, aid in list(user_operator.items()):
+        if aid == admin_id:
+            release_assignment(cid)
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM admins WHERE admin_id = ?", (admin_id,))
+        conn.commit()
+    ADMINS.pop(admin_id, None)
+    admin_load.pop(admin_id, None)
+    return {cid: assign_operator(cid, kind) for cid, kind in open_requests}
+def set_admin_online(admin_id: int, online: bool):
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE admins SET online = ?, last_seen = ?
+            WHERE admin_id = ?
+        """, (1 if online else 0, time.time(), admin_id))
+        conn.commit()
+    if admin_id in ADMINS:
+        ADMINS[admin_id]['online'] = online
+def assign_operator(chat_id: int, kind: str, admin_id: int = None) -> int:
+    """
+    Foydalanuvchi so'rovini operatorga biriktiradi. Ochiq biriktirish bo'lsa va operator onlayn bo'lsa,
+    o'sha operator qoladi; aks holda eng kam yuklangan onlayn operator tanlanadi (hech kim onlayn
+    bo'lmasa - bot egasi). admin_id berilsa, so'rov aynan shu operatorga o'tkaziladi.
+    """
+    current = user_operator.get(chat_id)
+    if admin_id is None:
+        if current in ADMINS and ADMINS[current]['online']:
+            return current
+        online = [aid for aid, a in ADMINS.items() if a['online']]
+        admin_id = min(online, key=lambda aid: (admin_load.get(aid, 0), _last_assigned.get(aid, 0.0))) if online else ADMIN_ID
+    if current == admin_id:
+        return admin_id
+    if current is not None:
+        release_assignment(chat_id)
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO assignments (admin_id, chat_id, kind, status, created)
+            VALUES (?, ?, ?, 'open', ?)
+        """, (admin_id, chat_id, kind, time.time()))
+        conn.commit()
+    admin_load[admin_id] = admin_load.get(admin_id, 0) + 1
+    _last_assigned[admin_id] = time.time()
+    user_operator[chat_id] = admin_id
+    return admin_id
+def operator_for(chat_id: int) -> int:
+    return user_operator.get(chat_id, ADMIN_ID)
+def release_assignment(chat_id: int):
+    admin_id = user_operator.pop(chat_id, None)
+    if admin_id is None:
+        return
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE assignments SET status = 'closed', closed = ?
+            WHERE chat_id = ? AND status = 'open'
+        """, (time.time(), chat_id))
+        conn.commit()
+    admin_load[admin_id] = max(0, admin_load.get(admin_id, 0) - 1)
+# ----------------- Admin <-> foydalanuvchi chat sessiyalari -----------------
+CHAT_SESSION_IDLE = int(os.getenv("CHAT_SESSION_IDLE", "1800"))  # sekund; shuncha vaqt xabar bo'lmasa sessiya yopiladi
+RELAY_INDEX_LIMIT = 5000
+sessions_by_user = {}  # user_id -> {'id', 'admin_id', 'user_id', 'opened', 'last_message'}
+sessions_by_admin = {}  # admin_id -> {user_id, ...}
+relay_index = {}  # (admin_id, admin tomondagi message_id) -> user_id; reply orqali javobni yo'naltirish uchun
+def load_chat_sessions():
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, admin_id, user_id, opened, last_message FROM chat_sessions WHERE closed IS NULL")
+        rows = cursor.fetchall()
+        # sessiyasi yo'q eski "chatda" bayroqlarini tozalash
+        cursor.execute("""
+            UPDATE chats SET in_chat_with_admin = 0
+            WHERE in_chat_with_admin = 1 AND chat_id NOT IN (SELECT user_id FROM chat_sessions WHERE closed IS NULL)
+        """)
+        conn.commit()
+    sessions_by_user.clear()
+    sessions_by_admin.clear()
+    for sid, admin_id, user_id, opened, last_message in rows:
+        sessions_by_user[user_id] = {'id': sid, 'admin_id': admin_id, 'user_id': user_id, 'opened': opened, 'last_message': last_message or opened}
+        sessions_by_admin.setdefault(admin_id, set()).add(user_id)
+def open_chat_session(admin_id: int, user_id: int) -> dict:
+    session = sessions_by_user.get(user_id)
+    if session and session['admin_id'] == admin_id:
+        admin_chat_targets[admin_id] = user_id
+        return session
+    if session:
+        close_chat_session(user_id)
+    now = time.time()
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO chat_sessions (admin_id, user_id, opened, last_message)
+            VALUES (?, ?, ?, ?)
+        """, (admin_id, user_id, now, now))
+        session = {'id': cursor.lastrowid, 'admin_id': admin_id, 'user_id': user_id, 'opened': now, 'last_message': now}
+        conn.commit()
+    sessions_by_user[user_id] = session
+    sessions_by_admin.setdefault(admin_id, set()).add(user_id)
+    admin_chat_targets[admin_id] = user_id
+    set_in_chat(user_id, True)
+    assign_operator(user_id, 'chat', admin_id)
+    return session
+def close_chat_session(user_id: int):
+    session = sessions_by_user.pop(user_id, None)
+    if not session:
+        return None
+    admin_id = session['admin_id']
+    with get_db_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE chat_sessions SET closed = ?, last_message = ? WHERE id = ?", (time.time(), session['last_message'], session['id']))
+        conn.commit()
+    remaining = sessions_by_admin.get(admin_id, set())
+    remaining.discard(user_id)
+    if admin_chat_targets.get(admin_id) == user_id:
+        if remaining:
+            admin_chat_targets[admin_id] = max(remaining, key=lambda uid: sessions_by_user[uid]['last_message'])
+        else:
+            admin_chat_targets.pop(admin_id, None)
+    set_in_chat(user_id, False)
+    release_assignment(user_id)
+    return session
+def touch_chat_session(user_id: int):
+    session = sessions_by_user.get(user_id)
+    if session:
+        session['last_message'] = time.time()
+def remember_relay(admin_id: int, message_id: int, user_id: int):
+    relay_index[(admin_id, message_id)] = user_id
+    if len(relay_index) > RELAY_INDEX_LIMIT:
+        for key in list(relay_index)[:len(relay_index) - RELAY_INDEX_LIMIT]:
+            relay_index.pop(key, None)
+def resolve_admin_target(message: types.Message):
+    """Admin xabari qaysi foydalanuvchiga tegishli: avval reply qilingan xabar bo'yicha, keyin joriy suhbat bo'yicha."""
+    admin_id = message.chat.id
+    if message.reply_to_message:
+        user_id = relay_index.get((admin_id, message.reply_to_message.message_id))
+        if user_id in sessions_by_user and sessions_by_user[user_id]['admin_id'] == admin_id:
+            return user_id
+    user_id = admin_chat_targets.get(admin_id)
+    if user_id in sessions_by_admin.get(admin_id, ()):
+        return user_id
+    return None
+def admin_chat_exit_kb(user_id: int, header: str = None) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=f"🚪 {user_id} bilan chatni yakunlash", callback_data=UserActionCb(action="exit", user_id=user_id).pack())]]
+    if header:
+        rows.insert(0, [InlineKeyboardButton(text=header, callback_data=UserActionCb(action="focus", user_id=user_id).pack())])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+def _relay_header(session: dict, service: str) -> str:
+    # sarlavha har bir sessiya+xizmat uchun bir marta quriladi, keyingi xabarlarda profil bazadan o'qilmaydi
+    if session.get('header_service') != service:
+        profile = get_chat_profile(session['user_id']) or Profile()
+        parts = [f"📨 {service}", profile.ism_familya or str(session['user_id']), profile.telefon]
+        session['header'] = " · ".join(p for p in parts if p)[:64]
+        session['header_service'] = service
+    return session['header']
+async def relay_to_operator(message: types.Message, service: str):
+    """
+    Foydalanuvchi xabarini (matn, rasm, ovoz, stiker va h.k.) bitta copy_message chaqiruvi bilan
+    suhbatdagi adminga yuboradi. Kontekst (xizmat, ism, telefon) inline tugma sarlavhasi sifatida
+    biriktiriladi, shuning uchun u barcha kontent turlari uchun bir xil ishlaydi.
+    """
+    chat_id = message.chat.id
+    session = sessions_by_user.get(chat_id)
+    if not session:
+        return None
+    admin_id = session['admin_id']
+    sent = await bot.copy_message(chat_id=admin_id, from_chat_id=chat_id, message_id=message.message_id,
+                                  reply_markup=admin_chat_exit_kb(chat_id, _relay_header(session, service)))
+    remember_relay(admin_id, sent.message_id, chat_id)
+    touch_chat_session(chat_id)
+    return sent
+async def expire_idle_sessions_loop():
+    while True:
+        await asyncio.sleep(60)
+        cutoff = time.time() - CHAT_SESSION_IDLE
+        for user_id, session in list(sessions_by_user.items()):
+            if session['last_message'] >= cutoff:
+                continue
+            close_chat_session(user_id)
+            save_action({'type': 'admin_chat_expired', 'chat_id': user_id, 'details': f"Idle session with {session['admin_id']}"})
+            try:
+                await bot.send_message(user_id, "⌛ Admin bilan suhbat faolsizlik sababli yakunlandi.", reply_markup=get_main_menu(user_id))
+            except Exception as e:
+                logger.debug("Sessiya tugashi haqida foydalanuvchiga yozilmadi (%s): %s", user_id, e)
+            try:
+                await bot.send_message(session['admin_id'], f"⌛ {user_id} bilan suhbat faolsizlik sababli yopildi.")
+            except Exception as e:
+                logger.debug("Sessiya tugashi haqida adminga yozilmadi (%s): %s", session['admin_id'], e)
+# ----------------- Chiquvchi so'rovlar rejalashtiruvchisi -----------------
+# Ustuvorlik: kichik son - yuqori ustuvorlik
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+PRIORITY_REMINDER = 2
+PRIORITY_BROADCAST = 3
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))  # xabar/sekund, butun bot bo'yicha
+OUTBOUND_PER_CHAT_INTERVAL = float(os.getenv("OUTBOUND_PER_CHAT_INTERVAL", "1.0"))  # bitta chatga xabarlar orasidagi sekund
+OUTBOUND_PER_CHAT_BURST = int(os.getenv("OUTBOUND_PER_CHAT_BURST", "3"))  # chatga kutmasdan ketadigan xabarlar soni
+RETRY_AFTER_ATTEMPTS = 3
+send_priority = contextvars.ContextVar("send_priority", default=None)
+@contextmanager
+def outbound_priority(priority: int):
+    token = send_priority.set(priority)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Bot sessiyasiga o'rnatiladigan middleware: chatga yuboriladigan barcha so'rovlarni
+    (send_*, copy_*, forward_*, edit_*) chat bo'yicha va global tezlik bo'yicha navbatga qo'yadi,
+    ustuvorlik bo'yicha chiqaradi va RetryAfter xatolarida avtomatik qayta urinadi.
+    """
+    PACED_PREFIXES = ("Send", "Copy", "Forward", "Edit")
+    # tahrirlar (odatda foydalanuvchi bosgan tugmaga javob) chat tezligiga kirmaydi, faqat global navbatdan o'tadi
+    CHAT_PACED_PREFIXES = ("Send", "Copy", "Forward")
+    def __init__(self, global_rate: float, per_chat_interval: float, per_chat_burst: int = 1):
+        self._global_interval = 1.0 / global_rate
+        self._per_chat_interval = per_chat_interval
+        # chatga ketma-ket shuncha xabar kutmasdan ketadi (GCRA: _chat_ready - chatning "nazariy" keyingi vaqti)
+        self._chat_burst_allowance = max(0, per_chat_burst - 1) * per_chat_interval
+        self._queue = []  # heap: (priority, seq, future)
+        self._seq = itertools.count()
+        self._chat_ready = {}  # chat_id -> keyingi bo'sh vaqt (monotonic)
+        self._chat_expiry = []  # heap: (bo'sh vaqt, chat_id) - muddati o'tgan _chat_ready yozuvlarini tozalash uchun
+        self._next_slot = 0.0
+        self._wakeup = None
+        self._worker = None
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+    def _set_chat_ready(self, chat_id, ready: float):
+        self._chat_ready[chat_id] = ready
+        heapq.heappush(self._chat_expiry, (ready, chat_id))
+    def _prune_chat_ready(self, now: float):
+        # faqat muddati o'tganlar olinadi: har bir yozuv bir marta, O(log n)
+        heap = self._chat_expiry
+        while heap and heap[0][0] <= now:
+            ready, chat_id = heapq.heappop(heap)
+            if self._chat_ready.get(chat_id) == ready:
+                del self._chat_ready[chat_id]
+    async def _wait_chat_slot(self, chat_id):
+        now = time.monotonic()
+        self._prune_chat_ready(now)
+        tat = max(now, self._chat_ready.get(chat_id, 0.0))
+        self._set_chat_ready(chat_id, tat + self._per_chat_interval)
+        wait = tat - self._chat_burst_allowance - now
+        if wait > 0:
+            await asyncio.sleep(wait)
+    async def _wait_global_slot(self, priority: int):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+        fut = loop.create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), fut))
+        self._wakeup.set()
+        await fut
+    async def _run(self):
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            delay = self._next_slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            _, _, fut = heapq.heappop(self._queue)
+            if fut.done():
+                continue
+            fut.set_result(None)
+            self._next_slot = max(time.monotonic(), self._next_slot) + self._global_interval
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(self.PACED_PREFIXES):
+            return await make_request(bot, method)
+        priority = send_priority.get()
+        if priority is None:
+            priority = PRIORITY_ADMIN if is_admin(chat_id) else PRIORITY_USER
+        chat_paced = type(method).__name__.startswith(self.CHAT_PACED_PREFIXES)
+        attempt = 0
+        while True:
+            if chat_paced:
+                await self._wait_chat_slot(chat_id)
+            await self._wait_global_slot(priority)
+            try:
+                return await make_request(bot, method)
+            except aiogram.exceptions.TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > RETRY_AFTER_ATTEMPTS:
+                    raise
+                logger.warning(f"Flood limit ({type(method).__name__}, chat {chat_id}): {e.retry_after}s kutiladi, urinish {attempt}")
+                resume = time.monotonic() + e.retry_after
+                self._set_chat_ready(chat_id, max(self._chat_ready.get(chat_id, 0.0), resume + self._chat_burst_allowance))
+                # navbatdagi boshqa so'rovlar ham shu 429 ga urilmasligi uchun global slot ham suriladi
+                self._next_slot = max(self._next_slot, resume)
 # ----------------- Bot / Dispatcher -----------------
 create_db()
 migrate_db()
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+presence.load()
+load_verified()
+load_admins()
+load_chat_sessions()
+bot = Bot(
+    token=BOT_TOKEN,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
+outbound = OutboundScheduler(OUTBOUND_GLOBAL_RATE, OUTBOUND_PER_CHAT_INTERVAL, OUTBOUND_PER_CHAT_BURST)
+bot.session.middleware(outbound)
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    # navbatdan keyin o'rnatiladi: faqat haqiqiy so'rov vaqti o'lchanadi, kutish emas
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            with trace_span(f"api: {name}"):
+                return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, name)
+bot.session.middleware(ApiMetricsMiddleware())
+# ----------------- Callback jadvali -----------------
+# aiogram callback ishlovchilarini ro'yxat bo'yicha birma-bir tekshiradi. CallbackTable esa ishlovchilarni
+# e'lon qilingan callback_data kaliti bo'yicha indekslaydi: F.data == "x" - aniq qiymat, F.data.startswith("x_")
+# va CallbackData.filter() - prefiks. Callback kelganda faqat lug'atdan topilgan nomzodlar (va kaliti aniqlanmagan
+# ishlovchilar) ro'yxatga olish tartibida tekshiriladi, shuning uchun narx ishlovchilar soniga bog'liq emas.
+def callback_key(filter_object):
+    """Filtrdan ("exact", qiymat) yoki ("prefix", qiymat) kalitini ajratadi; aniqlab bo'lmasa None."""
+    if isinstance(filter_object.callback, CallbackQueryFilter):
+        cb = filter_object.callback.callback_data
+        return "prefix", f"{cb.__prefix__}{cb.__separator__}"
+    ops = getattr(getattr(filter_object, "magic", None), "_operations", ())
+    if not ops or getattr(ops[0], "name", None) != "data":
+        return None
+    if len(ops) == 2 and getattr(ops[1], "comparator", None) is operator.eq and isinstance(getattr(ops[1], "right", None), str):
+        return "exact", ops[1].right
+    if len(ops) == 3 and getattr(ops[1], "name", None) == "startswith" and len(getattr(ops[2], "args", ())) == 1 and isinstance(ops[2].args[0], str):
+        return "prefix", ops[2].args[0]
+    return None
+class CallbackTable(TelegramEventObserver):
+    def __init__(self, router: Router):
+        super().__init__(router=router, event_name="callback_query")
+        self._index = None  # ro'yxatga olish o'zgarganda qayta quriladi
+    def register(self, *args, **kwargs):
+        self._index = None
+        return super().register(*args, **kwargs)
+    def _build_index(self):
+        exact, prefixes, always = {}, {}, []
+        for pos, handler in enumerate(self.handlers):
+            key = next(filter(None, map(callback_key, handler.filters or ())), None)
+            if key is None:
+                always.append(pos)
+            else:
+                (exact if key[0] == "exact" else prefixes).setdefault(key[1], []).append(pos)
+        return exact, prefixes, sorted({len(p) for p in prefixes}), always
+    def candidates(self, data: str) -> list:
+        if self._index is None:
+            self._index = self._build_index()
+        exact, prefixes, lengths, always = self._index
+        positions = always + exact.get(data, [])
+        for n in lengths:
+            if n <= len(data):
+                positions += prefixes.get(data[:n], [])
+        return [self.handlers[pos] for pos in sorted(positions)]
+    async def trigger(self, event: types.CallbackQuery, **kwargs):
+        # TelegramEventObserver.trigger bilan bir xil, faqat barcha ishlovchilar o'rniga nomzodlar ustida
+        for handler in self.candidates(event.data or ""):
+            kwargs["handler"] = handler
+            result, data = await handler.check(event, **kwargs)
+            if result:
+                kwargs.update(data)
+                try:
+                    wrapped_inner = self.outer_middleware.wrap_middlewares(self._resolve_middlewares(), handler.call)
+                    return await wrapped_inner(event, kwargs)
+                except SkipHandler:
+                    continue
+        return UNHANDLED
+def use_callback_table(router: Router) -> Router:
+    """Routerning callback_query kuzatuvchisini CallbackTable bilan almashtiradi (ishlovchilar qo'shilishidan oldin)."""
+    router.callback_query = router.observers["callback_query"] = CallbackTable(router)
+    return router
+dp = use_callback_table(Dispatcher(storage=MemoryStorage()))
 
 # Add admin_last_user_list (used by admin users/block lists)
 admin_last_user_list = {}  # admin_id -> {'page': int, 'users': [...], 'total': int}
 
 # Add admin chat mapping to track active admin <-> user sessions
-admin_chat_targets = {}  # admin_id -> target_chat_id
+admin_chat_targets = {}  # admin_id -> joriy (oxirgi faol) suhbatdoshi; to'liq ro'yxat sessions_by_admin da
 
 # ----------------- New: global intercept for banned users -----------------
 # If a user is banned, block all messages and callback queries (except ADMIN).
 # These handlers are registered early so they run before other handlers and prevent any action.
-@dp.message(lambda message: is_banned(getattr(message, "chat").id) and getattr(message, "chat").id != ADMIN_ID)
+@dp.message(lambda message: is_banned(getattr(message, "chat").id) and not is_admin(getattr(message, "chat").id))
 async def _blocked_user_message_intercept(message: types.Message, state: FSMContext):
 	# Clear any FSM state and inform the user they are banned.
 	try:
@@ -390,7 +1353,7 @@ async def _blocked_user_message_intercept(message: types.Message, state: FSMCont
 	except Exception:
 		pass
 
-@dp.callback_query(lambda cq: is_banned(getattr(cq, "from_user").id) and getattr(cq, "from_user").id != ADMIN_ID)
+@dp.callback_query(lambda cq: is_banned(getattr(cq, "from_user").id) and not is_admin(getattr(cq, "from_user").id))
 async def _blocked_user_callback_intercept(callback: types.CallbackQuery, state: FSMContext):
 	try:
 		await state.clear()
@@ -422,8 +1385,6 @@ class RaqamBuyurtma(StatesGroup):
     phone_text = State()
     confirm = State()
     waiting_reply = State()
-class HumanCheck(StatesGroup):
-    question = State()
 class Feedback(StatesGroup):
     waiting = State()
 class Reklama(StatesGroup):
@@ -452,8 +1413,235 @@ class AdminChat(StatesGroup):
     chatting = State()  # foydalanuvchi admin bilan suhbatda
 class Rating(StatesGroup):
     waiting = State()   # foydalan
+# ----------------- Routerlar -----------------
+# Har bir xizmat o'z routeriga ega. Router darajasidagi CallbackScope filtri callback_data nom maydonini
+# (birinchi "_" yoki ":" gacha bo'lgan qism) yoki joriy FSM holat guruhini tekshiradi; mos kelmasa aiogram
+# routerni bitta tekshiruv bilan o'tkazib yuboradi. Router ichida ishlovchi CallbackTable lug'atidan topiladi.
+def callback_namespace(data: str) -> str:
+    return (data or "").partition(":")[0].partition("_")[0]
+class CallbackScope(Filter):
+    def __init__(self, *namespaces: str, states=None):
+        self.namespaces = frozenset(namespaces)
+        self.state_prefix = f"{states.__full_group_name__}:" if states else None
+    async def __call__(self, callback: types.CallbackQuery, raw_state: str = None) -> bool:
+        if callback_namespace(callback.data) in self.namespaces:
+            return True
+        return bool(self.state_prefix and raw_state and raw_state.startswith(self.state_prefix))
+class UserActionCb(CallbackData, prefix="ua"):
+    action: str  # chat | accept | decline | unblock | block | focus | exit
+    user_id: int
+class DigestCb(CallbackData, prefix="dg"):
+    digest_id: int
+    page: int
+class UsersPageCb(CallbackData, prefix="up"):
+    page: int
+class CaptchaCb(CallbackData, prefix="cp"):
+    action: str  # "d" - raqam kiritish/o'chirish, "ok" - javobni yuborish
+    value: str   # shu tugma bosilgandan keyingi kiritilgan raqamlar
+    exp: int     # token amal qilish muddati (unix vaqt)
+    sig: str     # HMAC(chat_id, exp, to'g'ri javob)
+profil_router = use_callback_table(Router(name="profil"))
+profil_router.callback_query.filter(CallbackScope("profil", states=Profil))
+tiklash_router = use_callback_table(Router(name="tiklash"))
+tiklash_router.callback_query.filter(CallbackScope("tiklash", states=RaqamTiklash))
+reklama_router = use_callback_table(Router(name="reklama"))
+reklama_router.callback_query.filter(CallbackScope("reklama", states=Reklama))
+reklama_router.message.filter(StateFilter(Reklama))
+buyurtma_router = use_callback_table(Router(name="buyurtma"))
+buyurtma_router.callback_query.filter(CallbackScope("buyurtma", states=RaqamBuyurtma))
+buyurtma_router.message.filter(StateFilter(RaqamBuyurtma))
+admin_router = use_callback_table(Router(name="admin"))
+admin_router.callback_query.filter(CallbackScope("admin", UserActionCb.__prefix__, DigestCb.__prefix__, UsersPageCb.__prefix__), F.from_user.id.func(is_admin))
+admin_router.message.filter(F.chat.id.func(is_admin))
+# tartib muhim: admin routeri oxirida, chunki uning raqamli/relay ishlovchilari holatsiz xabarlarni ushlaydi
+dp.include_routers(profil_router, tiklash_router, reklama_router, buyurtma_router, admin_router)
+UPDATE_DEDUP_SIZE = 1000
+class UpdateDedupMiddleware(BaseMiddleware):
+    """Qayta yetkazilgan yangilanishlar (bir xil update_id) ishlovchilarga ikkinchi marta yetib bormaydi."""
+    def __init__(self):
+        self.seen = OrderedDict()
+    async def __call__(self, handler, event, data):
+        if event.update_id in self.seen:
+            logger.info(f"Takroriy yangilanish o'tkazib yuborildi: {event.update_id}")
+            return None
+        self.seen[event.update_id] = None
+        if len(self.seen) > UPDATE_DEDUP_SIZE:
+            self.seen.popitem(last=False)
+        return await handler(event, data)
+dp.update.outer_middleware(UpdateDedupMiddleware())
+class LogContextMiddleware(BaseMiddleware):
+    """Yangilanish uchun log kontekstini o'rnatadi va ishlov berish vaqtini bot.access'ga yozadi (namuna bilan)."""
+    async def __call__(self, handler, event, data):
+        ctx = {"update_id": event.update_id}
+        token = log_context.set(ctx)
+        trace = Trace(f"update {event.update_id} ({event.event_type})")
+        trace_token = current_trace.set(trace)
+        _active_traces.add(trace)
+        start = time.perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            ctx["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            access_logger.warning("update failed")  # traceback'ni aiogram o'zi loglaydi
+            raise
+        else:
+            ctx["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            access_logger.info("update handled")
+            return result
+        finally:
+            _active_traces.discard(trace)
+            if ctx.get("latency_ms", 0) >= SLOW_UPDATE_MS:
+                record_slow_update(trace, ctx.get("handler", event.event_type), ctx["latency_ms"])
+            trace.closed = True
+            current_trace.reset(trace_token)
+            log_context.reset(token)
+class HandlerContextMiddleware(BaseMiddleware):
+    # ichki middleware: ishlovchi aniq bo'lgandan keyin uning nomi va chat kontekstga qo'shiladi
+    async def __call__(self, handler, event, data):
+        ctx = log_context.get()
+        name = data["handler"].callback.__name__
+        if ctx is not None:
+            ctx["handler"] = name
+            chat = data.get("event_chat")
+            if chat is not None:
+                ctx["chat_id"] = chat.id
+        trace = current_trace.get()
+        if trace is not None:
+            # yangilanish boshidan shu yergacha: tashqi middleware'lar va routerlar filtrlari
+            trace.name = name
+            trace.spans.append(["middleware+filters", trace.start, time.perf_counter(), 1])
+        with trace_span(f"handler: {name}"):
+            return await handler(event, data)
+dp.update.outer_middleware(LogContextMiddleware())
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        UPDATES_TOTAL.inc(event.event_type)
+        return await handler(event, data)
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+for _observer in (dp.message, dp.callback_query, dp.inline_query, dp.chat_member):
+    _observer.middleware(HandlerMetricsMiddleware())
+dp.message.middleware(HandlerContextMiddleware())
+dp.callback_query.middleware(HandlerContextMiddleware())
+class ActivityMiddleware(BaseMiddleware):
+    """Har bir yangilanishda shaxsiy chat faolligini bir marta belgilaydi (presence)."""
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        if chat is not None and chat.type == "private":
+            update_chat_activity(chat.id)
+        return await handler(event, data)
+dp.update.outer_middleware(ActivityMiddleware())
+# ----------------- Flood nazorati (throttling) -----------------
+# Har bir chat uchun token bucket: "default" chelak barcha xabar/callbacklarga, qo'shimcha chelaklar esa
+# flags={"throttle": "<kalit>"} bilan belgilangan qimmat ishlovchilarga (admin bildirishnomasi, ariza) qo'llanadi.
+# Qiymatlar: (sekundiga to'ldirilish tezligi, maksimal zaxira).
+THROTTLE_LIMITS = {
+    "default": (float(os.getenv("THROTTLE_RATE", "1")), int(os.getenv("THROTTLE_BURST", "8"))),
+    "feedback": (1 / 60, 2),
+    "admin_request": (1 / 120, 1),
+    "submit": (1 / 30, 3),
+    "relay": (0.5, 10),
+}
+THROTTLE_BAN_STRIKES = int(os.getenv("THROTTLE_BAN_STRIKES", "20"))  # shuncha rad etilgan yangilanishdan keyin vaqtinchalik ban
+THROTTLE_STRIKE_WINDOW = 60
+THROTTLE_BAN_SECONDS = int(os.getenv("THROTTLE_BAN_SECONDS", "900"))
+class TokenBucket:
+    __slots__ = ("tokens", "stamp")
+    def __init__(self, burst: int, now: float):
+        self.tokens = burst
+        self.stamp = now
+    def refill(self, rate: float, burst: int, now: float) -> float:
+        self.tokens = min(burst, self.tokens + max(0.0, now - self.stamp) * rate)
+        self.stamp = now
+        return self.tokens
+_buckets = {}  # (chat_id, kalit) -> TokenBucket
+_strikes = {}  # chat_id -> [rad etilganlar soni, birinchisining vaqti]
+_last_album = {}  # chat_id -> media_group_id: albom bitta yangilanish sifatida hisoblanadi
+def throttle_allow(chat_id: int, key: str = "default") -> bool:
+    now = time.monotonic()
+    keys = ("default",) if key == "default" else ("default", key)
+    buckets = []
+    for k in keys:
+        rate, burst = THROTTLE_LIMITS[k]
+        bucket = _buckets.get((chat_id, k))
+        if bucket is None:
+            bucket = _buckets[(chat_id, k)] = TokenBucket(burst, now)
+        if bucket.refill(rate, burst, now) < 1:
+            return False  # hech bir chelakdan token olinmaydi
+        buckets.append(bucket)
+    for bucket in buckets:
+        bucket.tokens -= 1
+    return True
+def throttle_strike(chat_id: int) -> int:
+    now = time.monotonic()
+    strike = _strikes.get(chat_id)
+    if strike is None or now - strike[1] > THROTTLE_STRIKE_WINDOW:
+        strike = _strikes[chat_id] = [0, now]
+    strike[0] += 1
+    return strike[0]
+class ThrottlingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or is_admin(user.id):
+            return await handler(event, data)
+        chat_id = user.id
+        if isinstance(event, types.Message) and event.media_group_id:
+            if _last_album.get(chat_id) == event.media_group_id:
+                return await handler(event, data)
+            _last_album[chat_id] = event.media_group_id
+        if throttle_allow(chat_id, get_flag(data, "throttle", default="default")):
+            return await handler(event, data)
+        strikes = throttle_strike(chat_id)
+        if strikes >= THROTTLE_BAN_STRIKES and not is_banned(chat_id):
+            set_banned(chat_id, True, until=time.time() + THROTTLE_BAN_SECONDS)
+            _strikes.pop(chat_id, None)
+            logger.warning(f"Flood: {chat_id} {THROTTLE_BAN_SECONDS // 60} daqiqaga bloklandi")
+            save_action({'type': 'flood_ban', 'chat_id': chat_id, 'details': {'seconds': THROTTLE_BAN_SECONDS}})
+        # faqat birinchi rad etishda javob beriladi, aks holda flood javoblar oqimiga aylanadi
+        if isinstance(event, types.CallbackQuery):
+            await event.answer("⏳ Juda tez! Biroz kuting." if strikes == 1 else None)
+        elif strikes == 1:
+            await event.answer("⏳ Juda ko'p xabar yuboryapsiz. Biroz kuting va qayta urinib ko'ring.")
+dp.message.middleware(ThrottlingMiddleware())
+dp.callback_query.middleware(ThrottlingMiddleware())
+async def throttle_housekeeping_loop():
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        # to'lib bo'lgan (uzoq vaqt ishlatilmagan) chelaklar xotiradan chiqariladi
+        for key, bucket in list(_buckets.items()):
+            rate, burst = THROTTLE_LIMITS[key[1]]
+            if bucket.tokens + (now - bucket.stamp) * rate >= burst:
+                del _buckets[key]
+        for chat_id, (_, first) in list(_strikes.items()):
+            if now - first > THROTTLE_STRIKE_WINDOW:
+                del _strikes[chat_id]
+        for chat_id, (_, first) in list(_captcha_failures.items()):
+            if now - first > CAPTCHA_FAIL_WINDOW:
+                del _captcha_failures[chat_id]
+        _last_album.clear()
+        try:
+            prune_idempotency()
+        except sqlite3.Error as e:
+            logger.error(f"Idempotency kalitlari tozalanmadi: {e}")
+        try:
+            for chat_id in lift_expired_bans():
+                logger.info(f"Flood bani tugadi: {chat_id}")
+        except sqlite3.Error as e:
+            logger.error(f"Vaqtinchalik banlar tekshirilmadi: {e}")
 # ----------------- UI yordamchilar -----------------
 KB_MAIN_REPLY = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="/start")]], resize_keyboard=True, one_time_keyboard=False)
+@lru_cache(maxsize=None)  # back_cb qiymatlari soni cheklangan, har biri uchun bitta umumiy klaviatura
 def get_cancel_kb(service_back: str = None) -> InlineKeyboardMarkup:
     kb = [
         [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_service")]
@@ -463,19 +1651,26 @@ def get_cancel_kb(service_back: str = None) -> InlineKeyboardMarkup:
     else:
         kb.append([InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
-def get_main_menu(chat_id: int) -> InlineKeyboardMarkup:
-    kb = [
-        [InlineKeyboardButton(text="📱 Raqam tiklash", callback_data="tiklash")],
-        [InlineKeyboardButton(text="🆕 Raqam buyurtma", callback_data="buyurtma")],
-        [InlineKeyboardButton(text="📰 Reklama", callback_data="reklama")],
-        [InlineKeyboardButton(text="💬 Fikr bildirish", callback_data="feedback")],
-        [InlineKeyboardButton(text="👤 Profil", callback_data="profil")],
-        [InlineKeyboardButton(text="📞 Admin bilan chat", callback_data="admin_chat")],
-        [InlineKeyboardButton(text="ℹ️ Bot haqida", callback_data="about_bot")]
-    ]
-    if chat_id == ADMIN_ID:
+# Statik klaviaturalar bir marta quriladi va barcha yangilanishlar uchun umumiy nusxa sifatida qaytariladi.
+# Ularni o'zgartirmang (inline_keyboard ga qator qo'shish va h.k.) - kerak bo'lsa yangisini yarating.
+_MAIN_MENU_ROWS = (
+    (("📱 Raqam tiklash", "tiklash"),),
+    (("🆕 Raqam buyurtma", "buyurtma"),),
+    (("📰 Reklama", "reklama"),),
+    (("💬 Fikr bildirish", "feedback"),),
+    (("👤 Profil", "profil"),),
+    (("📞 Admin bilan chat", "admin_chat"),),
+    (("ℹ️ Bot haqida", "about_bot"),),
+)
+def _build_main_menu(with_admin: bool) -> InlineKeyboardMarkup:
+    kb = [[InlineKeyboardButton(text=text, callback_data=data) for text, data in row] for row in _MAIN_MENU_ROWS]
+    if with_admin:
         kb.append([InlineKeyboardButton(text="👨‍💻 Admin panel", callback_data="admin_panel")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
+KB_MAIN_USER = _build_main_menu(False)
+KB_MAIN_ADMIN = _build_main_menu(True)
+def get_main_menu(chat_id: int) -> InlineKeyboardMarkup:
+    return KB_MAIN_ADMIN if is_admin(chat_id) else KB_MAIN_USER
 KB_SUBSCRIPTION = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="✅ Kanalga obuna bo'lish", url=f"https://t.me/{REQUIRED_CHANNEL.lstrip('@')}")],
     [InlineKeyboardButton(text="Obuna bo'ldim, tekshirish", callback_data="check_subscription")]
@@ -506,6 +1701,13 @@ KB_BUYURTMA_OPERATOR = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="📶 Mobiuz", callback_data="bop_Mobiuz")],
     [InlineKeyboardButton(text="⬅️ Orqaga qaytish", callback_data="back_buyurtma_mah"), InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")]
 ])
+@lru_cache(maxsize=None)
+def step_back_kb(back_cb: str, back_text: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=back_text, callback_data=back_cb)],
+        [InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")],
+        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_service")]
+    ])
 def yes_no_kb(yes_cb, no_cb, back_cb) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Ha, qo'shaman", callback_data=yes_cb)],
@@ -579,6 +1781,8 @@ KB_ADMIN_PANEL = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="👥 Foydalanuvchilar ro'yxati", callback_data="admin_users")],
     [InlineKeyboardButton(text="📝 So'nggi harakatlar", callback_data="admin_actions")],
     [InlineKeyboardButton(text="🚫 Bloklanganlar", callback_data="admin_blocked")],
+    [InlineKeyboardButton(text="👮 Operatorlar", callback_data="admin_operators")],
+    [InlineKeyboardButton(text="🔄 Onlayn/oflayn holatni almashtirish", callback_data="admin_toggle_online")],
     [InlineKeyboardButton(text="⬅️ Bosh menyu", callback_data="back_main")]
 ])
 KB_SHARE_LOCATION = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="📍 Joylashuvni ulashish", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
@@ -599,7 +1803,7 @@ MAHALLALAR = [
     "Sherobod", "Cho'yinchi", "Chuqurko'l", "Xo'jgi", "Cho'mishli", "Balxiguzar", "Chag'atoy", "Poshxurt"
 ]
 PAGE_SIZE = 10
-def kb_mahalla_page(page: int) -> InlineKeyboardMarkup:
+def _build_mahalla_page(page: int) -> InlineKeyboardMarkup:
     start = page * PAGE_SIZE
     end = min(start + PAGE_SIZE, len(MAHALLALAR))
     rows = [[InlineKeyboardButton(text=f"🏘️ {MAHALLALAR[start + i]} mahallasi", callback_data=f"mah_sel_{start + i}")] for i in range(end - start)]
@@ -610,28 +1814,256 @@ def kb_mahalla_page(page: int) -> InlineKeyboardMarkup:
         nav.append(InlineKeyboardButton(text="➡️ Keyingi sahifa", callback_data=f"mah_page_{page + 1}"))
     if nav:
         rows.append(nav)
+    rows.append([InlineKeyboardButton(text="🔎 Mahallani qidirish", switch_inline_query_current_chat="")])
+    rows.append([InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+KB_MAHALLA_PAGES = tuple(_build_mahalla_page(page) for page in range((len(MAHALLALAR) + PAGE_SIZE - 1) // PAGE_SIZE))
+def kb_mahalla_page(page: int) -> InlineKeyboardMarkup:
+    # noto'g'ri/eskirgan sahifa raqami kelsa, eng yaqin mavjud sahifa qaytariladi
+    return KB_MAHALLA_PAGES[min(max(page, 0), len(KB_MAHALLA_PAGES) - 1)]
+# ----------------- Mahalla qidiruvi -----------------
+MAHALLA_SEARCH_LIMIT = 8
+_APOSTROPHES = str.maketrans({c: None for c in "'‘’ʻʼ`´"})
+def normalize_uz(text: str) -> str:
+    """G‘/G'/Gʻ/G kabi yozuvlarni bir xil ko'rinishga keltiradi (tutuq belgisiz ham topiladi) va ortiqcha so'zlarni olib tashlaydi."""
+    text = (text or "").translate(_APOSTROPHES).lower().replace("-", " ")
+    text = re.sub(r"\bmahalla(si)?\b", " ", text)
+    return " ".join(text.split())
+_MAHALLA_INDEX = [(normalize_uz(name), idx) for idx, name in enumerate(MAHALLALAR)]
+_MAHALLA_BY_KEY = {key: idx for key, idx in _MAHALLA_INDEX}
+def search_mahalla(query: str, limit: int = MAHALLA_SEARCH_LIMIT) -> list:
+    """Mahalla indekslarini moslik darajasi bo'yicha qaytaradi: aniq, boshlanishi, ichida, so'ng taxminiy (difflib)."""
+    q = normalize_uz(query)
+    if not q:
+        return []
+    if q in _MAHALLA_BY_KEY:
+        return [_MAHALLA_BY_KEY[q]]
+    prefix, words, inner = [], [], []
+    for key, idx in _MAHALLA_INDEX:
+        if key.startswith(q):
+            prefix.append(idx)
+        elif any(w.startswith(q) for w in key.split()):
+            words.append(idx)
+        elif q in key:
+            inner.append(idx)
+    found = prefix + words + inner
+    if len(found) < limit:
+        for key in difflib.get_close_matches(q, _MAHALLA_BY_KEY, n=limit, cutoff=0.6):
+            if _MAHALLA_BY_KEY[key] not in found:
+                found.append(_MAHALLA_BY_KEY[key])
+    return found[:limit]
+def kb_mahalla_matches(indices: list) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=f"🏘️ {MAHALLALAR[idx]} mahallasi", callback_data=f"mah_sel_{idx}")] for idx in indices]
+    rows.append([InlineKeyboardButton(text="📋 Ro'yxatdan tanlash", callback_data="mah_page_0")])
     rows.append([InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
+# ----------------- Ish vaqti -----------------
+# WORK_SCHEDULE: "kunlar=HH:MM-HH:MM" yozuvlari ";" bilan (0 = dushanba ... 6 = yakshanba), masalan
+# "0-4=07:00-24:00;5-6=09:00-18:00". Ro'yxatda yo'q kunlar dam olish kuni. WORK_HOLIDAYS: "2026-01-01,2026-03-21".
+# Yopilish ochilishdan oldin bo'lsa (masalan "0-6=22:00-02:00") u keyingi kunga tegishli deb olinadi.
+WORK_TZ = pytz.timezone(os.getenv("WORK_TZ", "Asia/Tashkent"))
+WORK_SCHEDULE = os.getenv("WORK_SCHEDULE", "0-6=07:00-24:00")
+WORK_HOLIDAYS = os.getenv("WORK_HOLIDAYS", "")
+def parse_work_schedule(spec: str) -> dict:
+    schedule = {}
+    for entry in filter(None, (part.strip() for part in spec.split(";"))):
+        days, _, hours = entry.partition("=")
+        first, _, last = days.partition("-")
+        opens, _, closes = hours.partition("-")
+        try:
+            start, end = (int(h) * 60 + int(m) for h, m in (opens.split(":"), closes.split(":")))
+            day_range = range(int(first), int(last or first) + 1)
+        except ValueError:
+            raise ValueError(f"WORK_SCHEDULE: noto'g'ri yozuv {entry!r} (kutilgan: kunlar=HH:MM-HH:MM)") from None
+        if not (0 <= start < 1440 and 0 <= end <= 1440) or not day_range or day_range[0] < 0 or day_range[-1] > 6:
+            raise ValueError(f"WORK_SCHEDULE: {entry!r} da kun 0-6, vaqt 00:00-24:00 oralig'ida bo'lishi kerak")
+        if end == start:
+            raise ValueError(f"WORK_SCHEDULE: {entry!r} da ochilish va yopilish vaqti bir xil")
+        if end < start:
+            end += 1440  # tungi smena: yopilish ertasi kuni
+        for day in day_range:
+            schedule[day] = (start, end)
+    return schedule
+class BusinessHours:
+    """
+    Keyingi ochilish/yopilish vaqti bir marta hisoblanadi va monotonic soat bo'yicha muddat sifatida saqlanadi:
+    is_open() muddat o'tmaguncha faqat time.monotonic() bilan solishtiradi, vaqt zonasi qayta hisoblanmaydi.
+    """
+    def __init__(self, tz, schedule: dict, holidays: set):
+        self.tz, self.schedule, self.holidays = tz, schedule, holidays
+        self._open = False
+        self._deadline = 0.0
+        self.next_open = None  # yopiq bo'lsa keyingi ochilish (mahalliy vaqt)
+    def _intervals(self, today):
+        # kechagi kundan boshlanadi: tungi smena yarim tundan keyin ham davom etishi mumkin
+        for offset in range(-1, 15):
+            day = today + timedelta(days=offset)
+            hours = self.schedule.get(day.weekday())
+            if hours and day.isoformat() not in self.holidays:
+                midnight = datetime(day.year, day.month, day.day)
+                yield (self.tz.localize(midnight + timedelta(minutes=hours[0])), self.tz.localize(midnight + timedelta(minutes=hours[1])))
+    def _compute(self):
+        now = datetime.now(self.tz)
+        self._open, transition, self.next_open = False, now + timedelta(hours=1), None
+        for start, end in self._intervals(now.date()):
+            if start <= now < end:
+                self._open, transition = True, end
+                break
+            if now < start:
+                transition = self.next_open = start
+                break
+        self._deadline = time.monotonic() + (transition - now).total_seconds()
+    def is_open(self) -> bool:
+        if time.monotonic() >= self._deadline:
+            self._compute()
+        return self._open
+    def seconds_to_transition(self) -> float:
+        self.is_open()
+        return max(0.0, self._deadline - time.monotonic())
+    def hours_text(self) -> str:
+        today = self.schedule.get(datetime.now(self.tz).weekday())
+        if not today:
+            return "bugun dam olish kuni"
+        end = today[1] if today[1] <= 1440 else today[1] - 1440
+        return "{:02d}:{:02d}-{:02d}:{:02d}".format(*divmod(today[0], 60), *divmod(end, 60))
+    def closed_text(self) -> str:
+        text = f"⏰ Bot ish vaqti: {self.hours_text()}."
+        if self.next_open:
+            text += f" Bot {self.next_open:%d.%m %H:%M} da ishlay boshlaydi."
+        return text
+business_hours = BusinessHours(WORK_TZ, parse_work_schedule(WORK_SCHEDULE), {d.strip() for d in WORK_HOLIDAYS.split(",") if d.strip()})
+KB_NOTIFY_OPEN = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔔 Ish vaqti boshlanganda xabar bering", callback_data="bh_notify")]])
+def defer_request(chat_id: int, kind: str, payload: str = ""):
+    # ish vaqtidan tashqari so'rov: ochilish vaqtida business_hours_loop yetkazadi
+    with get_db_conn() as conn:
+        conn.execute("INSERT OR IGNORE INTO deferred_requests (chat_id, kind, payload, created) VALUES (?, ?, ?, ?)", (chat_id, kind, payload, time.time()))
+        conn.commit()
+# Ochilishda navbat bir zumda emas, bir tekis tezlikda bo'shatiladi: operatorlarga arizalar DEFERRED_DRAIN_PER_MINUTE
+# tezlikda, foydalanuvchilarga "ish boshlandi" xabarlari esa DEFERRED_NOTIFY_INTERVAL oralig'ida (hamma bir vaqtda qaytmasligi uchun).
+DEFERRED_DRAIN_PER_MINUTE = float(os.getenv("DEFERRED_DRAIN_PER_MINUTE", "6"))
+DEFERRED_NOTIFY_INTERVAL = float(os.getenv("DEFERRED_NOTIFY_INTERVAL", "1"))
+# yetkazilmagan so'rov navbatda qoladi va DEFERRED_RETRY_DELAY * 2^(urinish-1) dan keyin qayta yuboriladi;
+# DEFERRED_MAX_ATTEMPTS urinishdan keyin voz kechiladi (xato logga yoziladi)
+DEFERRED_RETRY_DELAY = int(os.getenv("DEFERRED_RETRY_DELAY", "60"))
+DEFERRED_MAX_ATTEMPTS = int(os.getenv("DEFERRED_MAX_ATTEMPTS", "5"))
+OUT_OF_HOURS_INTAKE = "🌙 Hozir ish vaqtidan tashqari. Arizangizni to'ldirishingiz mumkin: u saqlanadi va ish vaqti boshlanganda adminga yuboriladi."
+OUT_OF_HOURS_ACCEPTED = "🌙 <b>Arizangiz qabul qilindi!</b>\n\nHozir ish vaqtidan tashqari, ariza ish vaqti boshlanganda navbat bilan adminga yuboriladi. Javobni shu yerda olasiz."
+async def defer_submission(callback: types.CallbackQuery, state: FSMContext, kind: str, text: str, files: list = None, order_id: str = None) -> bool:
+    """Ish vaqtidan tashqarida arizani navbatga qo'yadi va True qaytaradi; ish vaqtida hech narsa qilmaydi."""
+    if await is_working_hours():
+        return False
+    chat_id = callback.message.chat.id
+    defer_request(chat_id, "submission", json.dumps({"kind": kind, "text": text, "files": files or [], "order_id": order_id}))
+    await state.clear()
+    await safe_edit_or_send(callback, OUT_OF_HOURS_ACCEPTED, get_main_menu(chat_id))
+    return True
+async def _deliver_deferred(chat_id: int, kind: str, payload: str):
+    if kind == "feedback":
+        await notify_admin(payload, chat_id=chat_id)
+    elif kind == "submission":
+        sub = json.loads(payload)
+        admin_id = assign_operator(chat_id, sub["kind"])
+        await notify_admin(sub["text"], chat_id=chat_id, files=sub["files"], admin_id=admin_id)
+        if sub["order_id"]:
+            asyncio.create_task(send_reminder(sub["order_id"], admin_id))
+    elif kind == "notify":
+        with outbound_priority(PRIORITY_BROADCAST):
+            await bot.send_message(chat_id, "✅ Bot ish vaqti boshlandi! Quyidagi menyudan xizmat tanlang.", reply_markup=get_main_menu(chat_id))
+async def deliver_deferred_requests() -> int:
+    """Navbatni bo'shatadi; qayta urinish kutayotgan so'rovlar sonini qaytaradi."""
+    with get_db_conn() as conn:
+        # operatorga boradigan arizalar birinchi, keyin eslatmalar
+        rows = conn.execute("SELECT id, chat_id, kind, payload, attempts FROM deferred_requests WHERE next_try <= ? ORDER BY kind = 'notify', id",
+                            (time.time(),)).fetchall()
+    delivered = retrying = 0
+    for row_id, chat_id, kind, payload, attempts in rows:
+        if not business_hours.is_open():
+            break
+        try:
+            await _deliver_deferred(chat_id, kind, payload)
+        except Exception as e:
+            attempts += 1
+            with get_db_conn() as conn:
+                if attempts >= DEFERRED_MAX_ATTEMPTS:
+                    logger.error(f"Kechiktirilgan so'rov {row_id} ({kind}, chat {chat_id}) {attempts} urinishdan keyin ham yetkazilmadi, o'chirildi: {e}\n{payload}")
+                    conn.execute("DELETE FROM deferred_requests WHERE id = ?", (row_id,))
+                else:
+                    logger.warning(f"Kechiktirilgan so'rov {row_id} ({kind}) yetkazilmadi, urinish {attempts}/{DEFERRED_MAX_ATTEMPTS}: {e}")
+                    conn.execute("UPDATE deferred_requests SET attempts = ?, next_try = ? WHERE id = ?",
+                                 (attempts, time.time() + DEFERRED_RETRY_DELAY * 2 ** (attempts - 1), row_id))
+                    retrying += 1
+                conn.commit()
+        else:
+            delivered += 1
+            with get_db_conn() as conn:
+                conn.execute("DELETE FROM deferred_requests WHERE id = ?", (row_id,))
+                conn.commit()
+        await asyncio.sleep(DEFERRED_NOTIFY_INTERVAL if kind == "notify" else 60 / DEFERRED_DRAIN_PER_MINUTE)
+    if rows:
+        logger.info(f"Kechiktirilgan so'rovlar: {delivered}/{len(rows)} ta yetkazildi, {retrying} tasi qayta yuboriladi")
+    with get_db_conn() as conn:
+        return conn.execute("SELECT COUNT(*) FROM deferred_requests WHERE attempts > 0").fetchone()[0]
+async def business_hours_loop():
+    while True:
+        pending = 0
+        if business_hours.is_open():
+            pending = await deliver_deferred_requests()
+        # keyingi o'tishgacha uxlaydi (soat surilishi uchun ko'pi bilan 1 soat); qayta urinishlar bo'lsa - ertaroq
+        delay = min(business_hours.seconds_to_transition() + 1, 3600)
+        await asyncio.sleep(min(delay, DEFERRED_RETRY_DELAY) if pending else delay)
 # ----------------- Yordamchilar -----------------
 async def is_working_hours() -> bool:
-    tz = pytz.timezone("Asia/Tashkent")
-    return 7 <= datetime.now(tz).hour < 24
+    return business_hours.is_open()
+# Captcha holatsiz: to'g'ri javob hech qayerda saqlanmaydi, u faqat tugmalardagi HMAC imzoga kiradi.
+# Javob raqamli klaviaturada teriladi: kiritilgan raqamlar callback_data da yuradi, tekshirish esa
+# imzoni kiritilgan son bilan qayta hisoblashdan iborat. Faqat noto'g'ri urinishlar soni serverda
+# (xotirada, CAPTCHA_FAIL_WINDOW davomida) saqlanadi, shuning uchun /start uni nolga tushirmaydi.
+CAPTCHA_TTL = 300  # bitta savolga javob berish muddati (sekund)
+CAPTCHA_MAX_TRIES = 3
+CAPTCHA_FAIL_WINDOW = 86400  # noto'g'ri urinishlar shuncha vaqt eslab qolinadi (sekund)
+CAPTCHA_MAX_DIGITS = 3
+_captcha_failures = {}  # chat_id -> (noto'g'ri urinishlar, birinchisining vaqti, monotonic)
+def _captcha_sig(chat_id: int, exp: int, answer: int) -> str:
+    return hmac.new(CAPTCHA_SECRET, f"{chat_id}:{exp}:{answer}".encode(), hashlib.sha256).hexdigest()[:16]
 def _generate_captcha():
-    a, b = random.randint(2, 9), random.randint(2, 9)
     op = random.choice(["+", "-", "×"])
-    if op == "-":
-        a, b = max(a, b), min(a, b)
+    if op == "+":
+        a, b = random.randint(10, 49), random.randint(10, 49)
+        res = a + b
+    elif op == "-":
+        a, b = random.randint(20, 99), random.randint(2, 19)
         res = a - b
-    elif op == "×":
-        res = a * b
     else:
-        res = a + b
+        a, b = random.randint(2, 9), random.randint(2, 9)
+        res = a * b
     return f"{a} {op} {b} = ?", res
-async def _ask_captcha(message: types.Message, state: FSMContext):
+def captcha_kb(chat_id: int, exp: int, sig: str, entered: str = "") -> InlineKeyboardMarkup:
+    def key(text: str, value: str, action: str = "d"):
+        return InlineKeyboardButton(text=text, callback_data=CaptchaCb(action=action, value=value, exp=exp, sig=sig).pack())
+    digit = lambda d: key(d, (entered + d)[:CAPTCHA_MAX_DIGITS])
+    rows = [[digit(str(d)) for d in range(i, i + 3)] for i in (1, 4, 7)]
+    rows.append([key("⌫", entered[:-1]), digit("0"), key(f"✅ {entered}" if entered else "✅", entered, "ok")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+def captcha_valid(chat_id: int, cb: CaptchaCb) -> bool:
+    return cb.value.isdigit() and hmac.compare_digest(cb.sig, _captcha_sig(chat_id, cb.exp, int(cb.value)))
+def captcha_prompt(chat_id: int):
     text, res = _generate_captcha()
-    await state.set_state(HumanCheck.question)
-    await state.update_data(captcha_text=text, captcha_result=res, captcha_attempts=0)
-    await message.answer(f"🧠 Inson ekanligingizni tasdiqlang:\n<code>{text}</code>\nFaqat son yuboring.", reply_markup=KB_MAIN_REPLY)
+    exp = int(time.time()) + CAPTCHA_TTL
+    return f"🧠 Inson ekanligingizni tasdiqlang:\n<code>{text}</code>\nJavobni tugmalar bilan tering va ✅ ni bosing.", captcha_kb(chat_id, exp, _captcha_sig(chat_id, exp, res))
+def captcha_failures(chat_id: int) -> int:
+    count, first = _captcha_failures.get(chat_id, (0, 0.0))
+    if count and time.monotonic() - first > CAPTCHA_FAIL_WINDOW:
+        del _captcha_failures[chat_id]
+        return 0
+    return count
+def captcha_fail(chat_id: int) -> int:
+    count = captcha_failures(chat_id)
+    first = _captcha_failures[chat_id][1] if count else time.monotonic()
+    _captcha_failures[chat_id] = (count + 1, first)
+    return count + 1
+async def _ask_captcha(message: types.Message):
+    text, kb = captcha_prompt(message.chat.id)
+    await message.answer(text, reply_markup=kb)
 async def safe_edit_or_send(obj, text: str, reply_markup=None):
     try:
         if isinstance(obj, types.CallbackQuery):
@@ -652,17 +2084,61 @@ async def safe_edit_or_send(obj, text: str, reply_markup=None):
 async def get_aiohttp_session():
     async with aiohttp.ClientSession() as session:
         yield session
-async def show_progress(message: types.Message):
-    progress_msg = await message.answer("⏳ Fayl yuklanmoqda va tekshirilmoqda. Iltimos, kuting...")
-    await asyncio.sleep(1)
-    await progress_msg.delete()
-async def check_file_for_virus(file_id: str, content_type: str) -> bool:
+PROGRESS_STAGES = {
+    "queued": "⏳ Fayl qabul qilindi va navbatga qo'yildi...",
+    "scanning": "🔍 Fayl virusga tekshirilmoqda. Iltimos, kuting...",
+}
+class ScanProgress:
+    """Bitta holat xabarini yuboradi va tekshiruv davomida uni joyida tahrirlaydi (navbatda -> tekshirilmoqda -> natija)."""
+    def __init__(self, message: types.Message):
+        self._message = message
+        self._status = None
+        self._stage = None
+        self._lock = asyncio.Lock()
+        # holat xabari tekshiruv bilan parallel yuboriladi, tekshiruvni kutib turmaydi
+        self._sent = asyncio.create_task(self._send_initial())
+    async def _send_initial(self):
+        try:
+            self._status = await self._message.answer(PROGRESS_STAGES["queued"])
+            self._stage = "queued"
+        except Exception as e:
+            logger.error(f"Progress xabarini yuborishda xato: {e}")
+    async def set_stage(self, stage: str):
+        await self._sent
+        async with self._lock:
+            if self._status is None or self._stage in (stage, "done"):
+                return
+            self._stage = stage
+            try:
+                await self._status.edit_text(PROGRESS_STAGES[stage])
+            except Exception as e:
+                logger.debug("Progress xabarini tahrirlashda xato: %s", e)
+    async def finish(self, text: str, reply_markup=None):
+        await self._sent
+        async with self._lock:
+            self._stage = "done"
+            if self._status is not None:
+                try:
+                    await self._status.edit_text(text, reply_markup=reply_markup)
+                    return
+                except Exception as e:
+                    logger.debug("Progress xabarini yakunlashda xato: %s", e)
+            await self._message.answer(text, reply_markup=reply_markup)
+async def check_file_for_virus(file_id: str, content_type: str, progress: ScanProgress = None) -> bool:
     if not VIRUSTOTAL_API_KEY:
         return True
+    start = time.perf_counter()
+    with trace_span("virustotal"):
+        clean = await _scan_with_virustotal(file_id, progress)
+    VT_SECONDS.observe(time.perf_counter() - start, "clean" if clean else "rejected")
+    return clean
+async def _scan_with_virustotal(file_id: str, progress: ScanProgress = None) -> bool:
     try:
         file = await bot.get_file(file_id)
         if file.file_size > 32 * 1024 * 1024:
             return False
+        if progress:
+            asyncio.create_task(progress.set_stage("scanning"))
         file_path = Path(f"temp_{file_id}")
         await bot.download_file(file.file_path, file_path)
         async with get_aiohttp_session() as session:
@@ -691,40 +2167,260 @@ async def check_file_for_virus(file_id: str, content_type: str) -> bool:
     finally:
         if 'file_path' in locals() and file_path.exists():
             file_path.unlink()
+# ----------------- Fayl yuklash (albomlarni yig'ish) -----------------
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "0.8"))  # albom elementlarini kutish oynasi, sekund
+_media_groups = {}  # media_group_id -> [messages]
+_file_locks = {}  # chat_id -> [asyncio.Lock, kutayotganlar soni] (FSM dagi 'files' ro'yxatini himoyalaydi)
+def extract_file(message: types.Message):
+    if message.photo:
+        return "photo", message.photo[-1].file_id
+    if message.video:
+        return "video", message.video.file_id
+    if message.document:
+        return "document", message.document.file_id
+    return None
+async def collect_media_group(message: types.Message):
+    """
+    Albom elementlarini media_group_id bo'yicha yig'adi.
+    Albomning birinchi elementi oynani kutib, butun albomni qaytaradi; qolganlari uchun None qaytadi.
+    """
+    group_id = message.media_group_id
+    if not group_id:
+        return [message]
+    bucket = _media_groups.get(group_id)
+    if bucket is not None:
+        bucket.append(message)
+        return None
+    _media_groups[group_id] = bucket = [message]
+    await asyncio.sleep(MEDIA_GROUP_WINDOW)
+    _media_groups.pop(group_id, None)
+    return sorted(bucket, key=lambda m: m.message_id)
+async def handle_file_upload(message: types.Message, state: FSMContext, back_cb: str, texts: dict):
+    messages = await collect_media_group(message)
+    if messages is None:
+        return
+    items = [f for f in map(extract_file, messages) if f]
+    if not items:
+        await message.answer(texts['invalid'], reply_markup=get_cancel_kb(back_cb))
+        return
+    progress = ScanProgress(message)
+    results = await asyncio.gather(*(check_file_for_virus(fid, ctype, progress) for ctype, fid in items))
+    clean = [item for item, ok in zip(items, results) if ok]
+    if clean:
+        chat_id = message.chat.id
+        entry = _file_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                data = await state.get_data()
+                await state.update_data(files=data.get('files', []) + clean)
+        finally:
+            # oxirgi foydalanuvchi qulfni olib tashlaydi, lug'at faqat hozir yuklayotgan chatlar bilan cheklanadi
+            entry[1] -= 1
+            if not entry[1]:
+                _file_locks.pop(chat_id, None)
+    text = texts['clean'] if clean else texts['rejected']
+    if len(items) > 1:
+        text = f"📎 Albom: {len(clean)}/{len(items)} ta fayl qabul qilindi.\n{text}"
+    await progress.finish(text, KB_FILE_DONE if clean else get_cancel_kb(back_cb))
+# ----------------- Arizalarni adminga yuborish -----------------
+MEDIA_GROUP_LIMIT = 10  # send_media_group bir chaqiruvda qabul qiladigan maksimal element
+CAPTION_LIMIT = 1024
+def _input_media(ctype: str, file_id: str, caption: str = None):
+    if ctype == "photo":
+        return types.InputMediaPhoto(media=file_id, caption=caption)
+    if ctype == "video":
+        return types.InputMediaVideo(media=file_id, caption=caption)
+    return types.InputMediaDocument(media=file_id, caption=caption)
+async def _send_single_file(chat_id: int, ctype: str, file_id: str, caption: str = None):
+    if ctype == "photo":
+        await bot.send_photo(chat_id, file_id, caption=caption)
+    elif ctype == "video":
+        await bot.send_video(chat_id, file_id, caption=caption)
+    else:
+        await bot.send_document(chat_id, file_id, caption=caption)
+async def send_submission(chat_id: int, summary: str, files: list):
+    """
+    Ariza matni va fayllarini albomlar bilan yuboradi: rasm/video va hujjatlar alohida
+    guruhlanadi (Telegram ularni aralashtirishga ruxsat bermaydi), har bir guruh 10 tagacha,
+    matn esa birinchi albomga izoh sifatida qo'shiladi.
+    """
+    visual = [f for f in files if f[0] in ("photo", "video")]
+    docs = [f for f in files if f[0] not in ("photo", "video")]
+    batches = [visual[i:i + MEDIA_GROUP_LIMIT] for i in range(0, len(visual), MEDIA_GROUP_LIMIT)]
+    batches += [docs[i:i + MEDIA_GROUP_LIMIT] for i in range(0, len(docs), MEDIA_GROUP_LIMIT)]
+    caption = summary if batches and len(summary) <= CAPTION_LIMIT else None
+    if caption is None:
+        await bot.send_message(chat_id, summary)
+    for i, batch in enumerate(batches):
+        cap = caption if i == 0 else None
+        try:
+            if len(batch) == 1:
+                await _send_single_file(chat_id, *batch[0], caption=cap)
+            else:
+                await bot.send_media_group(chat_id, [_input_media(c, f, cap if j == 0 else None) for j, (c, f) in enumerate(batch)])
+        except Exception as e:
+            logger.error(f"Fayl xato: {e}")
+            if cap:
+                await bot.send_message(chat_id, summary)
+# ----------------- Admin bildirishnomalari (digest rejimi) -----------------
+ADMIN_DIGEST_INTERVAL = int(os.getenv("ADMIN_DIGEST_INTERVAL", "0"))  # sekund; 0 - digest o'chirilgan, hammasi darhol yuboriladi
+DIGEST_PAGE_SIZE = 8
+DIGEST_PAGE_CHARS = 3500
+DIGEST_KEEP = 20  # xotirada saqlanadigan oxirgi digestlar soni
+_digest_buffer = {}  # admin_id -> [{'text': str, 'chat_id': int|None, 'ts': float}]
+admin_digests = {}  # digest_id -> [page entries]
+_digest_seq = itertools.count(1)
+async def notify_admin(text: str, chat_id: int = None, files: list = None, urgent: bool = False, reply_markup=None, admin_id: int = None):
+    """
+    Adminga (admin_id berilmasa - bot egasiga) bildirishnoma yuboradi. Digest rejimida shoshilinch bo'lmagan,
+    faylsiz bildirishnomalar buferga yig'iladi va har ADMIN_DIGEST_INTERVAL sekundda sahifalangan bitta xabar bo'lib yuboriladi.
+    """
+    admin_id = admin_id or ADMIN_ID
+    if urgent or files or not ADMIN_DIGEST_INTERVAL or len(text) > DIGEST_PAGE_CHARS:
+        if files:
+            await send_submission(admin_id, text, files)
+        else:
+            await bot.send_message(admin_id, text, reply_markup=reply_markup)
+        return
+    _digest_buffer.setdefault(admin_id, []).append({'text': text, 'chat_id': chat_id, 'ts': time.time()})
+def _paginate_digest(entries: list) -> list:
+    pages, page, size = [], [], 0
+    for entry in entries:
+        if page and (len(page) >= DIGEST_PAGE_SIZE or size + len(entry['text']) > DIGEST_PAGE_CHARS):
+            pages.append(page)
+            page, size = [], 0
+        page.append(entry)
+        size += len(entry['text'])
+    if page:
+        pages.append(page)
+    return pages
+def render_digest_page(digest_id: int, page_no: int):
+    pages = admin_digests.get(digest_id)
+    if not pages or not 0 <= page_no < len(pages):
+        return None, None
+    total = sum(len(p) for p in pages)
+    first = sum(len(p) for p in pages[:page_no])
+    text = f"🗂 <b>Bildirishnomalar to'plami #{digest_id}</b> ({total} ta, sahifa {page_no + 1}/{len(pages)})\n\n"
+    buttons = []
+    for idx, entry in enumerate(pages[page_no], start=first + 1):
+        ts = datetime.fromtimestamp(entry['ts']).strftime('%H:%M')
+        text += f"<b>{idx}.</b> [{ts}] {entry['text']}\n\n"
+        if entry['chat_id']:
+            buttons.append(InlineKeyboardButton(text=f"💬 {idx}", callback_data=UserActionCb(action="chat", user_id=entry['chat_id']).pack()))
+    kb_rows = [buttons[i:i + 4] for i in range(0, len(buttons), 4)]
+    nav = []
+    if page_no > 0:
+        nav.append(InlineKeyboardButton(text="⬅️ Oldingi", callback_data=DigestCb(digest_id=digest_id, page=page_no - 1).pack()))
+    if page_no + 1 < len(pages):
+        nav.append(InlineKeyboardButton(text="➡️ Keyingi", callback_data=DigestCb(digest_id=digest_id, page=page_no + 1).pack()))
+    if nav:
+        kb_rows.append(nav)
+    return text, InlineKeyboardMarkup(inline_keyboard=kb_rows)
+async def flush_admin_digest():
+    for admin_id in list(_digest_buffer):
+        entries = _digest_buffer.pop(admin_id)
+        if not entries:
+            continue
+        digest_id = next(_digest_seq)
+        admin_digests[digest_id] = _paginate_digest(entries)
+        while len(admin_digests) > DIGEST_KEEP * max(1, len(ADMINS)):
+            admin_digests.pop(next(iter(admin_digests)))
+        text, kb = render_digest_page(digest_id, 0)
+        try:
+            await bot.send_message(admin_id, text, reply_markup=kb)
+        except Exception as e:
+            logger.error(f"Digest #{digest_id} yuborilmadi: {e}")
+async def admin_digest_loop():
+    while True:
+        await asyncio.sleep(ADMIN_DIGEST_INTERVAL)
+        await flush_admin_digest()
 async def send_waiting_reminder(chat_id: int, service: str):
     await asyncio.sleep(300)
     try:
-        await bot.send_message(chat_id, f"⌛ Iltimos, kutib turing. Sizning {service} so'rovingiz hozir ko'rib chiqilmoqda. Javob tez orada keladi.")
-    except:
-        pass
+        with outbound_priority(PRIORITY_REMINDER):
+            await bot.send_message(chat_id, f"⌛ Iltimos, kutib turing. Sizning {service} so'rovingiz hozir ko'rib chiqilmoqda. Javob tez orada keladi.")
+    except Exception as e:
+        logger.warning(f"Eslatma yuborilmadi ({chat_id}): {e}")
 async def auto_reset_state(state: FSMContext, chat_id: int, service: str):
     await asyncio.sleep(900)
     cur_state = await state.get_state()
+    if not is_in_chat(chat_id):
+        release_assignment(chat_id)
     if cur_state and str(cur_state).endswith('.waiting_reply'):
         await state.clear()
         try:
-            await bot.send_message(chat_id, f"⌛ 15 daqiqa ichida javob kelmadi. {service} so'rovingiz bekor qilindi. Bosh menyuga qaytildi.", reply_markup=get_main_menu(chat_id))
-        except:
-            pass
-async def send_reminder(order_id: str):
+            with outbound_priority(PRIORITY_REMINDER):
+                await bot.send_message(chat_id, f"⌛ 15 daqiqa ichida javob kelmadi. {service} so'rovingiz bekor qilindi. Bosh menyuga qaytildi.", reply_markup=get_main_menu(chat_id))
+        except Exception as e:
+            logger.warning(f"Avto-bekor xabari yuborilmadi ({chat_id}): {e}")
+async def send_reminder(order_id: str, admin_id: int = None):
     await asyncio.sleep(300)
     try:
-        await bot.send_message(ADMIN_ID, f"⌛ Eslatma: Buyurtma ID {order_id} ga hali javob berilmagan. Iltimos, ko'rib chiqing.")
-    except:
-        pass
+        with outbound_priority(PRIORITY_REMINDER):
+            await notify_admin(f"⌛ Eslatma: Buyurtma ID {order_id} ga hali javob berilmagan. Iltimos, ko'rib chiqing.", admin_id=admin_id)
+    except Exception as e:
+        logger.warning(f"Buyurtma {order_id} eslatmasi yuborilmadi: {e}")
 async def send_buyurtma_preview(obj, state: FSMContext):
-    data = await state.get_data()
-    loc = data.get('location', {})
-    caption = (
-        f"🧾 Buyurtma ma'lumotlari:\n"
-        f"🏘️ Mahalla: {data.get('mahalla', 'Kiritilmagan')}\n"
-        f"📝 Qo'shimcha ma'lumot: {data.get('malumot', 'Kiritilmagan')}\n"
-        f"📶 Operator: {data.get('operator', 'Kiritilmagan')}\n"
-        f"📍 Joylashuv: {loc.get('lat', 'N/A')}, {loc.get('lon', 'N/A')}\n"
-        f"📞 Bog'lanish usuli: {data.get('phone', 'Kiritilmagan')}\n\n"
-        f"Bu ma'lumotlar to'g'ri va to'liqmi? Agar yo'q bo'lsa, tahrirlang."
-    )
-    await safe_edit_or_send(obj, caption, KB_CONFIRM_SEND)
+    await safe_edit_or_send(obj, *_buyurtma_preview(await state.get_data()))
+# ----------------- Kanal obunasi (kesh) -----------------
+SUB_TTL_MEMBER = int(os.getenv("SUB_TTL_MEMBER", "21600"))  # obunachi natijasi yangi hisoblanadigan vaqt (sekund)
+SUB_TTL_NONMEMBER = int(os.getenv("SUB_TTL_NONMEMBER", "60"))  # obuna bo'lmagan natija uchun qisqa TTL
+SUB_STALE_GRACE = int(os.getenv("SUB_STALE_GRACE", "86400"))  # eskirgan natija fonda yangilanguncha ishlatilishi mumkin bo'lgan vaqt
+SUB_CACHE_SIZE = int(os.getenv("SUB_CACHE_SIZE", "10000"))
+_sub_cache = OrderedDict()  # user_id -> (is_member, checked_at) (LRU)
+_sub_inflight = {}  # user_id -> Task: bir foydalanuvchi uchun parallel get_chat_member so'rovlari birlashtiriladi
+def cache_subscription(user_id: int, is_member: bool):
+    _sub_cache[user_id] = (is_member, time.monotonic())
+    _sub_cache.move_to_end(user_id)
+    if len(_sub_cache) > SUB_CACHE_SIZE:
+        _sub_cache.popitem(last=False)
+async def _fetch_subscription(user_id: int) -> bool:
+    member = await bot.get_chat_member(REQUIRED_CHANNEL, user_id)
+    is_member = member.status not in ("left", "kicked")
+    cache_subscription(user_id, is_member)
+    return is_member
+def _refresh_subscription(user_id: int) -> asyncio.Task:
+    task = _sub_inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_fetch_subscription(user_id))
+        _sub_inflight[user_id] = task
+        task.add_done_callback(lambda t: _sub_inflight.pop(user_id, None))
+    return task
+def _background_refresh_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.warning(f"Obuna fonda yangilanmadi: {task.exception()}")
+async def is_subscribed(user_id: int, force: bool = False):
+    """
+    REQUIRED_CHANNEL obunasini kesh orqali tekshiradi. True/False, yoki Telegram javob bermasa va keshda
+    hech narsa bo'lmasa None. Yangi natija darhol qaytadi; eskirgan (SUB_STALE_GRACE ichida) natija ham
+    qaytadi, lekin fonda yangilanadi. force=True bo'lsa (foydalanuvchi "Obuna bo'ldim" tugmasini bosganda)
+    har doim Telegram'dan so'raladi, xato bo'lsa keshdagi qiymatga qaytiladi.
+    """
+    if not REQUIRED_CHANNEL:
+        return True
+    cached = _sub_cache.get(user_id)
+    if cached is not None and not force:
+        is_member, checked_at = cached
+        age = time.monotonic() - checked_at
+        ttl = SUB_TTL_MEMBER if is_member else SUB_TTL_NONMEMBER
+        if age < ttl:
+            _sub_cache.move_to_end(user_id)
+            return is_member
+        if is_member and age < ttl + SUB_STALE_GRACE:
+            _refresh_subscription(user_id).add_done_callback(_background_refresh_done)
+            return is_member
+    try:
+        return await _refresh_subscription(user_id)
+    except Exception as e:
+        logger.error(f"Obuna xato: {e}")
+        return cached[0] if cached is not None else None
+def _is_required_channel(chat: types.Chat) -> bool:
+    return REQUIRED_CHANNEL in (str(chat.id), f"@{chat.username}")
+@dp.chat_member(F.chat.func(_is_required_channel))
+async def required_channel_member_update(event: types.ChatMemberUpdated):
+    # bot kanal admini bo'lsa, Telegram a'zolik o'zgarishlarini yuboradi: kesh darhol yangilanadi
+    cache_subscription(event.new_chat_member.user.id, event.new_chat_member.status not in ("left", "kicked"))
 # ----------------- Handlers -----------------
 @dp.message(Command("start"))
 async def start_cmd(message: types.Message, state: FSMContext):
@@ -735,24 +2431,20 @@ async def start_cmd(message: types.Message, state: FSMContext):
         await message.answer("❌ Siz botdan bloklangansiz. Savollaringiz bo'lsa, admin bilan bog'laning.+998955954727")
         return
     if not await is_working_hours():
-        await message.answer("⏰ Bot ish vaqti: 07:00 dan 24:00 gacha. Ertaga qayta urinib ko'ring.")
+        # ish vaqtidan tashqarida ham arizalar qabul qilinadi (ochilishda navbat bilan yuboriladi)
+        await message.answer(f"{business_hours.closed_text()}\n\n{OUT_OF_HOURS_INTAKE}", reply_markup=KB_NOTIFY_OPEN)
+    subscribed = await is_subscribed(message.from_user.id)
+    if subscribed is None:
+        await message.answer("❌ Obuna tekshirishda texnik xato yuz berdi. Qayta urinib ko'ring yoki admin bilan bog'laning.")
         return
-    data = await state.get_data()
-    if REQUIRED_CHANNEL:
-        try:
-            member = await bot.get_chat_member(REQUIRED_CHANNEL, message.from_user.id)
-            if member.status in ("left", "kicked"):
-                await message.answer(f"❗ Botdan foydalanish uchun {REQUIRED_CHANNEL} kanaliga obuna bo'ling va obuna bo'lganingizni tasdiqlang.", reply_markup=KB_SUBSCRIPTION)
-                return
-        except Exception as e:
-            logger.error(f"Obuna xato: {e}")
-            await message.answer("❌ Obuna tekshirishda texnik xato yuz berdi. Qayta urinib ko'ring yoki admin bilan bog'laning.")
-            return
-    if not data.get("verified"):
-        await _ask_captcha(message, state)
+    if not subscribed:
+        await message.answer(f"❗ Botdan foydalanish uchun {REQUIRED_CHANNEL} kanaliga obuna bo'ling va obuna bo'lganingizni tasdiqlang.", reply_markup=KB_SUBSCRIPTION)
+        return
+    if not is_verified(chat_id):
+        await _ask_captcha(message)
         return
     profile = get_chat_profile(chat_id)
-    name = profile.get('ism_familya', message.from_user.first_name) if profile else message.from_user.first_name
+    name = (profile and profile.ism_familya) or message.from_user.first_name
     await message.answer(f"👋 Xush kelibsiz, {name}! Bot orqali quyidagi xizmatlardan foydalanishingiz mumkin:\n\nQuyidagi tugmalardan birini tanlang va  ko'rsatmalarga amal qiling.", reply_markup=get_main_menu(chat_id))
 @dp.callback_query(F.data == "check_subscription")
 async def check_subscription(callback: types.CallbackQuery, state: FSMContext):
@@ -762,22 +2454,16 @@ async def check_subscription(callback: types.CallbackQuery, state: FSMContext):
     if is_banned(chat_id):
         await callback.answer("❌ Siz botdan bloklangansiz!", show_alert=True)
         return
-    if not await is_working_hours():
-        await callback.answer("⏰ Bot ish vaqti: 07:00-24:00", show_alert=True)
-        return
-    try:
-        member = await bot.get_chat_member(REQUIRED_CHANNEL, callback.from_user.id)
-        if member.status in ("left", "kicked"):
-            await safe_edit_or_send(callback, f"❌ Hali {REQUIRED_CHANNEL} kanaliga obuna bo'lmagansiz. Obuna bo'ling va 'Obuna bo'ldim' tugmasini bosing.", KB_SUBSCRIPTION)
-        else:
-            data = await state.get_data()
-            if not data.get("verified"):
-                await _ask_captcha(callback.message, state)
-            else:
-                await safe_edit_or_send(callback, "🎉 Obuna muvaffaqiyatli tasdiqlandi! Endi bot xizmatlaridan foydalanishingiz mumkin. Quyidagi menyudan xizmat tanlang.", get_main_menu(chat_id))
-    except Exception as e:
-        logger.error(f"Obuna xato: {e}")
+    subscribed = await is_subscribed(callback.from_user.id, force=True)
+    if subscribed is None:
         await callback.answer("❌ Obuna tekshirishda xato yuz berdi. Qayta urinib ko'ring.", show_alert=True)
+    elif not subscribed:
+        await safe_edit_or_send(callback, f"❌ Hali {REQUIRED_CHANNEL} kanaliga obuna bo'lmagansiz. Obuna bo'ling va 'Obuna bo'ldim' tugmasini bosing.", KB_SUBSCRIPTION)
+    else:
+        if not is_verified(chat_id):
+            await _ask_captcha(callback.message)
+        else:
+            await safe_edit_or_send(callback, "🎉 Obuna muvaffaqiyatli tasdiqlandi! Endi bot xizmatlaridan foydalanishingiz mumkin. Quyidagi menyudan xizmat tanlang.", get_main_menu(chat_id))
 @dp.callback_query(F.data == "back_main")
 async def back_main(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
@@ -797,58 +2483,72 @@ async def feedback_start(cb: types.CallbackQuery, state: FSMContext):
     chat_id = cb.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
+    await state.set_state(Feedback.waiting)
     if not await is_working_hours():
-        await cb.message.answer("⏰ Bot ish vaqti: 07:00-24:00. Ertaga fikringizni yuboring.")
+        await safe_edit_or_send(cb, f"{business_hours.closed_text()}\n\n💬 Fikringizni hozir yozib qoldirishingiz mumkin, u ish vaqti boshlanganda adminga yetkaziladi.", get_cancel_kb())
         return
-    await state.set_state(Feedback.waiting)
     await safe_edit_or_send(cb, "💬 Iltimos fikr mulohazangizni qoldiring,bu biz uchin muhim", get_cancel_kb())
-@dp.message(StateFilter(Feedback.waiting))
+@dp.message(StateFilter(Feedback.waiting), flags={"throttle": "feedback"})
 async def handle_feedback(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     user_text = message.text or ""
     profile = get_chat_profile(chat_id)
-    profile_text = f"\n👤 Ism: {profile.get('ism_familya', '')} | 📞 Telefon: {profile.get('telefon', '')} | 🏙️ Tuman/Mahalla: {profile.get('tuman_mahalla', '')}" if profile else ""
+    profile_text = profile.admin_summary if profile else ""
     user_name = message.from_user.full_name or message.from_user.username or 'Noma\'lum'
-    await bot.send_message(ADMIN_ID, f"💬 Foydalanuvchi fikri:\n👤 Foydalanuvchi: {user_name}{profile_text}\n\n📝 Fikr matni:\n{user_text}\n\n🆔 Chat ID: {chat_id}")
+    admin_text = f"💬 Foydalanuvchi fikri:\n👤 Foydalanuvchi: {user_name}{profile_text}\n\n📝 Fikr matni:\n{user_text}\n\n🆔 Chat ID: {chat_id}"
+    if await is_working_hours():
+        await notify_admin(admin_text, chat_id=chat_id)
+    else:
+        defer_request(chat_id, "feedback", admin_text)
     save_action({'type': 'fikr', 'chat_id': chat_id, 'details': user_text})
     await message.answer("✅ Fikr takliflaringiz uchun katta rahmat!,sizning fikringiz biz uchun muhim", reply_markup=get_main_menu(chat_id))
     await state.clear()
-@dp.message(StateFilter(HumanCheck.question))
-async def human_check_answer(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    data = await state.get_data()
-    correct = data.get("captcha_result")
-    attempts = data.get("captcha_attempts", 0)
-    try:
-        user_val = int(message.text.strip())
-    except ValueError:
-        attempts += 1
-        await state.update_data(captcha_attempts=attempts)
-        if attempts >= 3:
-            set_banned(chat_id, True)
-            await message.reply("❌ Noto'g'ri urinishlar soni ko'p. Siz botdan banlangansiz.")
-            await state.clear()
-            return
-        await message.reply("❌ Faqat son yuboring. Qayta urinib ko'ring.")
+@dp.callback_query(CaptchaCb.filter())
+async def captcha_answer(callback: types.CallbackQuery, callback_data: CaptchaCb):
+    chat_id = callback.message.chat.id
+    if is_verified(chat_id):
+        await callback.answer()
+        await safe_edit_or_send(callback, "✅ Siz allaqachon tasdiqlangansiz.", get_main_menu(chat_id))
         return
-    if user_val == correct:
-        await state.update_data(verified=True)
-        await state.clear()
-        await message.answer("✅ Sizning inson ekanligingiz tasdiqlandi! Endi bot xizmatlaridan to'liq foydalanishingiz mumkin. Quyidagi menyudan xizmat tanlang.", reply_markup=get_main_menu(chat_id))
-    else:
-        attempts += 1
-        await state.update_data(captcha_attempts=attempts)
-        if attempts >= 3:
-            set_banned(chat_id, True)
-            await message.reply("❌ Noto'g'ri urinishlar soni ko'p. Siz botdan banlangansiz.")
-            await state.clear()
-            return
-        await message.reply("❌ Javob noto'g'ri. Qayta urinib ko'ring.")
-        await _ask_captcha(message, state)
+    if callback_data.exp < time.time():
+        await callback.answer("⌛ Savol muddati tugadi, yangisiga javob bering.")
+        await safe_edit_or_send(callback, *captcha_prompt(chat_id))
+        return
+    if callback_data.action != "ok":
+        # raqam terish: faqat klaviatura yangilanadi, imzo va muddat o'zgarmaydi
+        await callback.answer()
+        try:
+            await callback.message.edit_reply_markup(reply_markup=captcha_kb(chat_id, callback_data.exp, callback_data.sig, callback_data.value))
+        except aiogram.exceptions.TelegramBadRequest:
+            pass  # klaviatura o'zgarmagan (masalan, bo'sh maydonda ⌫)
+        return
+    if not callback_data.value:
+        await callback.answer("✍️ Avval javobni tering.")
+        return
+    if captcha_valid(chat_id, callback_data):
+        _captcha_failures.pop(chat_id, None)
+        mark_verified(chat_id)
+        await callback.answer()
+        await safe_edit_or_send(callback, "✅ Sizning inson ekanligingiz tasdiqlandi! Endi bot xizmatlaridan to'liq foydalanishingiz mumkin. Quyidagi menyudan xizmat tanlang.", get_main_menu(chat_id))
+        return
+    if captcha_fail(chat_id) >= CAPTCHA_MAX_TRIES:
+        _captcha_failures.pop(chat_id, None)
+        set_banned(chat_id, True)
+        await callback.answer()
+        await safe_edit_or_send(callback, "❌ Noto'g'ri urinishlar soni ko'p. Siz botdan banlangansiz.")
+        return
+    await callback.answer("❌ Javob noto'g'ri. Qayta urinib ko'ring.")
+    await safe_edit_or_send(callback, *captcha_prompt(chat_id))
+@dp.callback_query(F.data == "bh_notify")
+async def notify_when_open(callback: types.CallbackQuery):
+    chat_id = callback.message.chat.id
+    if await is_working_hours():
+        await safe_edit_or_send(callback, "✅ Bot hozir ishlayapti. Quyidagi menyudan xizmat tanlang.", get_main_menu(chat_id))
+        return
+    defer_request(chat_id, "notify")
+    await callback.answer("🔔 Ish vaqti boshlanganda sizga xabar beramiz.", show_alert=True)
 @dp.callback_query(F.data == "about_bot")
 async def about_bot(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
@@ -863,118 +2563,65 @@ Bu bot mobil aloqa xizmatlari bilan bog'liq masalalar uchun mo'ljallangan:
 • <b>💬 Fikr bildirish:</b> Bot haqida fikr va takliflaringizni yuborish.
 • <b>👤 Profil:</b> Shaxsiy ma'lumotlaringizni saqlash va tahrirlash (maxfiylik kafolatlangan).
 • <b>📞 Admin bilan chat:</b> Real vaqtda savol-javob uchun suhbat.
-<b>Diqqat:</b> Ma'lumotlarni to'g'ri va to'liq kiriting. Noto'g'ri arizalar ko'rib chiqilmaydi. Ish vaqti: 07:00–24:00.
+<b>Diqqat:</b> Ma'lumotlarni to'g'ri va to'liq kiriting. Noto'g'ri arizalar ko'rib chiqilmaydi. Ish vaqti: {hours}.
 Agar muammo yuzaga kelsa, admin bilan bog'laning.
-"""
+""".format(hours=business_hours.hours_text())
     await safe_edit_or_send(callback, text, get_main_menu(chat_id))
 # ----------------- Profil -----------------
-@dp.callback_query(F.data == "profil")
+@profil_router.callback_query(F.data == "profil")
 async def profil_start(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
-    if not await is_working_hours():
-        await callback.message.answer("⏰ Bot ish vaqti: 07:00-24:00. Ertaga urinib ko'ring.")
-        return
     profile = get_chat_profile(chat_id)
     if profile:
         text = (
             f"👤 <b>Sizning profil ma'lumotlaringiz:</b>\n\n"
-            f"👤 Ism va familiya: {profile.get('ism_familya', 'Kiritilmagan')}\n"
-            f"📞 Telefon raqami: {profile.get('telefon', 'Kiritilmagan')}\n"
-            f"🏙️ Tuman yoki mahalla: {profile.get('tuman_mahalla', 'Kiritilmagan')}\n\n"
+            f"👤 Ism va familiya: {profile.ism_familya or 'Kiritilmagan'}\n"
+            f"📞 Telefon raqami: {profile.telefon or 'Kiritilmagan'}\n"
+            f"🏙️ Tuman yoki mahalla: {profile.tuman_mahalla or 'Kiritilmagan'}\n\n"
             f"Quyidagi tugmalardan profilni tahrirlash yoki o'chirishni tanlang."
         )
         await safe_edit_or_send(callback, text, KB_PROFIL_MENU)
     else:
         await safe_edit_or_send(callback, "📝 <b>Profil yaratish:</b>\n\nShaxsiy ma'lumotlaringizni saqlashga rozimisiz. Bu ma'lumotlar faqat xizmat uchun ishlatiladi va maxfiy saqlanadi. Ma'lumotlaringizni saqlashga rozimisiz? (Agar rozi bo'lmasangiz, har safar qo'lda kiritishingiz mumkin.)", KB_PROFIL_CONSENT)
-@dp.callback_query(F.data == "profil_consent_yes")
+@profil_router.callback_query(F.data == "profil_consent_yes")
 async def profil_consent_yes(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(Profil.ism_familya)
     await safe_edit_or_send(callback, "👤 <b>Profil yaratish bosqichi 1/3:</b>\n\nIsm va familiyangizni to'liq kiriting (masalan: 'Quvvatov Og'abek Baxtiyor O'g'li'):", get_cancel_kb())
-@dp.callback_query(F.data == "profil_consent_no")
+@profil_router.callback_query(F.data == "profil_consent_no")
 async def profil_consent_no(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await safe_edit_or_send(callback, "❌ <b>Profil saqlash bekor qilindi.</b>\n\nProfil sizda mavjud emas. Xizmatlardan foydalanishda har safar ma'lumotlarni qo'lda kiritishingiz mumkin. Bosh menyuga qaytish uchun tugmani bosing.", get_main_menu(chat_id))
-@dp.message(StateFilter(Profil.ism_familya))
-async def profil_ism_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    ism = message.text.strip()
-    if not ism or len(ism) < 2:
-        await message.reply("❌ Ism va familiya to'liq va to'g'ri kiriting. Kamida 2 harf bo'lishi kerak. Qayta urinib ko'ring.", reply_markup=get_cancel_kb())
-        return
-    await state.update_data(ism_familya=ism)
-    await state.set_state(Profil.telefon)
-    await message.answer("📞 <b>Profil yaratish bosqichi 2/3:</b>\n\nTelefon raqamingizni kiriting (masalan: +99895....47). Faqat O'zbekiston raqamlari qabul qilinadi.", reply_markup=get_cancel_kb())
-@dp.message(StateFilter(Profil.telefon))
-async def profil_telefon_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    phone = message.text.strip()
-    if not re.fullmatch(r"\+?\d{9,15}", phone):
-        await message.reply("❌ Telefon raqami noto'g'ri formatda. +998 bilan boshlanishi va 9-12 xonali raqam bo'lishi kerak. Qayta kiriting.", reply_markup=get_cancel_kb())
-        return
-    await state.update_data(telefon=phone)
-    await state.set_state(Profil.tuman_mahalla)
-    await message.answer("🏙️ <b>Profil yaratish bosqichi 3/3:</b>\n\nTuman yoki mahallangizni kiriting (masalan: 'sherobod tumani, katta hayot mahallasi'):", reply_markup=get_cancel_kb())
-@dp.message(StateFilter(Profil.tuman_mahalla))
-async def profil_tuman_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    tuman = message.text.strip()
-    if not tuman or len(tuman) < 2:
-        await message.reply("❌ Tuman yoki mahalla nomini to'liq kiriting. Qayta urinib ko'ring.", reply_markup=get_cancel_kb())
-        return
-    await state.update_data(tuman_mahalla=tuman)
-    await state.set_state(Profil.confirm)
-    data = await state.get_data()
-    text = (
-        f"👤 <b>Profil ma'lumotlarini tasdiqlash:</b>\n\n"
-        f"👤 Ism va familiya: {data['ism_familya']}\n"
-        f"📞 Telefon raqami: {data['telefon']}\n"
-        f"🏙️ Tuman yoki mahalla: {data['tuman_mahalla']}\n\n"
-        f"<i>Bu ma'lumotlar to'g'ri va to'liqmi? Agar ha bo'lsa, saqlang. Yo'q bo'lsa, tahrirlang.</i>\n\n"
-        f"<b>Eslatma:</b> Profil ma'lumotlari maxfiy saqlanadi va faqat xizmat uchun ishlatiladi."
-    )
-    await message.answer(text, reply_markup=KB_CONFIRM_PROFIL)
-@dp.callback_query(StateFilter(Profil.confirm), F.data == "profil_confirm_yes")
+@profil_router.callback_query(StateFilter(Profil.confirm), F.data == "profil_confirm_yes")
 async def profil_confirm_yes(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     data = await state.get_data()
-    profile = {
-        "ism_familya": data.get("ism_familya", ""),
-        "telefon": data.get("telefon", ""),
-        "tuman_mahalla": data.get("tuman_mahalla", ""),
-    }
-    set_chat_profile(chat_id, profile)
+    set_chat_profile(chat_id, Profile(*(data.get(col, "") for col in PROFILE_FIELDS)))
     await state.clear()
     await safe_edit_or_send(callback, "✅ <b>Profil muvaffaqiyatli saqlandi!</b>\n\nEndi xizmatlardan foydalanganda ma'lumotlar avtomatik to'ldiriladi. Boshqa o'zgarishlar uchun profil bo'limiga qayting.", get_main_menu(chat_id))
-@dp.callback_query(StateFilter(Profil.confirm), F.data == "profil_confirm_edit")
+@profil_router.callback_query(StateFilter(Profil.confirm), F.data == "profil_confirm_edit")
 async def profil_confirm_edit(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(Profil.ism_familya)
     await safe_edit_or_send(callback, "👤 <b>Ma'lumotlarni tahrirlash:</b>\n\nIsm va familiyangizni qayta kiriting:", get_cancel_kb())
-@dp.callback_query(F.data == "profil_delete")
+@profil_router.callback_query(F.data == "profil_delete")
 async def profil_delete_confirm(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(Profil.delete_confirm)
     await safe_edit_or_send(callback, "🗑️ <b>Profilni o'chirish tasdiqlash:</b>\n\n<b>Ogohlantirish:</b> Profilni o'chirish saqlangan barcha ma'lumotlaringizni (ism, telefon, tuman/mahalla) o'chiradi. Xizmatlardan foydalanishda ularni qayta kiritishingiz kerak bo'ladi. Rostan profilni o'chirishni xohlaysizmi?", KB_DELETE_CONFIRM)
-@dp.callback_query(StateFilter(Profil.delete_confirm), F.data == "profil_delete_yes")
+@profil_router.callback_query(StateFilter(Profil.delete_confirm), F.data == "profil_delete_yes")
 async def profil_delete_yes(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -982,21 +2629,21 @@ async def profil_delete_yes(callback: types.CallbackQuery, state: FSMContext):
     delete_chat_profile(chat_id)
     await state.clear()
     await safe_edit_or_send(callback, "🗑️ <b>Profil muvaffaqiyatli o'chirildi.</b>\n\nEndi profil mavjud emas. Xizmatlardan foydalanishda ma'lumotlarni qo'lda kiritishingiz mumkin. Yangi profil yaratish uchun 'Profil' bo'limiga qayting.", get_main_menu(chat_id))
-@dp.callback_query(StateFilter(Profil.delete_confirm), F.data == "profil_delete_no")
+@profil_router.callback_query(StateFilter(Profil.delete_confirm), F.data == "profil_delete_no")
 async def profil_delete_no(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.clear()
     await safe_edit_or_send(callback, "❌ <b>Profil o'chirish bekor qilindi.</b>\n\nProfilingiz saqlanib qoldi. Boshqa harakatlar uchun menyudan tanlang.", get_main_menu(chat_id))
-@dp.callback_query(F.data == "profil_edit")
+@profil_router.callback_query(F.data == "profil_edit")
 async def profil_edit(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(Profil.edit_choice)
     await safe_edit_or_send(callback, "✏️ <b>Profil tahrirlash menyusi:</b>\n\nQaysi ma'lumotni o'zgartirmoqchisiz? Tanlang va yangi qiymatni kiriting. Saqlash tugmasini bosgandan keyin o'zgarishlar amalga oshiriladi.", KB_PROFIL_EDIT)
-@dp.callback_query(StateFilter(Profil.edit_choice), F.data.startswith("edit_"))
+@profil_router.callback_query(StateFilter(Profil.edit_choice), F.data.startswith("edit_"))
 async def profil_edit_field(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -1011,71 +2658,27 @@ async def profil_edit_field(callback: types.CallbackQuery, state: FSMContext):
     elif field == "tuman":
         await state.set_state(Profil.edit_tuman_mahalla)
         await safe_edit_or_send(callback, "🏙️ <b>Tuman/mahalla tahrirlash:</b>\n\nYangi tuman yoki mahallangizni kiriting (masalan: 'sherobod tumani , katta hayot mahallasi'):", get_cancel_kb("back_profil"))
-@dp.message(StateFilter(Profil.edit_ism_familya))
-async def profil_edit_ism_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    ism = message.text.strip()
-    if not ism or len(ism) < 2:
-        await message.reply("❌ Ism va familiya to'liq va to'g'ri kiriting. Qayta urinib ko'ring.", reply_markup=get_cancel_kb("back_profil"))
-        return
-    await state.update_data(edit_ism_familya=ism)
-    await state.set_state(Profil.edit_choice)
-    await message.answer("✅ <b>Ism va familiya muvaffaqiyatli yangilandi.</b>\n\nBoshqa o'zgarishlar uchun menyudan tanlang yoki 'Saqlash' tugmasini bosing.", reply_markup=KB_PROFIL_EDIT)
-@dp.message(StateFilter(Profil.edit_telefon))
-async def profil_edit_telefon_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    phone = message.text.strip()
-    if not re.fullmatch(r"\+?\d{9,15}", phone):
-        await message.reply("❌ Telefon raqami noto'g'ri formatda. +998 bilan boshlanishi va 9-12 xonali raqam bo'lishi kerak. Qayta kiriting.", reply_markup=get_cancel_kb("back_profil"))
-        return
-    await state.update_data(edit_telefon=phone)
-    await state.set_state(Profil.edit_choice)
-    await message.answer("✅ <b>Telefon raqam muvaffaqiyatli yangilandi.</b>\n\nBoshqa o'zgarishlar uchun menyudan tanlang yoki 'Saqlash' tugmasini bosing.", reply_markup=KB_PROFIL_EDIT)
-@dp.message(StateFilter(Profil.edit_tuman_mahalla))
-async def profil_edit_tuman_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    tuman = message.text.strip()
-    if not tuman or len(tuman) < 2:
-        await message.reply("❌ Tuman yoki mahalla nomini to'liq kiriting. Qayta urinib ko'ring.", reply_markup=get_cancel_kb("back_profil"))
-        return
-    await state.update_data(edit_tuman_mahalla=tuman)
-    await state.set_state(Profil.edit_choice)
-    await message.answer("✅ <b>Tuman/mahalla muvaffaqiyatli yangilandi.</b>\n\nBoshqa o'zgarishlar uchun menyudan tanlang yoki 'Saqlash' tugmasini bosing.", reply_markup=KB_PROFIL_EDIT)
-@dp.callback_query(StateFilter(Profil.edit_choice), F.data == "profil_save_edit")
+@profil_router.callback_query(StateFilter(Profil.edit_choice), F.data == "profil_save_edit")
 async def profil_save_edit(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     data = await state.get_data()
-    old_profile = get_chat_profile(chat_id) or {}
-    new_profile = old_profile.copy()
-    if 'edit_ism_familya' in data:
-        new_profile['ism_familya'] = data['edit_ism_familya']
-    if 'edit_telefon' in data:
-        new_profile['telefon'] = data['edit_telefon']
-    if 'edit_tuman_mahalla' in data:
-        new_profile['tuman_mahalla'] = data['edit_tuman_mahalla']
-    set_chat_profile(chat_id, new_profile)
+    changes = {col: data[f"edit_{col}"] for col in PROFILE_FIELDS if f"edit_{col}" in data}
+    set_chat_profile(chat_id, replace(get_chat_profile(chat_id) or Profile(), **changes))
     await state.clear()
     await safe_edit_or_send(callback, "✅ <b>Profil muvaffaqiyatli yangilandi!</b>\n\nO'zgarishlar saqlandi. Profil bo'limiga qaytib, yangi ma'lumotlarni ko'rishingiz mumkin.", get_main_menu(chat_id))
 @dp.callback_query(F.data == "back_profil")
 async def back_profil(callback: types.CallbackQuery, state: FSMContext):
     await back_main(callback, state)
 # ----------------- Raqam tiklash -----------------
-@dp.callback_query(F.data == "tiklash")
+@tiklash_router.callback_query(F.data == "tiklash")
 async def tiklash_start(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     if not await is_working_hours():
-        await callback.message.answer("⏰ ish vaqti: 07:00-24:00. Ertaga urinib ko'ring.")
-        return
+        await callback.message.answer(OUT_OF_HOURS_INTAKE)
     # NEW: require profile
     profile = get_chat_profile(chat_id)
     if not profile:
@@ -1084,7 +2687,7 @@ async def tiklash_start(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await state.set_state(RaqamTiklash.operator)
     await safe_edit_or_send(callback, "📱 <b>Raqam tiklash xizmati:</b>\n\nYo'qolgan yoki bloklangan raqamingizni tiklash uchun operatorni tanlang. Keyingi qadamda raqam va bog'lanish usulini kiritasiz.", KB_TIKLASH_OPERATOR)
-@dp.callback_query(StateFilter(RaqamTiklash.operator), F.data.startswith("op_"))
+@tiklash_router.callback_query(StateFilter(RaqamTiklash.operator), F.data.startswith("op_"))
 async def tiklash_operator_selected(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -1092,180 +2695,90 @@ async def tiklash_operator_selected(callback: types.CallbackQuery, state: FSMCon
     operator = callback.data.split("_", 1)[1]
     await state.update_data(operator=operator)
     await state.set_state(RaqamTiklash.number)
-    markup = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Operator tanlashga qaytish", callback_data="back_tiklash_op")],
-        [InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")],
-        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_service")]
-    ])
+    markup = step_back_kb("back_tiklash_op", "⬅️ Operator tanlashga qaytish")
     await safe_edit_or_send(callback, "📱 <b>Raqam tiklash bosqichi 2/3:</b>\n\nTiklanishi kerak bo'lgan telefon raqamingizni kiriting (masalan:+99895.....27).", markup)
-@dp.callback_query(F.data == "back_tiklash_op")
-async def back_tiklash_op(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    await state.set_state(RaqamTiklash.operator)
-    await safe_edit_or_send(callback, "📱 <b>Raqam tiklash xizmati:</b>\n\nOperatorni tanlang.", KB_TIKLASH_OPERATOR)
-@dp.message(StateFilter(RaqamTiklash.number))
-async def tiklash_number_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    text = message.text.strip()
-    if not re.fullmatch(r"(\+998)?\d{9}", text):
-        await message.reply("❌ Telefon raqami noto'g'ri formatda. +998 bilan boshlanishi mumkin. Masalan:+99895.....27. Qayta kiriting.", reply_markup=get_cancel_kb("back_tiklash_op"))
-        return
-    number = text if text.startswith("+998") else "+998" + text.lstrip("+")
-    await state.update_data(number=number)
-    await state.set_state(RaqamTiklash.contact_method)
-    await message.answer("📞 <b>Raqam tiklash bosqichi 3/3:</b>\n\nBog'lanish usulini tanlang.", reply_markup=KB_TIKLASH_CONTACT)
-@dp.callback_query(StateFilter(RaqamTiklash.contact_method), F.data == "ctm_username")
+@tiklash_router.callback_query(StateFilter(RaqamTiklash.contact_method), F.data == "ctm_username")
 async def tiklash_ct_username(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     username = callback.from_user.username
     contact = f"@{username}" if username else "Username topilmadi, telefon kiriting"
-    await state.update_data(contact=contact)
+    data = await state.update_data(contact=contact)
     await state.set_state(RaqamTiklash.confirm)
-    data = await state.get_data()
-    text = (
-        f"📩 <b>Raqam tiklash so'rovini tasdiqlash:</b>\n\n"
-        f"📶 Operator: {data['operator']}\n"
-        f"📱 Tiklanadigan raqam: {data['number']}\n"
-        f"📞 Bog'lanish usuli: {contact}\n\n"
-        f"<i>Bu ma'lumotlar to'g'ri va to'liqmi? Agar ha bo'lsa, so'rov adminga yuboriladi va ko'rib chiqiladi.</i>"
-    )
-    await safe_edit_or_send(callback, text, KB_TIKLASH_CONFIRM)
-@dp.callback_query(StateFilter(RaqamTiklash.contact_method), F.data == "ctm_text")
+    await safe_edit_or_send(callback, *_tiklash_confirm(data))
+@tiklash_router.callback_query(StateFilter(RaqamTiklash.contact_method), F.data == "ctm_text")
 async def tiklash_ct_text(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(RaqamTiklash.contact_text)
-    markup = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Bog'lanish usuliga qaytish", callback_data="back_tiklash_ctm")],
-        [InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")],
-        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_service")]
-    ])
+    markup = step_back_kb("back_tiklash_ctm", "⬅️ Bog'lanish usuliga qaytish")
     await safe_edit_or_send(callback, "📞 <b>Bog'lanish uchun telefon raqamini kiriting:</b>\n\n", markup)
-@dp.callback_query(F.data == "back_tiklash_ctm")
-async def back_tiklash_ctm(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    await state.set_state(RaqamTiklash.contact_method)
-    await safe_edit_or_send(callback, "📞 <b>Bog'lanish usulini tanlang:</b>", KB_TIKLASH_CONTACT)
-@dp.message(StateFilter(RaqamTiklash.contact_text))
-async def tiklash_ct_text_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    phone = message.text.strip()
-    if not re.fullmatch(r"\+998\d{9}", phone):
-        await message.reply("❌ Telefon raqami +998 bilan boshlanishi va 12 xonali raqam bo'lishi kerak. Masalan: +99891.....66. Qayta kiriting.", reply_markup=get_cancel_kb("back_tiklash_ctm"))
-        return
-    await state.update_data(contact=phone)
-    await state.set_state(RaqamTiklash.confirm)
-    data = await state.get_data()
-    text = (
-        f"📩 <b>Raqam tiklash so'rovini tasdiqlash:</b>\n\n"
-        f"📶 Operator: {data['operator']}\n"
-        f"📱 Tiklanadigan raqam: {data['number']}\n"
-        f"📞 Bog'lanish usuli: {phone}\n\n"
-        f"<i>Bu ma'lumotlar to'g'ri va to'liqmi? Agar ha bo'lsa, so'rov adminga yuboriladi va ko'rib chiqiladi.</i>"
-    )
-    await message.answer(text, reply_markup=KB_TIKLASH_CONFIRM)
-@dp.callback_query(StateFilter(RaqamTiklash.confirm), F.data == "tiklash_confirm_yes")
+@tiklash_router.callback_query(StateFilter(RaqamTiklash.confirm), F.data == "tiklash_confirm_yes", flags={"throttle": "submit"})
 async def tiklash_confirm_yes(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    data = await state.get_data()
-    profile = get_chat_profile(chat_id)
-    profile_text = f"\n👤 Ism: {profile.get('ism_familya', '')} | 📞 Telefon: {profile.get('telefon', '')} | 🏙️ Tuman/Mahalla: {profile.get('tuman_mahalla', '')}" if profile else ""
-    text = (
-        f"📩 <b>Raqam tiklash so'rovi keldi:</b>\n\n"
-        f"📶 Operator: {data['operator']}\n"
-        f"📱 Tiklanadigan raqam: {data['number']}\n"
-        f"📞 Bog'lanish usuli: {data['contact']}{profile_text}\n\n"
-        f"🆔 Foydalanuvchi ID: {callback.from_user.id}\n\n"
-        f"<i>Iltimos, bu so'rovni tez orada ko'rib chiqing va foydalanuvchiga javob bering.</i>"
-    )
-    await bot.send_message(ADMIN_ID, text)
-    save_action({
-        'type': 'raqam_tiklash',
-        'chat_id': callback.from_user.id,
-        'details': f"Operator: {data['operator']}, Raqam: {data['number']}, Bog'lanish: {data['contact']}"
-    })
+    key = f"{chat_id}:tiklash:confirm:{callback.message.message_id}"
+    saved = None
+    if not claim_idempotency(key, chat_id):
+        saved = resume_idempotency(key)  # oldingi urinish saqlab, lekin yubora olmagan bo'lsa - davom etiladi
+        if saved is None:
+            await callback.answer("✅ So'rovingiz allaqachon yuborilgan.")
+            return
+    try:
+        ensure_chat_exists(chat_id)
+        update_chat_activity(chat_id)
+        data = await state.get_data()
+        profile = get_chat_profile(chat_id)
+        profile_text = profile.admin_summary if profile else ""
+        text = (
+            f"📩 <b>Raqam tiklash so'rovi keldi:</b>\n\n"
+            f"📶 Operator: {data['operator']}\n"
+            f"📱 Tiklanadigan raqam: {data['number']}\n"
+            f"📞 Bog'lanish usuli: {data['contact']}{profile_text}\n\n"
+            f"🆔 Foydalanuvchi ID: {callback.from_user.id}\n\n"
+            f"<i>Iltimos, bu so'rovni tez orada ko'rib chiqing va foydalanuvchiga javob bering.</i>"
+        )
+        if saved is None:
+            save_action({
+                'type': 'raqam_tiklash',
+                'chat_id': callback.from_user.id,
+                'details': f"Operator: {data['operator']}, Raqam: {data['number']}, Bog'lanish: {data['contact']}"
+            })
+            record_idempotency(key, "saved")
+        if await defer_submission(callback, state, 'raqam_tiklash', text):
+            return
+        await notify_admin(text, chat_id=chat_id, admin_id=assign_operator(chat_id, 'raqam_tiklash'))
+    except Exception as e:
+        logger.exception(f"tiklash so'rovi adminga yuborilmadi: {e}")
+        # foydalanuvchi qayta bosganda "allaqachon yuborilgan" deb rad etilmaydi, saqlangan narsa takrorlanmaydi
+        fail_idempotency(key)
+        await callback.answer("❌ Texnik xato: so'rov adminga yuborilmadi. Qayta urinib ko'ring.", show_alert=True)
+        return
     await state.set_state(RaqamTiklash.waiting_reply)
     await safe_edit_or_send(callback, "✅ <b>Raqam tiklash so'rovingiz adminga muvaffaqiyatli yuborildi!</b>\n\nIltimos, kutib turing. So'rov ko'rib chiqilmoqda va javob tez orada keladi. Boshqa xizmatlar uchun menyudan tanlang.", get_main_menu(chat_id))
     asyncio.create_task(send_waiting_reminder(chat_id, "raqam tiklash so'rovingiz"))
     asyncio.create_task(auto_reset_state(state, chat_id, "Raqam tiklash so'rovi"))
-@dp.callback_query(StateFilter(RaqamTiklash.confirm), F.data == "tiklash_confirm_no")
+@tiklash_router.callback_query(StateFilter(RaqamTiklash.confirm), F.data == "tiklash_confirm_no")
 async def tiklash_confirm_no(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.clear()
     await safe_edit_or_send(callback, "❌ <b>Raqam tiklash so'rovi bekor qilindi.</b>\n\nAgar fikringiz o'zgarsa, 'Raqam tiklash' bo'limidan qayta boshlang.", get_main_menu(chat_id))
-@dp.callback_query(F.data == "back_tiklash_number")
-async def back_tiklash_number(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    await state.set_state(RaqamTiklash.number)
-    markup = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Operator tanlashga qaytish", callback_data="back_tiklash_op")],
-        [InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")],
-        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_service")]
-    ])
-    await safe_edit_or_send(callback, "📱 <b>Raqam tiklash bosqichi 2/3:</b>\n\nTiklanishi kerak bo'lgan telefon raqamingizni kiriting.", markup)
-@dp.callback_query(F.data == "back_tiklash_contact")
-async def back_tiklash_contact(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    await state.set_state(RaqamTiklash.contact_method)
-    await safe_edit_or_send(callback, "📞 <b>Bog'lanish usulini tanlang:</b>", KB_TIKLASH_CONTACT)
-@dp.message(StateFilter(RaqamTiklash.waiting_reply))
-async def tiklash_waiting_reply(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    if not is_in_chat(chat_id):
-        return
-    profile = get_chat_profile(chat_id)
-    profile_text = f"\n👤 Ism: {profile.get('ism_familya', '')} | 📞 Telefon: {profile.get('telefon', '')} | 🏙️ Tuman/Mahalla: {profile.get('tuman_mahalla', '')}" if profile else ""
-    txt = f"📨 <b>Raqam tiklash so'rovi bo'yicha javob:</b>\n\n{message.text or 'Fayl yuborildi'}{profile_text}\n\n🆔 Chat ID: {chat_id}"
-    try:
-        if message.photo:
-            await bot.send_photo(ADMIN_ID, message.photo[-1].file_id, caption=txt)
-        elif message.document:
-            await bot.send_document(ADMIN_ID, message.document.file_id, caption=txt)
-        elif message.video:
-            await bot.send_video(ADMIN_ID, message.video.file_id, caption=txt)
-        else:
-            await bot.send_message(ADMIN_ID, txt)
-        await message.answer("✉️ <b>Xabaringiz adminga muvaffaqiyatli yuborildi.</b>\n\nJavobni kuting. Suhbatdan chiqish uchun chiqish tugmasini bosing.", reply_markup=KB_ADMIN_CHAT_EXIT)
-        save_action({'type': 'tiklash_reply', 'chat_id': chat_id, 'details': message.text or 'media'})
-    except Exception as e:
-        logger.error(f"Tiklash reply xato: {e}")
-        await message.answer("⚠️ Xabar yuborishda texnik xato yuz berdi. Qayta urinib ko'ring.")
 # ----------------- Reklama -----------------
-@dp.callback_query(F.data == "reklama")
+@reklama_router.callback_query(F.data == "reklama")
 async def reklama_start(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     if not await is_working_hours():
-        await callback.message.answer("⏰ Bot ish vaqti: 07:00-24:00. Ertaga urinib ko'ring.")
-
-        return
+        await callback.message.answer(OUT_OF_HOURS_INTAKE)
     await state.clear()
     await state.update_data(files=[])
     await state.set_state(Reklama.ad_type)
     await safe_edit_or_send(callback, "📰 <b>Reklama xizmati:</b>\n\nReklama turini tanlang. Keyingi qadamda tafsilotlar va bog'lanish ma'lumotlarini kiritasiz. So'rov adminga yuborilgach, ko'rib chiqiladi.", KB_REKLAMA_TYPES)
-@dp.callback_query(StateFilter(Reklama.ad_type), F.data.startswith("rad_"))
+@reklama_router.callback_query(StateFilter(Reklama.ad_type), F.data.startswith("rad_"))
 async def reklama_type_selected(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -1273,51 +2786,16 @@ async def reklama_type_selected(callback: types.CallbackQuery, state: FSMContext
     ad_type = "Boshqa turdagi reklama" if callback.data == "rad_other" else f"{callback.data.split('_', 1)[1].capitalize()} reklama"
     await state.update_data(ad_type=ad_type)
     await state.set_state(Reklama.details)
-    markup = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Reklama turiga qaytish", callback_data="back_reklama_type")],
-        [InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")],
-        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_service")]
-    ])
+    markup = step_back_kb("back_reklama_type", "⬅️ Reklama turiga qaytish")
     await safe_edit_or_send(callback, "✍️ <b>Reklama tafsilotlarini kiriting:</b>\n\nReklama haqida batafsil ma'lumot yozing (o'lcham, rang, joylashuv talablari va h.k.). Iltimos, aniq va to'liq yozing.", markup)
-@dp.callback_query(F.data == "back_reklama_type")
-async def back_reklama_type(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    await state.set_state(Reklama.ad_type)
-    await safe_edit_or_send(callback, "📰 <b>Reklama turini tanlang:</b>", KB_REKLAMA_TYPES)
-@dp.message(StateFilter(Reklama.details))
-async def reklama_details_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    details = message.text.strip()
-    if not details or len(details) < 10:
-        await message.reply("❌ Reklama tafsilotlari yetarlicha batafsil emas. Kamida 10 ta belgi bo'lishi va aniq ma'lumot berilishi kerak. Qayta yozing.", reply_markup=get_cancel_kb("back_reklama_type"))
-        return
-    await state.update_data(details=details)
-    await state.set_state(Reklama.style)
-    await message.answer("🎨 <b>Reklama ko'rinishini tasvirlang:</b>\n\nReklama dizayni haqida ma'lumot bering (fon rangi, shrift turi, rasmlar and h.k.). Iltimos, batafsil yozing.", reply_markup=get_cancel_kb("back_reklama_type"))
-@dp.message(StateFilter(Reklama.style))
-async def reklama_style_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    style = message.text.strip()
-    if not style or len(style) < 5:
-        await message.reply("❌ Reklama ko'rinishi haqida ma'lumot yetarlicha emas. Qayta yozing.", reply_markup=get_cancel_kb("back_reklama_type"))
-        return
-    await state.update_data(style=style)
-    await state.set_state(Reklama.attach_choice)
-    await message.answer("📎 <b>Fayl qo'shish:</b>\n\nReklama uchun rasm, video yoki hujjat fayl qo'shmoqchimisiz? (Masalan, dizayn namunasi). Ha/Yo'q tanlang.", reply_markup=KB_REKLAMA_ATTACH)
-@dp.callback_query(StateFilter(Reklama.attach_choice), F.data == "rad_attach_yes")
+@reklama_router.callback_query(StateFilter(Reklama.attach_choice), F.data == "rad_attach_yes")
 async def reklama_attach_yes(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(Reklama.file_upload)
     await safe_edit_or_send(callback, "📤 <b>Fayl yuklash:</b>\n\nFayllarni yuboring (rasm, video yoki hujjat). Har birini alohida. Tugagach, 'Barcha fayllar yuborildi' tugmasini bosing. Virus tekshiruvi o'tkaziladi.", KB_FILE_DONE)
-@dp.callback_query(StateFilter(Reklama.attach_choice), F.data == "rad_attach_no")
+@reklama_router.callback_query(StateFilter(Reklama.attach_choice), F.data == "rad_attach_no")
 async def reklama_attach_no(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -1325,180 +2803,102 @@ async def reklama_attach_no(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(files=[])
     await state.set_state(Reklama.contact_method)
     await safe_edit_or_send(callback, "📞 <b>Bog'lanish usulini tanlang:</b>\n\n.", KB_REKLAMA_CONTACT)
-@dp.message(StateFilter(Reklama.file_upload))
+@reklama_router.message(StateFilter(Reklama.file_upload))
 async def reklama_file_uploaded(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
-    data = await state.get_data()
-    files = data.get('files', [])
-    file_id, ctype = None, None
-    if message.photo:
-        file_id = message.photo[-1].file_id
-        ctype = "photo"
-    elif message.video:
-        file_id = message.video.file_id
-        ctype = "video"
-    elif message.document:
-        file_id = message.document.file_id
-        ctype = "document"
-    if not file_id:
-        await message.answer("❌ Iltimos, faqat rasm, video yoki hujjat fayl yuboring. Qayta urinib ko'ring.", reply_markup=get_cancel_kb("back_reklama_attach"))
-        return
-    await show_progress(message)
-    if not await check_file_for_virus(file_id, ctype):
-        await message.answer("❌ Fayl virusli deb topildi yoki xavfli. Boshqa fayl yuboring yoki 'Barcha fayllar yuborildi' ni bosing.", reply_markup=get_cancel_kb("back_reklama_attach"))
-        return
-    files.append((ctype, file_id))
-    await state.update_data(files=files)
-    await message.answer("✅ Fayl muvaffaqiyatli yuklandi va tekshirildi. Yana fayl yuboring yoki tugagach 'Barcha fayllar yuborildi' ni bosing.", reply_markup=KB_FILE_DONE)
-@dp.callback_query(StateFilter(Reklama.file_upload), F.data == "file_done")
+    await handle_file_upload(message, state, "back_reklama_attach", {
+        'invalid': "❌ Iltimos, faqat rasm, video yoki hujjat fayl yuboring. Qayta urinib ko'ring.",
+        'rejected': "❌ Fayl virusli deb topildi yoki xavfli. Boshqa fayl yuboring yoki 'Barcha fayllar yuborildi' ni bosing.",
+        'clean': "✅ Fayl muvaffaqiyatli yuklandi va tekshirildi. Yana fayl yuboring yoki tugagach 'Barcha fayllar yuborildi' ni bosing.",
+    })
+@reklama_router.callback_query(StateFilter(Reklama.file_upload), F.data == "file_done")
 async def reklama_file_done(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(Reklama.contact_method)
     await safe_edit_or_send(callback, "📞 <b>Bog'lanish usulini tanlang:</b>", KB_REKLAMA_CONTACT)
-@dp.callback_query(StateFilter(Reklama.contact_method), F.data == "rad_ctm_username")
+@reklama_router.callback_query(StateFilter(Reklama.contact_method), F.data == "rad_ctm_username")
 async def reklama_ctm_username(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     username = callback.from_user.username
     contact = f"@{username}" if username else "Username topilmadi, telefon kiriting"
-    await state.update_data(contact=contact)
+    data = await state.update_data(contact=contact)
     await state.set_state(Reklama.confirm)
-    data = await state.get_data()
-    text = (
-        f"📰 <b>Reklama so'rovini tasdiqlash:</b>\n\n"
-        f"🖼️ Reklama turi: {data['ad_type']}\n"
-        f"✍️ Tafsilotlar: {data['details']}\n"
-        f"🎨 Ko'rinish: {data['style']}\n"
-        f"📎 Fayllar soni: {len(data.get('files', []))}\n"
-        f"📞 Bog'lanish: {contact}\n\n"
-        f"<i>Bu ma'lumotlar to'g'ri va to'liqmi? Agar ha bo'lsa, so'rov adminga yuboriladi va ko'rib chiqiladi.</i>"
-    )
-    await safe_edit_or_send(callback, text, KB_REKLAMA_CONFIRM)
-@dp.callback_query(StateFilter(Reklama.contact_method), F.data == "rad_ctm_text")
+    await safe_edit_or_send(callback, *_reklama_confirm(data))
+@reklama_router.callback_query(StateFilter(Reklama.contact_method), F.data == "rad_ctm_text")
 async def reklama_ctm_text(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(Reklama.contact_text)
-    markup = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Bog'lanish usuliga qaytish", callback_data="back_reklama_contact")],
-        [InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")],
-        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_service")]
-    ])
+    markup = step_back_kb("back_reklama_contact", "⬅️ Bog'lanish usuliga qaytish")
     await safe_edit_or_send(callback, "📞 <b>Bog'lanish uchun telefon raqamini kiriting:</b>\n\n.", markup)
-@dp.callback_query(F.data == "back_reklama_contact")
-async def back_reklama_contact(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    await state.set_state(Reklama.contact_method)
-    await safe_edit_or_send(callback, "📞 <b>Bog'lanish usulini tanlang:</b>", KB_REKLAMA_CONTACT)
-@dp.message(StateFilter(Reklama.contact_text))
-async def reklama_contact_text_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    phone = message.text.strip()
-    if not re.fullmatch(r"\+998\d{9}", phone):
-        await message.reply("❌ Telefon raqami +998 bilan boshlanishi va 12 xonali raqam bo'lishi kerak. Qayta kiriting.", reply_markup=get_cancel_kb("back_reklama_contact"))
-        return
-    await state.update_data(contact=phone)
-    await state.set_state(Reklama.confirm)
-    data = await state.get_data()
-    text = (
-        f"📰 <b>Reklama so'rovini tasdiqlash:</b>\n\n"
-        f"🖼️ Reklama turi: {data['ad_type']}\n"
-        f"✍️ Tafsilotlar: {data['details']}\n"
-        f"🎨 Ko'rinish: {data['style']}\n"
-        f"📎 Fayllar soni: {len(data.get('files', []))}\n"
-        f"📞 Bog'lanish: {phone}\n\n"
-        f"<i>Bu ma'lumotlar to'g'ri va to'liqmi? Agar ha bo'lsa, so'rov adminga yuboriladi va ko'rib chiqiladi.</i>"
-    )
-    await message.answer(text, reply_markup=KB_REKLAMA_CONFIRM)
-@dp.callback_query(StateFilter(Reklama.confirm), F.data == "rad_confirm_yes")
+@reklama_router.callback_query(StateFilter(Reklama.confirm), F.data == "rad_confirm_yes", flags={"throttle": "submit"})
 async def reklama_confirm_yes(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    data = await state.get_data()
-    profile = get_chat_profile(chat_id)
-    profile_text = f"\n👤 Ism: {profile.get('ism_familya', '')} | 📞 Telefon: {profile.get('telefon', '')} | 🏙️ Tuman/Mahalla: {profile.get('tuman_mahalla', '')}" if profile else ""
-    text = (
-        f"📰 <b>Reklama so'rovi keldi:</b>\n\n"
-        f"🖼️ Reklama turi: {data['ad_type']}\n"
-        f"✍️ Tafsilotlar: {data['details']}\n"
-        f"🎨 Ko'rinish: {data['style']}\n"
-        f"📎 Fayllar soni: {len(data.get('files', []))}\n"
-        f"📞 Bog'lanish: {data['contact']}{profile_text}\n\n"
-        f"🆔 Foydalanuvchi ID: {callback.from_user.id}\n\n"
-        f"<i>Iltimos, bu so'rovni tez orada ko'rib chiqing va foydalanuvchiga javob bering.</i>"
-    )
-    await bot.send_message(ADMIN_ID, text)
-    for ctype, fid in data.get('files', []):
-        caption = "📎 Reklama fayli (virus tekshiruvi o'tgan)"
-        try:
-            if ctype == "photo":
-                await bot.send_photo(ADMIN_ID, fid, caption=caption)
-            elif ctype == "video":
-                await bot.send_video(ADMIN_ID, fid, caption=caption)
-            else:
-                await bot.send_document(ADMIN_ID, fid, caption=caption)
-        except Exception as e:
-            logger.error(f"Fayl xato: {e}")
-    save_action({
-        'type': 'reklama',
-        'chat_id': callback.from_user.id,
-        'details': f"Turi: {data['ad_type']}, Tafsilot: {data['details']}, Ko'rinish: {data['style']}, Bog'lanish: {data['contact']}"
-    })
+    key = f"{chat_id}:reklama:confirm:{callback.message.message_id}"
+    saved = None
+    if not claim_idempotency(key, chat_id):
+        saved = resume_idempotency(key)  # oldingi urinish saqlab, lekin yubora olmagan bo'lsa - davom etiladi
+        if saved is None:
+            await callback.answer("✅ So'rovingiz allaqachon yuborilgan.")
+            return
+    try:
+        ensure_chat_exists(chat_id)
+        update_chat_activity(chat_id)
+        data = await state.get_data()
+        profile = get_chat_profile(chat_id)
+        profile_text = profile.admin_summary if profile else ""
+        text = (
+            f"📰 <b>Reklama so'rovi keldi:</b>\n\n"
+            f"🖼️ Reklama turi: {data['ad_type']}\n"
+            f"✍️ Tafsilotlar: {data['details']}\n"
+            f"🎨 Ko'rinish: {data['style']}\n"
+            f"📎 Fayllar soni: {len(data.get('files', []))}\n"
+            f"📞 Bog'lanish: {data['contact']}{profile_text}\n\n"
+            f"🆔 Foydalanuvchi ID: {callback.from_user.id}\n\n"
+            f"<i>Iltimos, bu so'rovni tez orada ko'rib chiqing va foydalanuvchiga javob bering.</i>"
+        )
+        if saved is None:
+            save_action({
+                'type': 'reklama',
+                'chat_id': callback.from_user.id,
+                'details': f"Turi: {data['ad_type']}, Tafsilot: {data['details']}, Ko'rinish: {data['style']}, Bog'lanish: {data['contact']}"
+            })
+            record_idempotency(key, "saved")
+        if await defer_submission(callback, state, 'reklama', text, data.get('files', [])):
+            return
+        await notify_admin(text, chat_id=chat_id, files=data.get('files', []), admin_id=assign_operator(chat_id, 'reklama'))
+    except Exception as e:
+        logger.exception(f"reklama so'rovi adminga yuborilmadi: {e}")
+        # foydalanuvchi qayta bosganda "allaqachon yuborilgan" deb rad etilmaydi, saqlangan narsa takrorlanmaydi
+        fail_idempotency(key)
+        await callback.answer("❌ Texnik xato: so'rov adminga yuborilmadi. Qayta urinib ko'ring.", show_alert=True)
+        return
     await state.set_state(Reklama.waiting_reply)
     await safe_edit_or_send(callback, "✅ <b>Reklama so'rovingiz adminga muvaffaqiyatli yuborildi!</b>\n\nIltimos, kutib turing. So'rov ko'rib chiqilmoqda va javob tez orada keladi. Boshqa xizmatlar uchun menyudan tanlang.", get_main_menu(chat_id))
     asyncio.create_task(send_waiting_reminder(chat_id, "reklama so'rovingiz"))
     asyncio.create_task(auto_reset_state(state, chat_id, "Reklama so'rovi"))
-@dp.callback_query(StateFilter(Reklama.confirm), F.data == "rad_confirm_edit")
+@reklama_router.callback_query(StateFilter(Reklama.confirm), F.data == "rad_confirm_edit")
 async def reklama_confirm_edit(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(Reklama.contact_method)
     await safe_edit_or_send(callback, "📞 <b>Bog'lanish usulini tahrirlash:</b>", KB_REKLAMA_CONTACT)
-@dp.message(StateFilter(Reklama.waiting_reply))
-async def reklama_waiting_reply(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    if not is_in_chat(chat_id):
-        return
-    profile = get_chat_profile(chat_id)
-    profile_text = f"\n👤 Ism: {profile.get('ism_familya', '')} | 📞 Telefon: {profile.get('telefon', '')} | 🏙️ Tuman/Mahalla: {profile.get('tuman_mahalla', '')}" if profile else ""
-    txt = f"📨 <b>Reklama so'rovi bo'yicha javob:</b>\n\n{message.text or 'Fayl yuborildi'}{profile_text}\n\n🆔 Chat ID: {chat_id}"
-    try:
-        if message.photo:
-            await bot.send_photo(ADMIN_ID, message.photo[-1].file_id, caption=txt)
-        elif message.document:
-            await bot.send_document(ADMIN_ID, message.document.file_id, caption=txt)
-        elif message.video:
-            await bot.send_video(ADMIN_ID, message.video.file_id, caption=txt)
-        else:
-            await bot.send_message(ADMIN_ID, txt)
-        await message.answer("✉️ <b>Xabaringiz adminga muvaffaqiyatli yuborildi.</b>\n\nJavobni kuting. Suhbatdan chiqish uchun chiqish tugmasini bosing.", reply_markup=KB_ADMIN_CHAT_EXIT)
-        save_action({'type': 'reklama_reply', 'chat_id': chat_id, 'details': message.text or 'media'})
-    except Exception as e:
-        logger.error(f"Reklama reply xato: {e}")
-        await message.answer("⚠️ Xabar yuborishda texnik xato yuz berdi. Qayta urinib ko'ring.")
 # ----------------- Buyurtma -----------------
-@dp.callback_query(F.data == "buyurtma")
+@buyurtma_router.callback_query(F.data == "buyurtma")
 async def buyurtma_start(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     if not await is_working_hours():
-        await callback.message.answer("⏰ Bot ish vaqti: 07:00-24:00. Ertaga urinib ko'ring.")
-        return
+        await callback.message.answer(OUT_OF_HOURS_INTAKE)
     # NEW: require profile
     profile = get_chat_profile(chat_id)
     if not profile:
@@ -1507,8 +2907,8 @@ async def buyurtma_start(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await state.update_data(files=[])
     await state.set_state(RaqamBuyurtma.mahalla)
-    await safe_edit_or_send(callback, "🆕 <b>Yangi raqam buyurtma xizmati:</b>\n\nYangi raqam olish uchun mahallangizni tanlang. Keyingi qadamlar: ma'lumot, operator, joylashuv va bog'lanish.", kb_mahalla_page(0))
-@dp.callback_query(StateFilter(RaqamBuyurtma.mahalla), F.data.startswith("mah_page_"))
+    await safe_edit_or_send(callback, "🆕 <b>Yangi raqam buyurtma xizmati:</b>\n\nYangi raqam olish uchun mahallangizni tanlang yoki nomini yozib yuboring. Keyingi qadamlar: ma'lumot, operator, joylashuv va bog'lanish.", kb_mahalla_page(0))
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.mahalla), F.data.startswith("mah_page_"))
 async def mahalla_page_nav(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -1518,7 +2918,12 @@ async def mahalla_page_nav(callback: types.CallbackQuery, state: FSMContext):
     except ValueError:
         page = 0
     await safe_edit_or_send(callback, "🆕 <b>Mahalla tanlash:</b>\n\nQuyidagi sahifadan mahallangizni tanlang.", kb_mahalla_page(page))
-@dp.callback_query(StateFilter(RaqamBuyurtma.mahalla), F.data.startswith("mah_sel_"))
+KB_BUYURTMA_DATA_BACK = step_back_kb("back_buyurtma_mah", "⬅️ Mahalla tanlashga qaytish")
+BUYURTMA_DATA_PROMPT = "🆕 <b>Raqam buyurtma bosqichi 2/5:</b>\n\nYangi raqam turi haqida qo'shimcha ma'lumot kiriting (masalan: sizga qanday raqam kerak va qay usulda olmoqchisiz). Iltimos, aniq yozing."
+async def _select_mahalla(state: FSMContext, idx: int):
+    await state.update_data(mahalla=MAHALLALAR[idx])
+    await state.set_state(RaqamBuyurtma.data)
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.mahalla), F.data.startswith("mah_sel_"))
 async def mahalla_selected(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -1528,31 +2933,40 @@ async def mahalla_selected(callback: types.CallbackQuery, state: FSMContext):
         if idx < 0 or idx >= len(MAHALLALAR):
             await safe_edit_or_send(callback, "❌ Noto'g'ri mahalla tanlandi. Iltimos, qayta tanlang.", kb_mahalla_page(0))
             return
-        mah = MAHALLALAR[idx]
-        await state.update_data(mahalla=mah)
-        await state.set_state(RaqamBuyurtma.data)
-        markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⬅️ Mahalla tanlashga qaytish", callback_data="back_buyurtma_mah")],
-            [InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")],
-            [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_service")]
-        ])
-        await safe_edit_or_send(callback, "🆕 <b>Raqam buyurtma bosqichi 2/5:</b>\n\nYangi raqam turi haqida qo'shimcha ma'lumot kiriting (masalan: sizga qanday raqam kerak va qay usulda olmoqchisiz). Iltimos, aniq yozing.", markup)
+        await _select_mahalla(state, idx)
+        await safe_edit_or_send(callback, BUYURTMA_DATA_PROMPT, KB_BUYURTMA_DATA_BACK)
     except Exception as e:
         logger.exception(f"mahalla_selected xato: {e}")
         await safe_edit_or_send(callback, "❌ Mahalla tanlashda xato yuz berdi. Qayta urinib ko'ring.", kb_mahalla_page(0))
-@dp.message(StateFilter(RaqamBuyurtma.data))
-async def buyurtma_data_entered(message: types.Message, state: FSMContext):
+@buyurtma_router.message(StateFilter(RaqamBuyurtma.mahalla), F.text)
+async def mahalla_typed(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
-    malumot = message.text.strip()
-    if not malumot or len(malumot) < 10:
-        await message.reply("❌ Qo'shimcha ma'lumot yetarlicha batafsil emas. Kamida 10 ta belgi bo'lishi kerak. Batafsilroq Qayta yozing.", reply_markup=get_cancel_kb("back_buyurtma_mah"))
+    matches = search_mahalla(message.text)
+    if len(matches) == 1 and normalize_uz(message.text) == _MAHALLA_INDEX[matches[0]][0]:
+        # aniq nom (yoki inline qidiruvdan tanlangan natija) - to'g'ridan-to'g'ri keyingi bosqichga
+        await _select_mahalla(state, matches[0])
+        await message.answer(f"🏘️ {MAHALLALAR[matches[0]]} mahallasi tanlandi.\n\n{BUYURTMA_DATA_PROMPT}", reply_markup=KB_BUYURTMA_DATA_BACK)
+        return
+    if not matches:
+        await message.answer("🔎 Bunday mahalla topilmadi. Nomini boshqacha yozib ko'ring yoki ro'yxatdan tanlang.", reply_markup=kb_mahalla_page(0))
         return
-    await state.update_data(malumot=malumot)
-    await state.set_state(RaqamBuyurtma.operator)
-    await message.answer("📶 <b>Raqam buyurtma bosqichi 3/5:</b>\n\nQaysi operator raqamini xohlaysiz? Tanlang.", reply_markup=KB_BUYURTMA_OPERATOR)
-@dp.callback_query(StateFilter(RaqamBuyurtma.operator), F.data.startswith("bop_"))
+    await message.answer("🔎 <b>Topilgan mahallalar:</b>\n\nKeraklisini tanlang.", reply_markup=kb_mahalla_matches(matches))
+@buyurtma_router.inline_query()
+async def mahalla_inline_search(query: types.InlineQuery):
+    indices = search_mahalla(query.query, limit=20) if query.query.strip() else range(min(20, len(MAHALLALAR)))
+    results = [
+        types.InlineQueryResultArticle(
+            id=str(idx),
+            title=f"🏘️ {MAHALLALAR[idx]}",
+            description="Mahalla sifatida tanlash",
+            input_message_content=types.InputTextMessageContent(message_text=MAHALLALAR[idx], parse_mode=None),
+        )
+        for idx in indices
+    ]
+    await query.answer(results, cache_time=3600, is_personal=False)
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.operator), F.data.startswith("bop_"))
 async def buyurtma_operator_selected(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -1561,21 +2975,14 @@ async def buyurtma_operator_selected(callback: types.CallbackQuery, state: FSMCo
     await state.update_data(operator=operator)
     await state.set_state(RaqamBuyurtma.file_choice)
     await safe_edit_or_send(callback, "📎 <b>Raqam buyurtma bosqichi 4/5:</b>\n\nBuyurtmaga qo'shimcha fayl (masalan, hujjat) qo'shmoqchimisiz? Tanlang.", yes_no_kb("file_yes", "file_no", "back_buyurtma_op"))
-@dp.callback_query(F.data == "back_buyurtma_op")
-async def back_buyurtma_op(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    await state.set_state(RaqamBuyurtma.operator)
-    await safe_edit_or_send(callback, "📶 <b>Operator tanlash:</b>", KB_BUYURTMA_OPERATOR)
-@dp.callback_query(StateFilter(RaqamBuyurtma.file_choice), F.data == "file_yes")
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.file_choice), F.data == "file_yes")
 async def buyurtma_file_yes(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(RaqamBuyurtma.file_upload)
     await safe_edit_or_send(callback, "📤 <b>Fayl yuklash:</b>\n\nFayllarni yuboring (hujjat yoki rasm). Har birini alohida. Tugagach, 'Barcha fayllar yuborildi' ni bosing. Virus tekshiruvi o'tkaziladi.", KB_FILE_DONE)
-@dp.callback_query(StateFilter(RaqamBuyurtma.file_choice), F.data == "file_no")
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.file_choice), F.data == "file_no")
 async def buyurtma_file_no(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -1583,45 +2990,21 @@ async def buyurtma_file_no(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(files=[])
     await state.set_state(RaqamBuyurtma.location)
     await callback.message.answer("📍 <b>Raqam buyurtma bosqichi 5/5:</b>\n\nJoylashuvni ulashing (GPS orqali). Bu mahalla tasdiqlash uchun kerak.", reply_markup=KB_SHARE_LOCATION)
-@dp.callback_query(F.data == "back_buyurtma_file_choice")
-async def back_buyurtma_file_choice(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    await state.set_state(RaqamBuyurtma.file_choice)
-    await safe_edit_or_send(callback, "📎 <b>Fayl qo'shish:</b>", yes_no_kb("file_yes", "file_no", "back_buyurtma_op"))
-@dp.message(StateFilter(RaqamBuyurtma.file_upload))
+@buyurtma_router.message(StateFilter(RaqamBuyurtma.file_upload))
 async def buyurtma_file_uploaded(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
-    data = await state.get_data()
-    files = data.get('files', [])
-    ctype = None
-    file_id = None
-    if message.photo:
-        file_id = message.photo[-1].file_id
-        ctype = "photo"
-    elif message.video:
-        file_id = message.video.file_id
-        ctype = "video"
-    elif message.document:
-        file_id = message.document.file_id
-        ctype = "document"
-    if file_id is None:
-        await message.answer("❌ Iltimos, faqat rasm, video yoki hujjat yuboring. Qayta urinib ko'ring.", reply_markup=get_cancel_kb("back_buyurtma_file_choice"))
-        return
-    await show_progress(message)
-    if not await check_file_for_virus(file_id, ctype):
-        await message.answer("❌ Fayl virusli yoki xavfli deb topildi. Boshqa fayl yuboring.", reply_markup=get_cancel_kb("back_buyurtma_file_choice"))
-        return
-    files.append((ctype, file_id))
-    await state.update_data(files=files)
-    await message.answer("✅ Fayl muvaffaqiyatli yuklandi va tekshirildi. Yana fayl yuboring yoki tugagach tugmani bosing.", reply_markup=KB_FILE_DONE)
-@dp.callback_query(StateFilter(RaqamBuyurtma.file_upload), F.data == "file_done")
+    await handle_file_upload(message, state, "back_buyurtma_file_choice", {
+        'invalid': "❌ Iltimos, faqat rasm, video yoki hujjat yuboring. Qayta urinib ko'ring.",
+        'rejected': "❌ Fayl virusli yoki xavfli deb topildi. Boshqa fayl yuboring.",
+        'clean': "✅ Fayl muvaffaqiyatli yuklandi va tekshirildi. Yana fayl yuboring yoki tugagach tugmani bosing.",
+    })
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.file_upload), F.data == "file_done")
 async def buyurtma_file_done(callback: types.CallbackQuery, state: FSMContext):
+    await state.set_state(RaqamBuyurtma.location)
     await callback.message.answer("📍 <b>Joylashuvni ulashing:</b>", reply_markup=KB_SHARE_LOCATION)
-@dp.message(StateFilter(RaqamBuyurtma.location), F.location)
+@buyurtma_router.message(StateFilter(RaqamBuyurtma.location), F.location)
 async def buyurtma_location_received(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
     ensure_chat_exists(chat_id)
@@ -1631,13 +3014,13 @@ async def buyurtma_location_received(message: types.Message, state: FSMContext):
     data = await state.get_data()
     profile = get_chat_profile(chat_id)
     if profile:
-        await state.update_data(phone=profile.get('telefon', 'Kiritilmagan'))
+        await state.update_data(phone=profile.telefon or 'Kiritilmagan')
         await state.set_state(RaqamBuyurtma.confirm)
         await send_buyurtma_preview(message, state)
     else:
         await state.set_state(RaqamBuyurtma.phone_method)
         await message.answer("📞 <b>Bog'lanish usulini tanlang:</b>\n\n.", reply_markup=KB_BUYURTMA_PHONE)
-@dp.callback_query(StateFilter(RaqamBuyurtma.phone_method), F.data == "phm_username")
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.phone_method), F.data == "phm_username")
 async def buyurtma_phone_username(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -1647,114 +3030,262 @@ async def buyurtma_phone_username(callback: types.CallbackQuery, state: FSMConte
     await state.update_data(phone=contact)
     await state.set_state(RaqamBuyurtma.confirm)
     await send_buyurtma_preview(callback, state)
-@dp.callback_query(StateFilter(RaqamBuyurtma.phone_method), F.data == "phm_text")
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.phone_method), F.data == "phm_text")
 async def buyurtma_phone_text(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(RaqamBuyurtma.phone_text)
-    markup = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Bog'lanish usuliga qaytish", callback_data="back_buyurtma_phone")],
-        [InlineKeyboardButton(text="🏠 Bosh menyu", callback_data="back_main")],
-        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_service")]
-    ])
+    markup = step_back_kb("back_buyurtma_phone", "⬅️ Bog'lanish usuliga qaytish")
     await safe_edit_or_send(callback, "📞 <b>Bog'lanish uchun telefon raqamini kiriting:</b>\n\n.", markup)
-@dp.callback_query(F.data == "back_buyurtma_phone")
-async def back_buyurtma_phone(callback: types.CallbackQuery, state: FSMContext):
-    chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    await state.set_state(RaqamBuyurtma.phone_method)
-    await safe_edit_or_send(callback, "📞 <b>Bog'lanish usulini tanlang:</b>", KB_BUYURTMA_PHONE)
-@dp.message(StateFilter(RaqamBuyurtma.phone_text))
-async def buyurtma_phone_text_entered(message: types.Message, state: FSMContext):
-    chat_id = message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    phone = message.text.strip()
-    if not re.fullmatch(r"\+998\d{9}", phone):
-        await message.reply("❌ Telefon raqami +998 bilan boshlanishi va 12 xonali raqam bo'lishi kerak. Qayta kiriting.", reply_markup=get_cancel_kb("back_buyurtma_phone"))
-        return
-    await state.update_data(phone=phone)
-    await state.set_state(RaqamBuyurtma.confirm)
-    await send_buyurtma_preview(message, state)
-@dp.callback_query(StateFilter(RaqamBuyurtma.confirm), F.data == "confirm_edit")
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.confirm), F.data == "confirm_edit")
 async def confirm_edit(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     await state.set_state(RaqamBuyurtma.phone_method)
     await safe_edit_or_send(callback, "📞 <b>Bog'lanish usulini tahrirlash:</b>", KB_BUYURTMA_PHONE)
-@dp.callback_query(StateFilter(RaqamBuyurtma.confirm), F.data == "confirm_yes")
+@buyurtma_router.callback_query(StateFilter(RaqamBuyurtma.confirm), F.data == "confirm_yes", flags={"throttle": "submit"})
 async def confirm_yes(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
-    ensure_chat_exists(chat_id)
-    update_chat_activity(chat_id)
-    data = await state.get_data()
-    profile = get_chat_profile(chat_id)
-    profile_text = f"\n👤 Ism: {profile.get('ism_familya', '')} | 📞 Telefon: {profile.get('telefon', '')} | 🏙️ Tuman/Mahalla: {profile.get('tuman_mahalla', '')}" if profile else ""
-    loc = data.get('location', {})
-    lat = loc.get('lat', 'N/A')
-    lon = loc.get('lon', 'N/A')
-    maps_link = f"https://maps.google.com/?q={lat},{lon}" if lat != 'N/A' else "Joylashuv berilmagan"
-    txt = (
-        f"📩 <b>Yangi raqam buyurtma so'rovi keldi:</b>\n\n"
-        f"🏘️ Mahalla: {data['mahalla']}\n"
-        f"📝 Qo'shimcha ma'lumot: {data['malumot']}\n"
-        f"📶 Operator: {data['operator']}\n"
-        f"📍 Joylashuv: {maps_link}\n"
-        f"📞 Bog'lanish usuli: {data['phone']}{profile_text}\n\n"
-        f"🆔 Foydalanuvchi ID: {chat_id}\n\n"
-        f"<i>Iltimos, bu so'rovni tez orada ko'rib chiqing va foydalanuvchiga javob bering.</i>"
-    )
-    await bot.send_message(ADMIN_ID, txt)
-    for ctype, fid in data.get('files', []):
-        caption = "📎 Buyurtma fayli (virus tekshiruvi o'tgan)"
-        try:
-            if ctype == "photo":
-                await bot.send_photo(ADMIN_ID, fid, caption=caption)
-            elif ctype == "video":
-                await bot.send_video(ADMIN_ID, fid, caption=caption)
-            else:
-                await bot.send_document(ADMIN_ID, fid, caption=caption)
-        except Exception as e:
-            logger.error(f"Fayl xato: {e}")
-    order_data = data.copy()
-    order_data['chat_id'] = chat_id
-    order_id = save_order(order_data)
-    await bot.send_message(ADMIN_ID, f"<b>Buyurtma ID:</b> {order_id}\n\nBu ID orqali buyurtmani kuzatib borishingiz mumkin.")
-    save_action({'type': 'raqam_buyurtma', 'chat_id': chat_id, 'details': f"Mahalla: {data['mahalla']}, Operator: {data['operator']}, Ma'lumot: {data['malumot']}"})
-    asyncio.create_task(send_reminder(order_id))
+    key = f"{chat_id}:buyurtma:confirm:{callback.message.message_id}"
+    saved = None
+    if not claim_idempotency(key, chat_id):
+        saved = resume_idempotency(key)  # oldingi urinish saqlab, lekin yubora olmagan bo'lsa - davom etiladi
+        if saved is None:
+            await callback.answer("✅ So'rovingiz allaqachon yuborilgan.")
+            return
+    try:
+        ensure_chat_exists(chat_id)
+        update_chat_activity(chat_id)
+        data = await state.get_data()
+        profile = get_chat_profile(chat_id)
+        profile_text = profile.admin_summary if profile else ""
+        loc = data.get('location', {})
+        lat = loc.get('lat', 'N/A')
+        lon = loc.get('lon', 'N/A')
+        maps_link = f"https://maps.google.com/?q={lat},{lon}" if lat != 'N/A' else "Joylashuv berilmagan"
+        if saved is None:
+            order_data = data.copy()
+            order_data['chat_id'] = chat_id
+            order_id = save_order(order_data)
+            record_idempotency(key, order_id)
+            save_action({'type': 'raqam_buyurtma', 'chat_id': chat_id, 'details': f"Mahalla: {data['mahalla']}, Operator: {data['operator']}, Ma'lumot: {data['malumot']}"})
+        else:
+            order_id = saved
+        files = data.get('files', [])
+        files_text = f"\n📎 Fayllar: {len(files)} ta (virus tekshiruvi o'tgan)" if files else ""
+        txt = (
+            f"📩 <b>Yangi raqam buyurtma so'rovi keldi:</b>\n"
+            f"<b>Buyurtma ID:</b> {order_id}\n\n"
+            f"🏘️ Mahalla: {data['mahalla']}\n"
+            f"📝 Qo'shimcha ma'lumot: {data['malumot']}\n"
+            f"📶 Operator: {data['operator']}\n"
+            f"📍 Joylashuv: {maps_link}\n"
+            f"📞 Bog'lanish usuli: {data['phone']}{profile_text}{files_text}\n\n"
+            f"🆔 Foydalanuvchi ID: {chat_id}\n\n"
+            f"<i>Iltimos, bu so'rovni tez orada ko'rib chiqing va foydalanuvchiga javob bering. Buyurtma ID orqali uni kuzatib borishingiz mumkin.</i>"
+        )
+        if await defer_submission(callback, state, 'raqam_buyurtma', txt, files, order_id):
+            return
+        admin_id = assign_operator(chat_id, 'raqam_buyurtma')
+        await notify_admin(txt, chat_id=chat_id, files=files, admin_id=admin_id)
+        asyncio.create_task(send_reminder(order_id, admin_id))
+    except Exception as e:
+        logger.exception(f"buyurtma so'rovi adminga yuborilmadi: {e}")
+        # foydalanuvchi qayta bosganda "allaqachon yuborilgan" deb rad etilmaydi, saqlangan narsa takrorlanmaydi
+        fail_idempotency(key)
+        await callback.answer("❌ Texnik xato: so'rov adminga yuborilmadi. Qayta urinib ko'ring.", show_alert=True)
+        return
     await state.set_state(RaqamBuyurtma.waiting_reply)
     await safe_edit_or_send(callback, "✅ <b>Raqam buyurtma so'rovingiz adminga muvaffaqiyatli yuborildi!</b>\n\nIltimos, kutib turing. So'rov ko'rib chiqilmoqda va javob tez orada keladi. Boshqa xizmatlar uchun menyudan tanlang.", get_main_menu(chat_id))
     asyncio.create_task(send_waiting_reminder(chat_id, "raqam buyurtma so'rovingiz"))
     asyncio.create_task(auto_reset_state(state, chat_id, "Raqam buyurtma so'rovi"))
-@dp.message(StateFilter(RaqamBuyurtma.waiting_reply))
-async def buyurtma_waiting_reply(message: types.Message, state: FSMContext):
+WAITING_REPLY_SERVICES = {
+    RaqamTiklash.waiting_reply.state: ("Raqam tiklash", "tiklash_reply"),
+    Reklama.waiting_reply.state: ("Reklama", "reklama_reply"),
+    RaqamBuyurtma.waiting_reply.state: ("Raqam buyurtma", "buyurtma_reply"),
+}
+@dp.message(StateFilter(RaqamTiklash.waiting_reply, Reklama.waiting_reply, RaqamBuyurtma.waiting_reply), flags={"throttle": "relay"})
+async def service_waiting_reply(message: types.Message, state: FSMContext, raw_state: str):
     chat_id = message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     if not is_in_chat(chat_id):
         return
-    profile = get_chat_profile(chat_id)
-    profile_text = f"\n👤 Ism: {profile.get('ism_familya', '')} | 📞 Telefon: {profile.get('telefon', '')} | 🏙️ Tuman/Mahalla: {profile.get('tuman_mahalla', '')}" if profile else ""
-    txt = f"📨 <b>Raqam buyurtma so'rovi bo'yicha javob:</b>\n\n{message.text or 'Fayl yuborildi'}{profile_text}\n\n🆔 Chat ID: {chat_id}"
+    service, action_type = WAITING_REPLY_SERVICES[raw_state]
     try:
-        if message.photo:
-            await bot.send_photo(ADMIN_ID, message.photo[-1].file_id, caption=txt)
-        elif message.document:
-            await bot.send_document(ADMIN_ID, message.document.file_id, caption=txt)
-        elif message.video:
-            await bot.send_video(ADMIN_ID, message.video.file_id, caption=txt)
-        else:
-            await bot.send_message(ADMIN_ID, txt)
+        await relay_to_operator(message, service)
         await message.answer("✉️ <b>Xabaringiz adminga muvaffaqiyatli yuborildi.</b>\n\nJavobni kuting. Suhbatdan chiqish uchun chiqish tugmasini bosing.", reply_markup=KB_ADMIN_CHAT_EXIT)
-        save_action({'type': 'buyurtma_reply', 'chat_id': chat_id, 'details': message.text or 'media'})
+        save_action({'type': action_type, 'chat_id': chat_id, 'details': message.text or message.caption or message.content_type})
     except Exception as e:
-        logger.error(f"Buyurtma reply xato: {e}")
+        logger.error(f"{service} reply xato: {e}")
         await message.answer("⚠️ Xabar yuborishda texnik xato yuz berdi. Qayta urinib ko'ring.")
+# ----------------- Xizmat oqimlari (deklarativ qadamlar jadvali) -----------------
+# Matn kiritiladigan har bir qadam: qaysi maydonga yoziladi, qanday tekshiriladi, xato bo'lsa qayerga qaytiladi
+# va keyingi holat qanday ko'rsatiladi. Barcha qadamlarni bitta flow_text_step ishlovchisi bajaradi.
+def _tiklash_confirm(data: dict):
+    return (
+        f"📩 <b>Raqam tiklash so'rovini tasdiqlash:</b>\n\n"
+        f"📶 Operator: {data['operator']}\n"
+        f"📱 Tiklanadigan raqam: {data['number']}\n"
+        f"📞 Bog'lanish usuli: {data['contact']}\n\n"
+        f"<i>Bu ma'lumotlar to'g'ri va to'liqmi? Agar ha bo'lsa, so'rov adminga yuboriladi va ko'rib chiqiladi.</i>"
+    ), KB_TIKLASH_CONFIRM
+def _reklama_confirm(data: dict):
+    return (
+        f"📰 <b>Reklama so'rovini tasdiqlash:</b>\n\n"
+        f"🖼️ Reklama turi: {data['ad_type']}\n"
+        f"✍️ Tafsilotlar: {data['details']}\n"
+        f"🎨 Ko'rinish: {data['style']}\n"
+        f"📎 Fayllar soni: {len(data.get('files', []))}\n"
+        f"📞 Bog'lanish: {data['contact']}\n\n"
+        f"<i>Bu ma'lumotlar to'g'ri va to'liqmi? Agar ha bo'lsa, so'rov adminga yuboriladi va ko'rib chiqiladi.</i>"
+    ), KB_REKLAMA_CONFIRM
+def _profil_confirm(data: dict):
+    return (
+        f"👤 <b>Profil ma'lumotlarini tasdiqlash:</b>\n\n"
+        f"👤 Ism va familiya: {data['ism_familya']}\n"
+        f"📞 Telefon raqami: {data['telefon']}\n"
+        f"🏙️ Tuman yoki mahalla: {data['tuman_mahalla']}\n\n"
+        f"<i>Bu ma'lumotlar to'g'ri va to'liqmi? Agar ha bo'lsa, saqlang. Yo'q bo'lsa, tahrirlang.</i>\n\n"
+        f"<b>Eslatma:</b> Profil ma'lumotlari maxfiy saqlanadi va faqat xizmat uchun ishlatiladi."
+    ), KB_CONFIRM_PROFIL
+def _buyurtma_preview(data: dict):
+    loc = data.get('location', {})
+    return (
+        f"🧾 Buyurtma ma'lumotlari:\n"
+        f"🏘️ Mahalla: {data.get('mahalla', 'Kiritilmagan')}\n"
+        f"📝 Qo'shimcha ma'lumot: {data.get('malumot', 'Kiritilmagan')}\n"
+        f"📶 Operator: {data.get('operator', 'Kiritilmagan')}\n"
+        f"📍 Joylashuv: {loc.get('lat', 'N/A')}, {loc.get('lon', 'N/A')}\n"
+        f"📞 Bog'lanish usuli: {data.get('phone', 'Kiritilmagan')}\n\n"
+        f"Bu ma'lumotlar to'g'ri va to'liqmi? Agar yo'q bo'lsa, tahrirlang."
+    ), KB_CONFIRM_SEND
+PHONE_UZ = r"\+998\d{9}"
+PROFIL_EDITED = "\n\nBoshqa o'zgarishlar uchun menyudan tanlang yoki 'Saqlash' tugmasini bosing."
+FLOW_STEPS = (
+    # --- Profil yaratish ---
+    (Profil.ism_familya, {
+        'field': 'ism_familya', 'min_len': 2, 'back': None, 'next': Profil.telefon,
+        'error': "❌ Ism va familiya to'liq va to'g'ri kiriting. Kamida 2 harf bo'lishi kerak. Qayta urinib ko'ring.",
+        'prompt': "📞 <b>Profil yaratish bosqichi 2/3:</b>\n\nTelefon raqamingizni kiriting (masalan: +99895....47). Faqat O'zbekiston raqamlari qabul qilinadi.",
+        'kb': get_cancel_kb(),
+    }),
+    (Profil.telefon, {
+        'field': 'telefon', 'pattern': r"\+?\d{9,15}", 'back': None, 'next': Profil.tuman_mahalla,
+        'error': "❌ Telefon raqami noto'g'ri formatda. +998 bilan boshlanishi va 9-12 xonali raqam bo'lishi kerak. Qayta kiriting.",
+        'prompt': "🏙️ <b>Profil yaratish bosqichi 3/3:</b>\n\nTuman yoki mahallangizni kiriting (masalan: 'sherobod tumani, katta hayot mahallasi'):",
+        'kb': get_cancel_kb(),
+    }),
+    (Profil.tuman_mahalla, {
+        'field': 'tuman_mahalla', 'min_len': 2, 'back': None, 'next': Profil.confirm,
+        'error': "❌ Tuman yoki mahalla nomini to'liq kiriting. Qayta urinib ko'ring.",
+        'render': _profil_confirm,
+    }),
+    # --- Profil tahrirlash ---
+    (Profil.edit_ism_familya, {
+        'field': 'edit_ism_familya', 'min_len': 2, 'back': "back_profil", 'next': Profil.edit_choice,
+        'error': "❌ Ism va familiya to'liq va to'g'ri kiriting. Qayta urinib ko'ring.",
+        'prompt': "✅ <b>Ism va familiya muvaffaqiyatli yangilandi.</b>" + PROFIL_EDITED, 'kb': KB_PROFIL_EDIT,
+    }),
+    (Profil.edit_telefon, {
+        'field': 'edit_telefon', 'pattern': r"\+?\d{9,15}", 'back': "back_profil", 'next': Profil.edit_choice,
+        'error': "❌ Telefon raqami noto'g'ri formatda. +998 bilan boshlanishi va 9-12 xonali raqam bo'lishi kerak. Qayta kiriting.",
+        'prompt': "✅ <b>Telefon raqam muvaffaqiyatli yangilandi.</b>" + PROFIL_EDITED, 'kb': KB_PROFIL_EDIT,
+    }),
+    (Profil.edit_tuman_mahalla, {
+        'field': 'edit_tuman_mahalla', 'min_len': 2, 'back': "back_profil", 'next': Profil.edit_choice,
+        'error': "❌ Tuman yoki mahalla nomini to'liq kiriting. Qayta urinib ko'ring.",
+        'prompt': "✅ <b>Tuman/mahalla muvaffaqiyatli yangilandi.</b>" + PROFIL_EDITED, 'kb': KB_PROFIL_EDIT,
+    }),
+    # --- Raqam tiklash ---
+    (RaqamTiklash.number, {
+        'field': 'number', 'pattern': r"(\+998)?\d{9}", 'back': "back_tiklash_op", 'next': RaqamTiklash.contact_method,
+        'transform': lambda text: text if text.startswith("+998") else "+998" + text.lstrip("+"),
+        'error': "❌ Telefon raqami noto'g'ri formatda. +998 bilan boshlanishi mumkin. Masalan:+99895.....27. Qayta kiriting.",
+        'prompt': "📞 <b>Raqam tiklash bosqichi 3/3:</b>\n\nBog'lanish usulini tanlang.", 'kb': KB_TIKLASH_CONTACT,
+    }),
+    (RaqamTiklash.contact_text, {
+        'field': 'contact', 'pattern': PHONE_UZ, 'back': "back_tiklash_ctm", 'next': RaqamTiklash.confirm,
+        'error': "❌ Telefon raqami +998 bilan boshlanishi va 12 xonali raqam bo'lishi kerak. Masalan: +99891.....66. Qayta kiriting.",
+        'render': _tiklash_confirm,
+    }),
+    # --- Reklama ---
+    (Reklama.details, {
+        'field': 'details', 'min_len': 10, 'back': "back_reklama_type", 'next': Reklama.style,
+        'error': "❌ Reklama tafsilotlari yetarlicha batafsil emas. Kamida 10 ta belgi bo'lishi va aniq ma'lumot berilishi kerak. Qayta yozing.",
+        'prompt': "🎨 <b>Reklama ko'rinishini tasvirlang:</b>\n\nReklama dizayni haqida ma'lumot bering (fon rangi, shrift turi, rasmlar and h.k.). Iltimos, batafsil yozing.",
+        'kb': get_cancel_kb("back_reklama_type"),
+    }),
+    (Reklama.style, {
+        'field': 'style', 'min_len': 5, 'back': "back_reklama_type", 'next': Reklama.attach_choice,
+        'error': "❌ Reklama ko'rinishi haqida ma'lumot yetarlicha emas. Qayta yozing.",
+        'prompt': "📎 <b>Fayl qo'shish:</b>\n\nReklama uchun rasm, video yoki hujjat fayl qo'shmoqchimisiz? (Masalan, dizayn namunasi). Ha/Yo'q tanlang.",
+        'kb': KB_REKLAMA_ATTACH,
+    }),
+    (Reklama.contact_text, {
+        'field': 'contact', 'pattern': PHONE_UZ, 'back': "back_reklama_contact", 'next': Reklama.confirm,
+        'error': "❌ Telefon raqami +998 bilan boshlanishi va 12 xonali raqam bo'lishi kerak. Qayta kiriting.",
+        'render': _reklama_confirm,
+    }),
+    # --- Raqam buyurtma ---
+    (RaqamBuyurtma.data, {
+        'field': 'malumot', 'min_len': 10, 'back': "back_buyurtma_mah", 'next': RaqamBuyurtma.operator,
+        'error': "❌ Qo'shimcha ma'lumot yetarlicha batafsil emas. Kamida 10 ta belgi bo'lishi kerak. Batafsilroq Qayta yozing.",
+        'prompt': "📶 <b>Raqam buyurtma bosqichi 3/5:</b>\n\nQaysi operator raqamini xohlaysiz? Tanlang.", 'kb': KB_BUYURTMA_OPERATOR,
+    }),
+    (RaqamBuyurtma.phone_text, {
+        'field': 'phone', 'pattern': PHONE_UZ, 'back': "back_buyurtma_phone", 'next': RaqamBuyurtma.confirm,
+        'error': "❌ Telefon raqami +998 bilan boshlanishi va 12 xonali raqam bo'lishi kerak. Qayta kiriting.",
+        'render': _buyurtma_preview,
+    }),
+)
+# "Orqaga" tugmalari: callback_data -> (holat, matn, klaviatura)
+FLOW_BACK = {
+    "back_tiklash_op": (RaqamTiklash.operator, "📱 <b>Raqam tiklash xizmati:</b>\n\nOperatorni tanlang.", KB_TIKLASH_OPERATOR),
+    "back_tiklash_number": (RaqamTiklash.number, "📱 <b>Raqam tiklash bosqichi 2/3:</b>\n\nTiklanishi kerak bo'lgan telefon raqamingizni kiriting.", step_back_kb("back_tiklash_op", "⬅️ Operator tanlashga qaytish")),
+    "back_tiklash_ctm": (RaqamTiklash.contact_method, "📞 <b>Bog'lanish usulini tanlang:</b>", KB_TIKLASH_CONTACT),
+    "back_tiklash_contact": (RaqamTiklash.contact_method, "📞 <b>Bog'lanish usulini tanlang:</b>", KB_TIKLASH_CONTACT),
+    "back_reklama_type": (Reklama.ad_type, "📰 <b>Reklama turini tanlang:</b>", KB_REKLAMA_TYPES),
+    "back_reklama_attach": (Reklama.attach_choice, "📎 <b>Fayl qo'shish:</b>\n\nReklama uchun rasm, video yoki hujjat fayl qo'shmoqchimisiz? Ha/Yo'q tanlang.", KB_REKLAMA_ATTACH),
+    "back_reklama_contact": (Reklama.contact_method, "📞 <b>Bog'lanish usulini tanlang:</b>", KB_REKLAMA_CONTACT),
+    "back_buyurtma_mah": (RaqamBuyurtma.mahalla, "🆕 <b>Mahalla tanlash:</b>\n\nQuyidagi sahifadan mahallangizni tanlang yoki nomini yozib yuboring.", kb_mahalla_page(0)),
+    "back_buyurtma_op": (RaqamBuyurtma.operator, "📶 <b>Operator tanlash:</b>", KB_BUYURTMA_OPERATOR),
+    "back_buyurtma_file_choice": (RaqamBuyurtma.file_choice, "📎 <b>Fayl qo'shish:</b>", yes_no_kb("file_yes", "file_no", "back_buyurtma_op")),
+    "back_buyurtma_phone": (RaqamBuyurtma.phone_method, "📞 <b>Bog'lanish usulini tanlang:</b>", KB_BUYURTMA_PHONE),
+}
+FLOW_TEXT_STEPS = {st.state: step for st, step in FLOW_STEPS}
+def _step_accepts(step: dict, text: str) -> bool:
+    if 'pattern' in step:
+        return re.fullmatch(step['pattern'], text) is not None
+    return len(text) >= step.get('min_len', 1)
+@dp.message(StateFilter(*(st for st, _ in FLOW_STEPS)))
+async def flow_text_step(message: types.Message, state: FSMContext, raw_state: str):
+    chat_id = message.chat.id
+    ensure_chat_exists(chat_id)
+    update_chat_activity(chat_id)
+    step = FLOW_TEXT_STEPS[raw_state]
+    value = (message.text or "").strip()
+    if not _step_accepts(step, value):
+        await message.reply(step['error'], reply_markup=get_cancel_kb(step['back']))
+        return
+    if 'transform' in step:
+        value = step['transform'](value)
+    data = await state.update_data({step['field']: value})
+    await state.set_state(step['next'])
+    text, markup = step['render'](data) if 'render' in step else (step['prompt'], step['kb'])
+    await message.answer(text, reply_markup=markup)
+@dp.callback_query(F.data.in_(FLOW_BACK))
+async def flow_back(callback: types.CallbackQuery, state: FSMContext):
+    chat_id = callback.message.chat.id
+    ensure_chat_exists(chat_id)
+    update_chat_activity(chat_id)
+    target, text, markup = FLOW_BACK[callback.data]
+    await state.set_state(target)
+    await safe_edit_or_send(callback, text, markup)
 # ----------------- Admin orders -----------------
-@dp.callback_query(F.data == "admin_orders", F.from_user.id == ADMIN_ID)
+@admin_router.callback_query(F.data == "admin_orders")
 async def admin_orders(callback: types.CallbackQuery, state: FSMContext):
     orders = get_orders()
     if not orders:
@@ -1765,146 +3296,98 @@ async def admin_orders(callback: types.CallbackQuery, state: FSMContext):
             ts = datetime.fromtimestamp(odata['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
             malumot = odata.get('malumot', 'Qisqa')[:50] + '...' if len(odata.get('malumot', '')) > 50 else odata.get('malumot', 'N/A')
             text += f"🆔 ID {oid} ({ts}): Operator - {odata.get('operator', 'N/A')}, Mahalla - {odata.get('mahalla', 'N/A')}, Ma'lumot - {malumot}\n"
-    await safe_edit_or_send(callback, text, get_main_menu(ADMIN_ID))
-@dp.callback_query(F.data == "admin_stats", F.from_user.id == ADMIN_ID)
+    await safe_edit_or_send(callback, text, get_main_menu(callback.from_user.id))
+@admin_router.callback_query(F.data == "admin_stats")
 async def admin_stats(callback: types.CallbackQuery, state: FSMContext):
     total = get_total_chats()
     avg = get_average_rating()
     stats = get_service_stats()
     text = f"📊 <b>Bot statistikasi:</b>\n\n👥 Jami ro'yxatdan o'tgan foydalanuvchilar: {total}\n"
+    text += "🟢 Faol foydalanuvchilar: " + ", ".join(f"{label} - {n}" for label, n in presence.counts().items()) + "\n"
     if avg > 0:
         text += f"🌟 O'rtacha baho (chat uchun): {avg}/5\n"
     text += f"\n📈 Xizmatlar bo'yicha buyurtmalar (oxirgi 24 soat):\n{chr(10).join([f'{k}: {v} ta' for k, v in stats.items()])}"
-    await safe_edit_or_send(callback, text, get_main_menu(ADMIN_ID))
-@dp.callback_query(F.data == "admin_users", F.from_user.id == ADMIN_ID)
+    await safe_edit_or_send(callback, text, get_main_menu(callback.from_user.id))
+@admin_router.callback_query(F.data == "admin_users")
 async def admin_users(callback: types.CallbackQuery, state: FSMContext):
     """Show first page (page=0) of users (10 per page)."""
     await _send_admin_users_page(callback, page=0)
 
-@dp.callback_query(F.data.startswith("admin_users_page_"), F.from_user.id == ADMIN_ID)
-async def admin_users_page(callback: types.CallbackQuery, state: FSMContext):
-    try:
-        page = int(callback.data.split("_")[-1])
-    except Exception:
-        page = 0
-    await _send_admin_users_page(callback, page=page)
+@admin_router.callback_query(UsersPageCb.filter())
+async def admin_users_page(callback: types.CallbackQuery, state: FSMContext, callback_data: UsersPageCb):
+    await _send_admin_users_page(callback, page=max(callback_data.page, 0))
 
+async def _telegram_display_names(chat_ids) -> dict:
+    """Telegram'dagi to'liq ism va @username: barcha get_chat so'rovlari parallel yuboriladi."""
+    async def fetch(cid):
+        try:
+            chat = await bot.get_chat(cid)
+        except Exception as e:
+            logger.debug("bot.get_chat failed for %s: %s", cid, e)
+            return cid, None, None
+        full_name = getattr(chat, "full_name", None) or " ".join(p for p in (chat.first_name, chat.last_name) if p) or None
+        username = f"@{chat.username}" if getattr(chat, "username", None) else None
+        return cid, full_name, username
+    return {cid: (full_name, username) for cid, full_name, username in await asyncio.gather(*(fetch(cid) for cid in chat_ids))}
+async def _render_user_rows(users: list) -> tuple:
+    names = await _telegram_display_names([u['id'] for u in users])
+    listed, text = [], ""
+    for idx, user in enumerate(users, start=1):
+        full_name, username = names.get(user['id'], (None, None))
+        display = f"{full_name} {username or ''}".strip() if full_name else user['name']
+        listed.append({'id': user['id'], 'name': display, 'username': username or ''})
+        text += f"{idx}. {display} (ID: {user['id']})\n"
+    return listed, text
 async def _send_admin_users_page(obj, page: int = 0):
+    admin_id = obj.from_user.id
     per_page = 10
     offset = page * per_page
-    with get_db_conn() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM chats")
-        total = cursor.fetchone()[0] or 0
-        cursor.execute("SELECT chat_id, profile, last_active FROM chats ORDER BY last_active DESC LIMIT ? OFFSET ?", (per_page, offset))
-        rows = cursor.fetchall()
+    rows, total = get_all_users_with_names(page, per_page)
     if not rows:
-        await safe_edit_or_send(obj, "📋 Foydalanuvchilar ro'yxati bo'sh.", get_main_menu(ADMIN_ID))
-        admin_last_user_list.pop(ADMIN_ID, None)
+        await safe_edit_or_send(obj, "📋 Foydalanuvchilar ro'yxati bo'sh.", get_main_menu(admin_id))
+        admin_last_user_list.pop(admin_id, None)
         return
-    users = []
-    text = f"👥 <b>Foydalanuvchilar (sahifa {page+1}, jami: {total} ta):</b>\n\n"
-    for idx, row in enumerate(rows, start=1):
-        cid = row[0]
-        profile_json = row[1]
-        display = None
-        username = None
-        try:
-            chat = await bot.get_chat(cid)
-            full_name = getattr(chat, "full_name", None)
-            if not full_name:
-                parts = []
-                if getattr(chat, "first_name", None):
-                    parts.append(chat.first_name)
-                if getattr(chat, "last_name", None):
-                    parts.append(chat.last_name)
-                full_name = " ".join(parts).strip() if parts else None
-            username = f"@{chat.username}" if getattr(chat, "username", None) else None
-            if full_name:
-                display = f"{full_name} {username or ''}".strip()
-        except Exception as e:
-            logger.debug(f"bot.get_chat failed for {cid}: {e}")
-        if not display and profile_json:
-            try:
-                prof = json.loads(profile_json)
-                display = prof.get('ism_familya') or prof.get('telefon') or None
-            except Exception:
-                display = None
-        if not display:
-            display = f"User {cid}"
-        users.append({'id': cid, 'name': display, 'username': username or ''})
-        text += f"{idx}. {display} (ID: {cid})\n"
+    users, listing = await _render_user_rows(rows)
+    text = f"👥 <b>Foydalanuvchilar (sahifa {page+1}, jami: {total} ta):</b>\n\n" + listing
     # navigatsiya klaviaturasi
     kb_rows = []
     nav = []
     if page > 0:
-        nav.append(InlineKeyboardButton(text="⬅️ Oldingi", callback_data=f"admin_users_page_{page-1}"))
+        nav.append(InlineKeyboardButton(text="⬅️ Oldingi", callback_data=UsersPageCb(page=page - 1).pack()))
     if (offset + per_page) < total:
-        nav.append(InlineKeyboardButton(text="➡️ Keyingi", callback_data=f"admin_users_page_{page+1}"))
+        nav.append(InlineKeyboardButton(text="➡️ Keyingi", callback_data=UsersPageCb(page=page + 1).pack()))
     if nav:
         kb_rows.append(nav)
     kb_rows.append([InlineKeyboardButton(text="⬅️ Bosh menyu", callback_data="back_main")])
     kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
 # oxirgi ko'rsatilgan sahifani saqlang
-    admin_last_user_list[ADMIN_ID] = {'page': page, 'users': users, 'total': total}
+    admin_last_user_list[admin_id] = {'page': page, 'users': users, 'total': total}
     text += "\n❗ Tanlangan tartib raqamini yuboring (masalan: 1) — bot tanlangan foydalanuvchi uchun amallarni ko'rsatadi."
     await safe_edit_or_send(obj, text, kb)
 
+BLOCKED_LIST_LIMIT = 50
 # ----------------- Administrator tomonidan bloklangan foydalanuvchilar (bir xil xatti-harakatlarni saqlaydi, lekin oxirgi ro'yxatni saqlaydi) -----------------
-@dp.callback_query(F.data == "admin_blocked", F.from_user.id == ADMIN_ID)
+@admin_router.callback_query(F.data == "admin_blocked")
 async def admin_blocked(callback: types.CallbackQuery, state: FSMContext):
-    with get_db_conn() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT chat_id, profile, last_active FROM chats WHERE banned = 1 ORDER BY last_active DESC")
-        rows = cursor.fetchall()
+    rows, total = get_all_users_with_names(0, BLOCKED_LIST_LIMIT, banned_only=True)
     if not rows:
-        await safe_edit_or_send(callback, "🚫 Hozircha bloklangan foydalanuvchilar yo'q.", get_main_menu(ADMIN_ID))
-        admin_last_user_list.pop(ADMIN_ID, None)
+        await safe_edit_or_send(callback, "🚫 Hozircha bloklangan foydalanuvchilar yo'q.", get_main_menu(callback.from_user.id))
+        admin_last_user_list.pop(callback.from_user.id, None)
         return
-    users = []
-    text = f"🚫 <b>Bloklangan foydalanuvchilar ({len(rows)}):</b>\n\n"
-    for idx, row in enumerate(rows, start=1):
-        cid = row[0]
-        profile_json = row[1]
-        display = None
-        username = None
-     # Telegram foydalanuvchi nomi/ismini olishga harakat qiling
-        try:
-            chat = await bot.get_chat(cid)
-            full_name = getattr(chat, "full_name", None)
-            if not full_name:
-                parts = []
-                if getattr(chat, "first_name", None):
-                    parts.append(chat.first_name)
-                if getattr(chat, "last_name", None):
-                    parts.append(chat.last_name)
-                full_name = " ".join(parts).strip() if parts else None
-            username = f"@{chat.username}" if getattr(chat, "username", None) else None
-            if full_name:
-                display = f"{full_name} {username or ''}".strip()
-        except Exception as e:
-            logger.debug(f"bot.get_chat failed for blocked user {cid}: {e}")
-        if not display and profile_json:
-            try:
-                prof = json.loads(profile_json)
-                display = prof.get('ism_familya') or prof.get('telefon') or None
-            except Exception:
-                display = None
-        if not display:
-            display = f"User {cid}"
-        users.append({'id': cid, 'name': display, 'username': username or ''})
-        text += f"{idx}. {display} (ID: {cid})\n"
-    admin_last_user_list[ADMIN_ID] = {'page': 0, 'users': users, 'total': len(users)}
+    users, listing = await _render_user_rows(rows)
+    shown = f"{len(rows)}" if total == len(rows) else f"so'nggi {len(rows)} / {total}"
+    text = f"🚫 <b>Bloklangan foydalanuvchilar ({shown}):</b>\n\n" + listing
+    admin_last_user_list[callback.from_user.id] = {'page': 0, 'users': users, 'total': len(users)}
     text += "\n❗ Tanlangan tartib raqamini yuboring (masalan: 1) — bot tanlangan foydalanuvchi uchun blokdan ochish tugmasini chiqaradi."
     kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Bosh menyu", callback_data="back_main")]])
     await safe_edit_or_send(callback, text, kb)
 
 # ----------------- Administrator uchun bitta raqamli ishlov beruvchi -> oxirgi ko'rsatilgan ro'yxatda ishlaydi -----------------
-@dp.message(F.chat.id == ADMIN_ID, F.text.regexp(r"^\d+$"))
+@admin_router.message(F.text.regexp(r"^\d+$"), ~F.reply_to_message, lambda m: m.chat.id in admin_last_user_list or not sessions_by_admin.get(m.chat.id))
 async def admin_user_action_by_number(message: types.Message):
     try:
         idx = int(message.text.strip()) - 1
-        entry = admin_last_user_list.get(ADMIN_ID)
+        entry = admin_last_user_list.get(message.chat.id)
         if not entry:
             await message.answer("❌ Avval ro'yxatni oching (Foydalanuvchilar yoki Bloklanganlar).")
             return
@@ -1917,28 +3400,29 @@ async def admin_user_action_by_number(message: types.Message):
         name = user['name']
         if is_banned(chat_id):
             kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=f"🔓 {name} blokdan chiqarish", callback_data=f"admin_unblock_{chat_id}")],
+                [InlineKeyboardButton(text=f"🔓 {name} blokdan chiqarish", callback_data=UserActionCb(action="unblock", user_id=chat_id).pack())],
                 [InlineKeyboardButton(text="⬅️ Bosh menyu", callback_data="back_main")]
             ])
         else:
             kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=f"💬 {name} bilan chat ochish", callback_data=f"admin_chat_with_{chat_id}")],
-                [InlineKeyboardButton(text=f"🚫 {name} ni bloklash", callback_data=f"admin_block_{chat_id}")],
+                [InlineKeyboardButton(text=f"💬 {name} bilan chat ochish", callback_data=UserActionCb(action="chat", user_id=chat_id).pack())],
+                [InlineKeyboardButton(text=f"🚫 {name} ni bloklash", callback_data=UserActionCb(action="block", user_id=chat_id).pack())],
                 [InlineKeyboardButton(text="⬅️ Bosh menyu", callback_data="back_main")]
             ])
         await message.answer(f"👤 Foydalanuvchi: {name} (ID: {chat_id})\n\nQuyidagi harakatni tanlang:", reply_markup=kb)
       # tasodifiy qayta ishlatmaslik uchun oxirgi ko'rsatilgan ro'yxatni tozalang
-        admin_last_user_list.pop(ADMIN_ID, None)
+        admin_last_user_list.pop(message.chat.id, None)
     except Exception as e:
         logger.error(f"admin numeric action error: {e}")
         await message.answer("❌ Xato yuz berdi. Qayta urinib ko'ring.")
 
 # ----------------- Blokdan chiqarish ishlovchisi (mavjud xatti-harakatlarni saqlaydi) -----------------
-@dp.callback_query(F.data.startswith("admin_unblock_"), F.from_user.id == ADMIN_ID)
-async def admin_unblock_user(callback: types.CallbackQuery, state: FSMContext):
+@admin_router.callback_query(UserActionCb.filter(F.action == "unblock"))
+async def admin_unblock_user(callback: types.CallbackQuery, state: FSMContext, callback_data: UserActionCb):
     try:
-        chat_id = int(callback.data.split("_")[-1])
+        chat_id = callback_data.user_id
         set_banned(chat_id, False)
+        close_chat_session(chat_id)
         set_in_chat(chat_id, False)
         await callback.message.edit_text(f"✅ Foydalanuvchi {chat_id} blokdan olindi va chatga ruxsat berildi.")
         try:
@@ -1950,8 +3434,19 @@ async def admin_unblock_user(callback: types.CallbackQuery, state: FSMContext):
         logger.error(f"Unblock xato: {e}")
         await callback.answer("❌ Blokni ochishda xato yuz berdi.", show_alert=True)
 
+@admin_router.callback_query(UserActionCb.filter(F.action == "block"))
+async def admin_block_user(callback: types.CallbackQuery, state: FSMContext, callback_data: UserActionCb):
+    chat_id = callback_data.user_id
+    if is_admin(chat_id):
+        await callback.answer("❌ Adminni bloklab bo'lmaydi.", show_alert=True)
+        return
+    set_banned(chat_id, True)
+    close_chat_session(chat_id)
+    await callback.message.edit_text(f"🚫 Foydalanuvchi {chat_id} bloklandi.")
+    save_action({'type': 'admin_block', 'chat_id': chat_id, 'details': f"Blocked by {callback.from_user.id}"})
+
 # ----------------- Admin Panel  -----------------
-@dp.callback_query(F.data == "admin_panel", F.from_user.id == ADMIN_ID)
+@admin_router.callback_query(F.data == "admin_panel")
 async def admin_panel(callback: types.CallbackQuery, state: FSMContext):
     """
     Show admin panel keyboard to authorized admin.
@@ -1963,17 +3458,25 @@ async def admin_panel(callback: types.CallbackQuery, state: FSMContext):
         logger.exception(f"admin_panel handler error: {e}")
         await callback.answer("❌ Admin panelni ochishda xato yuz berdi.", show_alert=True)
 
+@admin_router.callback_query(DigestCb.filter())
+async def admin_digest_page(callback: types.CallbackQuery, state: FSMContext, callback_data: DigestCb):
+    text, kb = render_digest_page(callback_data.digest_id, callback_data.page)
+    if not text:
+        await callback.answer("❌ Bu to'plam endi mavjud emas.", show_alert=True)
+        return
+    await safe_edit_or_send(callback, text, kb)
+
 # ----------------- Yangi: administrator foydalanuvchi va administrator bloklarini ishlovchilar bilan suhbatni boshlaydi -----------------
-@dp.callback_query(F.data.startswith("admin_chat_with_"), F.from_user.id == ADMIN_ID)
-async def admin_chat_with_user(callback: types.CallbackQuery, state: FSMContext):
+@admin_router.callback_query(UserActionCb.filter(F.action == "chat"))
+async def admin_chat_with_user(callback: types.CallbackQuery, state: FSMContext, callback_data: UserActionCb):
     """
     Admin admin_users ro'yxatidan foydalanuvchi bilan chat ochadi.
     """
     try:
-        target_id = int(callback.data.split("_")[-1])
-        set_in_chat(target_id, True)
-        # record that admin is actively chatting with target
-        admin_chat_targets[ADMIN_ID] = target_id
+        target_id = callback_data.user_id
+        admin_id = callback.from_user.id
+        # sessiya ochiladi; admin bir vaqtning o'zida bir nechta suhbatni olib borishi mumkin
+        open_chat_session(admin_id, target_id)
 
        # administratorni xabardor qilish (xabarni tahrirlash)
         await callback.message.edit_text(f"✅ Admin {target_id} bilan chat boshlandi. Endi admin tomonidan yuboriladigan xabarlar shu foydalanuvchiga yo'naltiriladi.")
@@ -1985,16 +3488,17 @@ async def admin_chat_with_user(callback: types.CallbackQuery, state: FSMContext)
             logger.warning(f"admin_chat_with_user: foydalanuvchi {target_id} ga xabar yuborilmadi.")
         # aniqlik uchun adminni shaxsiy xabarda ham xabardor qilish
         try:
-            await bot.send_message(ADMIN_ID, f"📞 Siz {target_id} ID li foydalanuvchi bilan chatni boshladingiz.\n\nFoydalanuvchi javob berganida u avtomatik adminga yuboriladi.", reply_markup=KB_ADMIN_CHAT_EXIT)
+            await bot.send_message(admin_id, f"📞 Siz {target_id} ID li foydalanuvchi bilan chatni boshladingiz.\n\nFoydalanuvchi javob berganida u avtomatik adminga yuboriladi. Bir nechta suhbat bo'lsa, kerakli foydalanuvchi xabariga reply qilib javob yozing.", reply_markup=admin_chat_exit_kb(target_id))
         except Exception:
             pass
-        save_action({'type': 'admin_chat_start', 'chat_id': ADMIN_ID, 'details': f"Chat with {target_id}"})
+        save_action({'type': 'admin_chat_start', 'chat_id': admin_id, 'details': f"Chat with {target_id}"})
     except Exception as e:
         logger.exception(f"admin_chat_with_user xato: {e}")
         await callback.answer("❌ Chatni boshlashda xato yuz berdi.", show_alert=True)
 
 # New: user requests admin chat -> send admin a confirmation request with inline buttons
-@dp.callback_query(F.data == "admin_chat")
+ADMIN_CHAT_REQUEST_WINDOW = 900  # javobsiz chat so'rovi shuncha vaqt takror yuborilmaydi
+@dp.callback_query(F.data == "admin_chat", flags={"throttle": "admin_request"})
 async def user_request_admin_chat(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
@@ -2002,29 +3506,35 @@ async def user_request_admin_chat(callback: types.CallbackQuery, state: FSMConte
     if is_banned(chat_id):
         await callback.answer("❌ Siz botdan bloklangansiz. Admin bilan bog'lanish mumkin emas.", show_alert=True)
         return
+    # ochiq so'rov bo'lsa operatorga qayta yuborilmaydi; kalit operator javob berganda bo'shatiladi
+    if not claim_idempotency(f"{chat_id}:admin_chat", chat_id, persist=False, window=ADMIN_CHAT_REQUEST_WINDOW):
+        await callback.answer("📨 So'rovingiz allaqachon adminga yuborilgan. Javobni kuting.", show_alert=True)
+        return
     # build profile/context for admin
-    profile = get_chat_profile(chat_id) or {}
+    profile = get_chat_profile(chat_id) or Profile("Noma'lum", "N/A", "N/A")
     prof_text = (
-        f'👤 Ism: {profile.get("ism_familya", "Noma\\'lum")} \n'
-        f'📞 Telefon: {profile.get("telefon", "N/A")}\n'
-        f'📍 Tuman/Mahalla: {profile.get("tuman_mahalla", "N/A")}\n'
+        f"👤 Ism: {profile.ism_familya} \n"
+        f"📞 Telefon: {profile.telefon}\n"
+        f"📍 Tuman/Mahalla: {profile.tuman_mahalla}\n"
     )
     user_name = callback.from_user.full_name or callback.from_user.username or f"User {chat_id}"
     # inline keyboard for admin to accept/decline
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Tasdiqlayman (chatni boshlash)", callback_data=f"admin_accept_chat_{chat_id}")],
-        [InlineKeyboardButton(text="❌ Rad etish", callback_data=f"admin_decline_chat_{chat_id}")],
+        [InlineKeyboardButton(text="✅ Tasdiqlayman (chatni boshlash)", callback_data=UserActionCb(action="accept", user_id=chat_id).pack())],
+        [InlineKeyboardButton(text="❌ Rad etish", callback_data=UserActionCb(action="decline", user_id=chat_id).pack())],
         [InlineKeyboardButton(text="⬅️ Bosh menyu", callback_data="back_main")]
     ])
-    # notify admin
+    # notify the least-loaded operator (chat so'rovlari shoshilinch - digestga tushmaydi)
     try:
-        await bot.send_message(
-            ADMIN_ID,
+        await notify_admin(
             f"📩 Adminga so'rov:\n\n{user_name} (ID: {chat_id}) siz bilan chat boshlamoqchi.\n\n{prof_text}\n\n<b>So'rovni tasdiqlaysizmi?</b>",
-            reply_markup=kb
+            urgent=True,
+            reply_markup=kb,
+            admin_id=assign_operator(chat_id, 'chat_request')
         )
     except Exception as e:
         logger.exception(f"Failed to send admin chat request to admin: {e}")
+        release_idempotency(f"{chat_id}:admin_chat")
         await safe_edit_or_send(callback, "❌ Texnik xato: adminga so'rov yuborilmadi. Qayta urinib ko'ring.", get_main_menu(chat_id))
         return
 
@@ -2033,16 +3543,13 @@ async def user_request_admin_chat(callback: types.CallbackQuery, state: FSMConte
     save_action({'type': 'admin_chat_request', 'chat_id': chat_id, 'details': 'User requested admin chat'})
 
 # New: admin accepts the user chat request
-@dp.callback_query(F.data.startswith("admin_accept_chat_"), F.from_user.id == ADMIN_ID)
-async def admin_accept_chat(callback: types.CallbackQuery, state: FSMContext):
-    try:
-        target_id = int(callback.data.split("_")[-1])
-    except Exception:
-        await callback.answer("❌ Noto'g'ri foydalanuvchi ID.", show_alert=True)
-        return
-    # set mapping and flags
-    admin_chat_targets[ADMIN_ID] = target_id
-    set_in_chat(target_id, True)
+@admin_router.callback_query(UserActionCb.filter(F.action == "accept"))
+async def admin_accept_chat(callback: types.CallbackQuery, state: FSMContext, callback_data: UserActionCb):
+    target_id = callback_data.user_id
+    release_idempotency(f"{target_id}:admin_chat")
+    # set mapping and flags (so'rovni tasdiqlagan operator suhbatni o'z zimmasiga oladi)
+    admin_id = callback.from_user.id
+    open_chat_session(admin_id, target_id)
     # edit admin's message to reflect acceptance
     try:
         await callback.message.edit_text(f"✅ Siz {target_id} bilan chatni tasdiqladingiz. Chat boshlandi.")
@@ -2050,24 +3557,22 @@ async def admin_accept_chat(callback: types.CallbackQuery, state: FSMContext):
         pass
     # notify admin (private) and user
     try:
-        await bot.send_message(ADMIN_ID, f"📞 Chat boshlandi: foydalanuvchi {target_id} bilan endi suhbatdasiz.", reply_markup=KB_ADMIN_CHAT_EXIT)
+        await bot.send_message(admin_id, f"📞 Chat boshlandi: foydalanuvchi {target_id} bilan endi suhbatdasiz. Bir nechta suhbat bo'lsa, kerakli foydalanuvchi xabariga reply qilib javob yozing.", reply_markup=admin_chat_exit_kb(target_id))
     except Exception:
         pass
     try:
         await bot.send_message(target_id, "📞 Admin so'rovingizni qabul qildi. Chat boshlandi. Endi savolingizni yozing. Suhbatdan chiqish uchun 'Admin chatdan chiqish' tugmasini bosing.", reply_markup=KB_ADMIN_CHAT_EXIT)
     except Exception:
         logger.warning(f"Could not notify user {target_id} about accepted admin chat.")
-    save_action({'type': 'admin_chat_accepted', 'chat_id': ADMIN_ID, 'details': f"Accepted chat with {target_id}"})
+    save_action({'type': 'admin_chat_accepted', 'chat_id': admin_id, 'details': f"Accepted chat with {target_id}"})
     await callback.answer("✅ Chat boshlandi va foydalanuvchiga xabar yuborildi.", show_alert=True)
 
 # New: admin declines the user chat request
-@dp.callback_query(F.data.startswith("admin_decline_chat_"), F.from_user.id == ADMIN_ID)
-async def admin_decline_chat(callback: types.CallbackQuery, state: FSMContext):
-    try:
-        target_id = int(callback.data.split("_")[-1])
-    except Exception:
-        await callback.answer("❌ Noto'g'ri foydalanuvchi ID.", show_alert=True)
-        return
+@admin_router.callback_query(UserActionCb.filter(F.action == "decline"))
+async def admin_decline_chat(callback: types.CallbackQuery, state: FSMContext, callback_data: UserActionCb):
+    target_id = callback_data.user_id
+    release_idempotency(f"{target_id}:admin_chat")
+    release_assignment(target_id)
     try:
         await callback.message.edit_text(f"❌ Siz {target_id} uchun chat so'rovini rad etdingiz.")
     except Exception:
@@ -2076,11 +3581,150 @@ async def admin_decline_chat(callback: types.CallbackQuery, state: FSMContext):
         await bot.send_message(target_id, "❌ Admin sizning chat so'rovingizni rad etdi. Keyinroq qayta urinib ko'ring.", reply_markup=get_main_menu(target_id))
     except Exception:
         logger.warning(f"Could not notify user {target_id} about declined admin chat.")
-    save_action({'type': 'admin_chat_declined', 'chat_id': ADMIN_ID, 'details': f"Declined chat with {target_id}"})
+    save_action({'type': 'admin_chat_declined', 'chat_id': callback.from_user.id, 'details': f"Declined chat with {target_id}"})
     await callback.answer("❌ So'rov rad etildi va foydalanuvchiga xabar yuborildi.", show_alert=True)
 
+# ----------------- Chat sessiyalari: xabarlarni yo'naltirish va yakunlash -----------------
+async def _close_chat(callback: types.CallbackQuery, state: FSMContext, user_id: int):
+    caller = callback.from_user.id
+    session = close_chat_session(user_id)
+    if not session:
+        await callback.answer("ℹ️ Faol suhbat topilmadi.", show_alert=True)
+        return
+    save_action({'type': 'admin_chat_closed', 'chat_id': user_id, 'details': f"Closed by {caller}"})
+    if caller == user_id:
+        await state.clear()
+        await safe_edit_or_send(callback, "🚪 Admin bilan suhbat yakunlandi. Bosh menyuga qaytdingiz.", get_main_menu(user_id))
+        try:
+            await bot.send_message(session['admin_id'], f"🚪 Foydalanuvchi {user_id} suhbatni yakunladi.")
+        except Exception as e:
+            logger.debug("Suhbat yakuni haqida adminga yozilmadi: %s", e)
+    else:
+        await safe_edit_or_send(callback, f"🚪 {user_id} bilan suhbat yakunlandi.")
+        try:
+            await bot.send_message(user_id, "🚪 Admin suhbatni yakunladi. Bosh menyudan davom etishingiz mumkin.", reply_markup=get_main_menu(user_id))
+        except Exception as e:
+            logger.debug("Suhbat yakuni haqida foydalanuvchiga yozilmadi: %s", e)
+@dp.callback_query(F.data == "exit_admin_chat")
+async def exit_admin_chat(callback: types.CallbackQuery, state: FSMContext):
+    await _close_chat(callback, state, callback.from_user.id)
+@admin_router.callback_query(UserActionCb.filter(F.action == "exit"))
+async def admin_exit_chat(callback: types.CallbackQuery, state: FSMContext, callback_data: UserActionCb):
+    await _close_chat(callback, state, callback_data.user_id)
+@admin_router.callback_query(UserActionCb.filter(F.action == "focus"))
+async def focus_chat(callback: types.CallbackQuery, callback_data: UserActionCb):
+    user_id = callback_data.user_id
+    if user_id not in sessions_by_admin.get(callback.from_user.id, ()):
+        await callback.answer("ℹ️ Bu suhbat yopilgan.", show_alert=True)
+        return
+    admin_chat_targets[callback.from_user.id] = user_id
+    await callback.answer(f"✍️ Keyingi xabarlaringiz {user_id} ga yuboriladi.")
+def _admin_relay_filter(message: types.Message):
+    if not is_admin(message.chat.id) or (message.text or "").startswith("/"):
+        return False
+    user_id = resolve_admin_target(message)
+    return {'target_id': user_id} if user_id is not None else False
+@admin_router.message(StateFilter(None), _admin_relay_filter)
+async def admin_chat_relay(message: types.Message, target_id: int):
+    try:
+        await bot.copy_message(chat_id=target_id, from_chat_id=message.chat.id, message_id=message.message_id, reply_markup=KB_ADMIN_CHAT_EXIT)
+        touch_chat_session(target_id)
+        admin_chat_targets[message.chat.id] = target_id
+    except Exception as e:
+        logger.error(f"Admin xabari {target_id} ga yetkazilmadi: {e}")
+        await message.reply(f"⚠️ Xabar {target_id} ga yetkazilmadi. Foydalanuvchi botni bloklagan bo'lishi mumkin.")
+@dp.message(StateFilter(None), lambda message: is_in_chat(message.chat.id) and not is_admin(message.chat.id), flags={"throttle": "relay"})
+async def user_chat_relay(message: types.Message):
+    chat_id = message.chat.id
+    try:
+        await relay_to_operator(message, "Suhbat")
+    except Exception as e:
+        logger.error(f"Foydalanuvchi {chat_id} xabari adminga yetkazilmadi: {e}")
+        await message.answer("⚠️ Xabar yuborishda texnik xato yuz berdi. Qayta urinib ko'ring.")
+
+# ----------------- Operatorlarni boshqarish -----------------
+def _operators_text() -> str:
+    text = "👮 <b>Operatorlar:</b>\n\n"
+    for aid, a in ADMINS.items():
+        status = "🟢 onlayn" if a['online'] else "🔴 oflayn"
+        role = "egasi" if a['role'] == ROLE_OWNER else "operator"
+        text += f"• {a['name']} (ID: {aid}, {role}) — {status}, ochiq so'rovlar: {admin_load.get(aid, 0)}\n"
+    return text
+@admin_router.callback_query(F.data == "admin_operators")
+async def admin_operators(callback: types.CallbackQuery, state: FSMContext):
+    text = _operators_text()
+    if is_owner(callback.from_user.id):
+        text += "\nOperator qo'shish: /add_admin <id> [ism]\nOperatorni o'chirish: /remove_admin <id>"
+    await safe_edit_or_send(callback, text, KB_ADMIN_PANEL)
+@admin_router.callback_query(F.data == "admin_toggle_online")
+async def admin_toggle_online(callback: types.CallbackQuery, state: FSMContext):
+    admin_id = callback.from_user.id
+    online = not ADMINS[admin_id]['online']
+    set_admin_online(admin_id, online)
+    await callback.answer("🟢 Siz onlaynsiz - yangi so'rovlar sizga ham yo'naltiriladi." if online else "🔴 Siz oflaynsiz - yangi so'rovlar boshqa operatorlarga yo'naltiriladi.", show_alert=True)
+@admin_router.message(Command("online", "offline"))
+async def admin_set_online_cmd(message: types.Message):
+    online = message.text.lstrip("/").startswith("online")
+    set_admin_online(message.chat.id, online)
+    await message.answer("🟢 Holat: onlayn." if online else "🔴 Holat: oflayn.")
+@admin_router.message(Command("add_admin"), F.chat.id.func(is_owner))
+async def owner_add_admin(message: types.Message):
+    parts = (message.text or "").split(maxsplit=2)
+    if len(parts) < 2 or not parts[1].lstrip("-").isdigit():
+        await message.answer("❌ Foydalanish: /add_admin <id> [ism]")
+        return
+    admin_id = int(parts[1])
+    name = parts[2] if len(parts) > 2 else f"Operator {admin_id}"
+    add_admin(admin_id, name, ROLE_OWNER if admin_id == ADMIN_ID else ROLE_OPERATOR)
+    save_action({'type': 'admin_added', 'chat_id': message.chat.id, 'details': f"Operator {admin_id} ({name})"})
+    await message.answer(f"✅ {name} (ID: {admin_id}) operator sifatida qo'shildi.")
+@admin_router.message(Command("remove_admin"), F.chat.id.func(is_owner))
+async def owner_remove_admin(message: types.Message):
+    parts = (message.text or "").split()
+    if len(parts) < 2 or not parts[1].lstrip("-").isdigit() or int(parts[1]) == ADMIN_ID:
+        await message.answer("❌ Foydalanish: /remove_admin <id> (bot egasini o'chirib bo'lmaydi)")
+        return
+    admin_id = int(parts[1])
+    moved = remove_admin(admin_id)
+    save_action({'type': 'admin_removed', 'chat_id': message.chat.id, 'details': f"Operator {admin_id}"})
+    text = f"🗑️ Operator {admin_id} o'chirildi."
+    if moved:
+        counts = {}
+        for aid in moved.values():
+            counts[aid] = counts.get(aid, 0) + 1
+        text += f"\nUning {len(moved)} ta ochiq so'rovi qayta taqsimlandi: " + ", ".join(f"{ADMINS[aid]['name']} - {n} ta" for aid, n in counts.items())
+    await message.answer(text)
+    for cid, aid in moved.items():
+        try:
+            await bot.send_message(aid, f"📥 Foydalanuvchi {cid} so'rovi sizga o'tkazildi.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=f"💬 {cid} bilan chat ochish", callback_data=UserActionCb(action="chat", user_id=cid).pack())]]))
+        except Exception as e:
+            logger.warning(f"Operator {aid} ga o'tkazish xabari yuborilmadi: {e}")
+SLOW_TREE_LIMIT = 3500
+@admin_router.message(Command("slow"))
+async def admin_slow_handlers(message: types.Message):
+    parts = (message.text or "").split()
+    if len(parts) > 1 and parts[1] == "last" and slow_traces:
+        ts, handler, latency_ms, tree = slow_traces[-1]
+        if len(tree) > SLOW_TREE_LIMIT:
+            # bitta xabarga (4096 belgi) sig'ishi uchun butun qatorlar bo'yicha kesiladi
+            tree = tree[:SLOW_TREE_LIMIT].rsplit("\n", 1)[0] + "\n... (qisqartirildi)"
+        await message.answer(f"🐢 <b>Oxirgi sekin yangilanish</b> ({datetime.fromtimestamp(ts):%H:%M:%S}):\n<pre>{html.escape(tree)}</pre>")
+        return
+    lines = [f"🐢 <b>Sekin ishlovchilar</b> (>{SLOW_UPDATE_MS:.0f} ms):"]
+    top = sorted(slow_stats.items(), key=lambda item: item[1][2], reverse=True)[:10]
+    for handler, (count, total_ms, max_ms) in top:
+        lines.append(f"• <code>{handler}</code>: {count} marta, o'rtacha {total_ms / count:.0f} ms, eng ko'p {max_ms:.0f} ms")
+    if not top:
+        lines.append("Hozircha sekin yangilanishlar yo'q.")
+    recent = [lag for ts, lag in loop_lag_recent if ts > time.time() - 300]
+    if recent:
+        lines.append(f"\n⏱️ Event loop kechikishi (5 daqiqa): o'rtacha {sum(recent) / len(recent):.1f} ms, eng ko'p {max(recent):.0f} ms")
+    lines.append("\nOxirgi oraliqlar daraxti: /slow last")
+    await message.answer("\n".join(lines))
+
 # ----------------- Admin broadcast (send to all non-banned users) -----------------
-@dp.callback_query(F.data == "admin_broadcast", F.from_user.id == ADMIN_ID)
+@admin_router.callback_query(F.data == "admin_broadcast", F.from_user.id.func(is_owner))
 async def admin_broadcast_start(callback: types.CallbackQuery, state: FSMContext):
     try:
         await state.set_state(AdminBroadcast.waiting)
@@ -2089,7 +3733,7 @@ async def admin_broadcast_start(callback: types.CallbackQuery, state: FSMContext
         logger.exception(f"admin_broadcast_start xato: {e}")
         await callback.answer("❌ E'lon yuborishni boshlashda xato yuz berdi.", show_alert=True)
 
-@dp.message(StateFilter(AdminBroadcast.waiting), F.chat.id == ADMIN_ID)
+@admin_router.message(StateFilter(AdminBroadcast.waiting), F.chat.id.func(is_owner))
 async def admin_broadcast_receive(message: types.Message, state: FSMContext):
     try:
         success, total = await broadcast_message(message)
@@ -2102,14 +3746,13 @@ async def admin_broadcast_receive(message: types.Message, state: FSMContext):
 
 # ----------------- Require profile before using main services -----------------
 # For Raqam tiklash
-@dp.callback_query(F.data == "tiklash")
+@tiklash_router.callback_query(F.data == "tiklash")
 async def tiklash_start(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     if not await is_working_hours():
-        await callback.message.answer("⏰ ish vaqti: 07:00-24:00. Ertaga urinib ko'ring.")
-        return
+        await callback.message.answer(OUT_OF_HOURS_INTAKE)
     # NEW: require profile
     profile = get_chat_profile(chat_id)
     if not profile:
@@ -2120,14 +3763,13 @@ async def tiklash_start(callback: types.CallbackQuery, state: FSMContext):
     await safe_edit_or_send(callback, "📱 <b>Raqam tiklash xizmati:</b>\n\nYo'qolgan yoki bloklangan raqamingizni tiklash uchun operatorni tanlang. Keyingi qadamda raqam va bog'lanish usulini kiritasiz.", KB_TIKLASH_OPERATOR)
 
 # For Reklama
-@dp.callback_query(F.data == "reklama")
+@reklama_router.callback_query(F.data == "reklama")
 async def reklama_start(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     if not await is_working_hours():
-        await callback.message.answer("⏰ Bot ish vaqti: 07:00-24:00. Ertaga urinib ko'ring.")
-        return
+        await callback.message.answer(OUT_OF_HOURS_INTAKE)
     # NEW: require profile
     profile = get_chat_profile(chat_id)
     if not profile:
@@ -2139,14 +3781,13 @@ async def reklama_start(callback: types.CallbackQuery, state: FSMContext):
     await safe_edit_or_send(callback, "📰 <b>Reklama xizmati:</b>\n\nReklama turini tanlang. Keyingi qadamda tafsilotlar va bog'lanish ma'lumotlarini kiritasiz. So'rov adminga yuborilgach, ko'rib chiqiladi.", KB_REKLAMA_TYPES)
 
 # For Buyurtma
-@dp.callback_query(F.data == "buyurtma")
+@buyurtma_router.callback_query(F.data == "buyurtma")
 async def buyurtma_start(callback: types.CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     ensure_chat_exists(chat_id)
     update_chat_activity(chat_id)
     if not await is_working_hours():
-        await callback.message.answer("⏰ Bot ish vaqti: 07:00-24:00. Ertaga urinib ko'ring.")
-        return
+        await callback.message.answer(OUT_OF_HOURS_INTAKE)
     # NEW: require profile
     profile = get_chat_profile(chat_id)
     if not profile:
@@ -2155,19 +3796,43 @@ async def buyurtma_start(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await state.update_data(files=[])
     await state.set_state(RaqamBuyurtma.mahalla)
-    await safe_edit_or_send(callback, "🆕 <b>Yangi raqam buyurtma xizmati:</b>\n\nYangi raqam olish uchun mahallangizni tanlang. Keyingi qadamlar: ma'lumot, operator, joylashuv va bog'lanish.", kb_mahalla_page(0))
+    await safe_edit_or_send(callback, "🆕 <b>Yangi raqam buyurtma xizmati:</b>\n\nYangi raqam olish uchun mahallangizni tanlang yoki nomini yozib yuboring. Keyingi qadamlar: ma'lumot, operator, joylashuv va bog'lanish.", kb_mahalla_page(0))
 
+Gauge("bot_outbound_queue_depth", "Chiquvchi xabarlar navbati", lambda: outbound.depth)
+Gauge("bot_deferred_requests", "Ish vaqtini kutayotgan so'rovlar", lambda: get_db_conn_scalar("SELECT COUNT(*) FROM deferred_requests"))
+Gauge("bot_media_groups_pending", "Yig'ilayotgan albomlar", lambda: len(_media_groups))
+Gauge("bot_chat_sessions_open", "Ochiq admin suhbatlari", lambda: len(sessions_by_user))
+Gauge("bot_users_online", "So'nggi 5 daqiqada faol foydalanuvchilar", lambda: presence.count())
+Gauge("bot_throttle_buckets", "Xotiradagi flood chelaklari", lambda: len(_buckets))
+def get_db_conn_scalar(query: str):
+    with get_db_conn() as conn:
+        return conn.execute(query).fetchone()[0]
 async def main():
     logger.info("Bot ishga tushmoqda...")
+    metrics_runner = await start_metrics_server()
+    if ADMIN_DIGEST_INTERVAL:
+        asyncio.create_task(admin_digest_loop())
+    asyncio.create_task(expire_idle_sessions_loop())
+    asyncio.create_task(presence_flush_loop())
+    asyncio.create_task(throttle_housekeeping_loop())
+    asyncio.create_task(business_hours_loop())
+    asyncio.create_task(loop_lag_monitor())
     try:
-        await dp.start_polling(bot)
+        # chat_member yangilanishlari standart ro'yxatda yo'q: ishlatilayotgan turlar aniq so'raladi
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except Exception as e:
         logger.exception(f"Botda ishlashda xato yuz berdi: {e}")
     finally:
+        presence.flush()
+        if _digest_buffer:
+            # yig'ilgan, hali yuborilmagan bildirishnomalar qayta ishga tushishda yo'qolmasligi uchun
+            await flush_admin_digest()
+        if metrics_runner:
+            await metrics_runner.cleanup()
         try:
             await bot.close()
         except Exception as e:
-            logger.debug(f"Botni yopishda xato: {e}")
+            logger.debug("Botni yopishda xato: %s", e)
         logger.info("Bot to'xtatildi.")
 
 if __name__ == "__main__":